@@ -0,0 +1,277 @@
+# backends.py
+"""Платформенные бэкенды клиента: уведомления, keepalive сокета, путь к настройкам
+(и шаблон путей к профилям всех пользователей для режима службы), проверка
+запущенного процесса.
+
+Модули Windows (pywin32, COM) импортируются только при первом обращении к
+бэкенду, которому они нужны, поэтому client.py импортируется быстро и на
+любой ОС. HeadlessBackend написан на чистом Python: уведомления пишутся
+в лог, а путь к настройкам берется из окружения. Бэкенд выбирается
+переменной MICROSIP_PLATFORM (windows | headless), по умолчанию - по ОС.
+"""
+import ctypes
+import logging
+import os
+import socket
+import sys
+import time
+
+KEEPALIVE_IDLE = 10  # Секунд тишины до первой keepalive-пробы
+KEEPALIVE_INTERVAL = 3  # Интервал между пробами (секунды)
+KEEPALIVE_PROBES = 5  # Неотвеченных проб до разрыва (где ОС позволяет задать)
+TH32CS_SNAPPROCESS = 0x00000002
+PROCESS_QUERY_LIMITED_INFORMATION = 0x1000
+STILL_ACTIVE = 259
+INVALID_HANDLE_VALUE = ctypes.c_void_p(-1).value
+
+
+class NotificationManager:
+    """Уведомления Windows: WScript.Shell.Popup, при неудаче - MessageBoxW"""
+
+    def __init__(self):
+        self.app_id = "MicroSip"
+        try:
+            from win32com.client import Dispatch
+            self.shell = Dispatch("WScript.Shell")
+        except Exception as e:
+            logging.error(f"Failed to initialize WScript.Shell: {e}")
+            self.shell = None
+
+    def show_notification(self, title, message, duration=5):
+        """Показывает уведомление в правом нижнем углу экрана"""
+        try:
+            if self.shell:
+                try:
+                    # Создаем объект уведомления через WScript.Shell
+                    notification = self.shell.CreateObject("WScript.Shell.1")
+                    notification.Popup(
+                        "MicroSip",
+                        message,
+                        duration,
+                        0x1  # Information icon
+                    )
+                    return "message_displayed"
+                except Exception as e:
+                    logging.error(f"Failed to show WScript notification: {e}")
+
+            # Если WScript.Shell не работает, используем стандартное окно сообщения
+            ctypes.windll.user32.MessageBoxW(0, message, "MicroSip", 0x40)
+            return "message_displayed"
+        except Exception as e:
+            logging.error(f"Ошибка при показе уведомления: {e}")
+
+
+class HeadlessNotifier:
+    """Уведомления без UI: пишет в лог и запоминает показанное (для тестов и служб)"""
+
+    def __init__(self, display_seconds=0):
+        self.display_seconds = display_seconds  # Сколько "пользователь" держит окно открытым
+        self.shown = []
+
+    def show_notification(self, title, message, duration=5):
+        logging.info(f"Уведомление: {title}: {message}")
+        self.shown.append((title, message))
+        if self.display_seconds:
+            time.sleep(self.display_seconds)
+        return "message_displayed"
+
+
+class HeadlessBackend:
+    """Бэкенд на чистом Python (Linux CI, тестовые стенды, службы без рабочего стола)"""
+    name = 'headless'
+    FULL_SCAN_EVERY = 10  # Каждый N-й обход /proc перечитывает имена всех процессов (exec без смены PID)
+
+    def __init__(self):
+        self._known = {}  # PID -> (имя, сколько раз прочитано) по прошлому обходу /proc
+        self._scans = 0
+
+    def settings_path(self):
+        """Путь к microsip.ini: MICROSIP_SETTINGS_PATH, иначе %APPDATA% или ~/.config"""
+        explicit = os.getenv('MICROSIP_SETTINGS_PATH')
+        if explicit:
+            return explicit
+        base = os.getenv('APPDATA') or os.path.join(os.path.expanduser('~'), '.config')
+        return os.path.join(base, 'MicroSIP', 'microsip.ini')
+
+    def profiles_pattern(self):
+        """Шаблон путей к microsip.ini всех пользователей ('*' - имя пользователя)"""
+        return os.path.join('/home', '*', '.config', 'MicroSIP', 'microsip.ini')
+
+    def configure_keepalive(self, sock):
+        """TCP keepalive средствами setsockopt (параметры - где ОС их поддерживает)"""
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        for option, value in (('TCP_KEEPIDLE', KEEPALIVE_IDLE), ('TCP_KEEPINTVL', KEEPALIVE_INTERVAL),
+                              ('TCP_KEEPCNT', KEEPALIVE_PROBES)):
+            if hasattr(socket, option):
+                try:
+                    sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, option), value)
+                except OSError as e:
+                    logging.debug(f"Не удалось установить {option}: {e}")
+
+    def create_notifier(self):
+        return HeadlessNotifier()
+
+    def process_running(self, image_name):
+        """Есть ли процесс с таким именем; None, если ОС не позволяет узнать"""
+        pid = self.find_process(image_name)
+        return None if pid is None else bool(pid)
+
+    def find_process(self, image_name):
+        """PID процесса с таким именем (по /proc); 0 - не найден, None - /proc недоступен.
+
+        Имена читаются только у новых PID (дважды: первый раз можно застать
+        процесс между fork и exec) и у всех - раз в FULL_SCAN_EVERY обходов."""
+        if not os.path.isdir('/proc'):
+            return None
+        wanted = self._names(image_name)
+        self._scans += 1
+        full = self._scans % self.FULL_SCAN_EVERY == 0
+        known = {}
+        for entry in os.scandir('/proc'):
+            if not entry.name.isdigit():
+                continue
+            name, reads = self._known.get(entry.name, (None, 0))
+            if full or reads < 2:
+                name, reads = self._comm(entry.name), reads + 1
+            known[entry.name] = (name, reads)
+            if name in wanted:
+                return int(entry.name)
+        self._known = known
+        return 0
+
+    def process_generation(self):
+        """Метка, которая меняется при запуске любого процесса; None - ОС не дает ее дешево.
+
+        Последний выданный PID из /proc/loadavg: одно чтение вместо обхода /proc."""
+        try:
+            fd = os.open('/proc/loadavg', os.O_RDONLY)
+        except OSError:
+            return None
+        try:
+            return os.read(fd, 128).split()[-1]
+        except (OSError, IndexError):
+            return None
+        finally:
+            os.close(fd)
+
+    def process_alive(self, pid, image_name):
+        """Жив ли процесс pid с тем же именем (проверка одного PID вместо обхода списка)"""
+        return self._comm(pid) in self._names(image_name)
+
+    @staticmethod
+    def _names(image_name):
+        # В /proc/PID/comm имя без пути; запускаемый под Wine или заглушка может быть и без .exe
+        return {image_name.lower(), os.path.splitext(image_name)[0].lower()}
+
+    @staticmethod
+    def _comm(pid):
+        # os.open/os.read вдвое дешевле open()
+        try:
+            fd = os.open(f'/proc/{pid}/comm', os.O_RDONLY)
+        except OSError:
+            return None
+        try:
+            return os.read(fd, 64).decode('utf-8', 'replace').strip().lower()
+        except OSError:
+            return None
+        finally:
+            os.close(fd)
+
+
+class WindowsBackend(HeadlessBackend):
+    """Windows: окна уведомлений через COM/user32, keepalive через WSAIoctl"""
+    name = 'windows'
+
+    def settings_path(self):
+        return os.getenv('MICROSIP_SETTINGS_PATH') or os.path.join(
+            os.getenv('APPDATA'), 'MicroSIP', 'microsip.ini')
+
+    def profiles_pattern(self):
+        return os.path.join(os.getenv('SystemDrive', 'C:') + os.sep, 'Users', '*',
+                            'AppData', 'Roaming', 'MicroSIP', 'microsip.ini')
+
+    def configure_keepalive(self, sock):
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        sock.ioctl(socket.SIO_KEEPALIVE_VALS, (1, KEEPALIVE_IDLE * 1000, KEEPALIVE_INTERVAL * 1000))
+
+    def create_notifier(self):
+        return NotificationManager()
+
+    def find_process(self, image_name):
+        """PID процесса с таким именем (снимок процессов Toolhelp32, без запуска tasklist)"""
+        from ctypes import wintypes
+
+        class PROCESSENTRY32W(ctypes.Structure):
+            _fields_ = [('dwSize', wintypes.DWORD), ('cntUsage', wintypes.DWORD),
+                        ('th32ProcessID', wintypes.DWORD), ('th32DefaultHeapID', ctypes.c_size_t),
+                        ('th32ModuleID', wintypes.DWORD), ('cntThreads', wintypes.DWORD),
+                        ('th32ParentProcessID', wintypes.DWORD), ('pcPriClassBase', wintypes.LONG),
+                        ('dwFlags', wintypes.DWORD), ('szExeFile', wintypes.WCHAR * 260)]
+
+        kernel32 = ctypes.windll.kernel32
+        kernel32.CreateToolhelp32Snapshot.restype = wintypes.HANDLE
+        snapshot = kernel32.CreateToolhelp32Snapshot(TH32CS_SNAPPROCESS, 0)
+        if snapshot in (None, INVALID_HANDLE_VALUE):
+            return None
+        handle = wintypes.HANDLE(snapshot)  # Без argtypes int усекся бы до 32 бит
+        try:
+            entry = PROCESSENTRY32W()
+            entry.dwSize = ctypes.sizeof(PROCESSENTRY32W)
+            found = kernel32.Process32FirstW(handle, ctypes.byref(entry))
+            while found:
+                if entry.szExeFile.lower() == image_name.lower():
+                    return entry.th32ProcessID
+                found = kernel32.Process32NextW(handle, ctypes.byref(entry))
+            return 0
+        finally:
+            kernel32.CloseHandle(handle)
+
+    def process_generation(self):
+        """Хеш списка PID (EnumProcesses): без имен процессов, дешевле снимка Toolhelp32"""
+        from ctypes import wintypes
+
+        pids = (wintypes.DWORD * 4096)()
+        size = wintypes.DWORD()
+        if not ctypes.windll.psapi.EnumProcesses(pids, ctypes.sizeof(pids), ctypes.byref(size)):
+            return None
+        if size.value == ctypes.sizeof(pids):
+            return None  # Список не поместился - по нему нельзя судить о новых процессах
+        return hash(bytes(pids)[:size.value])
+
+    def process_alive(self, pid, image_name):
+        """Жив ли процесс pid с тем же именем (OpenProcess, без снимка всех процессов)"""
+        from ctypes import wintypes
+
+        kernel32 = ctypes.windll.kernel32
+        kernel32.OpenProcess.restype = wintypes.HANDLE
+        handle = kernel32.OpenProcess(PROCESS_QUERY_LIMITED_INFORMATION, False, pid)
+        if not handle:
+            return False
+        handle = wintypes.HANDLE(handle)
+        try:
+            code = wintypes.DWORD()
+            if not kernel32.GetExitCodeProcess(handle, ctypes.byref(code)) or code.value != STILL_ACTIVE:
+                return False
+            buffer = ctypes.create_unicode_buffer(260)
+            size = wintypes.DWORD(len(buffer))
+            if not kernel32.QueryFullProcessImageNameW(handle, 0, buffer, ctypes.byref(size)):
+                return True
+            return os.path.basename(buffer.value).lower() == image_name.lower()
+        finally:
+            kernel32.CloseHandle(handle)
+
+
+BACKENDS = {backend.name: backend for backend in (WindowsBackend, HeadlessBackend)}
+_current = None
+
+
+def get_backend():
+    """Бэкенд текущей платформы (создается один раз)"""
+    global _current
+    if _current is None:
+        name = os.getenv('MICROSIP_PLATFORM') or ('windows' if sys.platform == 'win32' else 'headless')
+        if name not in BACKENDS:
+            logging.warning(f"Неизвестная платформа {name}, используем headless")
+            name = 'headless'
+        _current = BACKENDS[name]()
+    return _current
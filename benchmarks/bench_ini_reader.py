@@ -0,0 +1,127 @@
+# bench_ini_reader.py
+"""Сравнение стоимости get_dnd_status: исходное чтение microsip.ini и IniReader.
+
+Запуск: python benchmarks/bench_ini_reader.py [--accounts 1 100 2000] [--iterations 200]
+"""
+import argparse
+import os
+import tempfile
+import time
+
+from support import import_client
+
+client = import_client()
+
+ENCODINGS = ['utf-16', 'utf-8', 'cp1251']
+
+
+def build_ini(accounts, dnd):
+    """Формирует ini в формате MicroSIP: [Settings] и секции учетных записей"""
+    lines = ['[Settings]']
+    for i in range(40):
+        lines.append(f'setting{i}={i * 7}')
+    lines.append(f'DND={dnd}')
+    lines.append('autoAnswer=button')
+    for account in range(1, accounts + 1):
+        lines.append(f'[Account{account}]')
+        lines.append(f'label=Оператор {account}')
+        lines.append(f'server=sip{account % 8}.example.local')
+        lines.append(f'username={1000 + account}')
+        lines.append(f'displayName=Сотрудник отдела {account}')
+        for i in range(12):
+            lines.append(f'option{i}={account}-{i}')
+    return '\r\n'.join(lines) + '\r\n'
+
+
+def legacy_get_dnd_status(path):
+    """Исходный алгоритм get_dnd_status (до IniReader), без логирования"""
+    encodings = ['utf-16', 'utf-16le', 'utf-16be', 'utf-8', 'cp1251']
+    with open(path, 'rb') as f:
+        raw = f.read()
+        if raw.startswith(b'\xff\xfe'):
+            encodings.insert(0, 'utf-16le')
+        elif raw.startswith(b'\xfe\xff'):
+            encodings.insert(0, 'utf-16be')
+    for encoding in encodings:
+        try:
+            with open(path, 'r', encoding=encoding) as f:
+                content = f.read()
+                for line in content.splitlines():
+                    if line.strip().startswith('DND='):
+                        dnd_value = line.strip().split('=')[1]
+                        if dnd_value.isdigit():
+                            return dnd_value
+                return "1"
+        except UnicodeError:
+            continue
+    with open(path, 'rb') as f:
+        content = f.read()
+        if b'DND=' in content:
+            pos = content.index(b'DND=') + 4
+            value = chr(content[pos])
+            if value in ['0', '1']:
+                return value
+    return "1"
+
+
+SCENARIOS = ['unchanged', 'changed', 'resized']
+
+
+def write_ini(path, accounts, dnd, encoding, tail=''):
+    with open(path, 'w', encoding=encoding, newline='') as f:
+        f.write(build_ini(accounts, dnd) + tail)
+
+
+def measure(read, path, accounts, encoding, iterations, scenario):
+    """Среднее время вызова (мкс) и число неверных ответов.
+
+    changed - перед вызовом DND меняется без изменения размера файла,
+    resized - вдобавок через раз в конец дописывается строка (размер меняется).
+    """
+    read(path)  # прогрев: первый разбор не входит в замер
+    total = 0.0
+    errors = 0
+    for i in range(iterations):
+        toggle = scenario != 'unchanged'
+        expected = str(i % 2) if toggle else '0'
+        if toggle:
+            tail = '; resized\r\n' * (i % 2) if scenario == 'resized' else ''
+            write_ini(path, accounts, i % 2, encoding, tail)
+            # Гарантируем новый mtime даже на файловых системах с грубым разрешением
+            os.utime(path, ns=(i * 1000, i * 1000))
+        start = time.perf_counter()
+        value = read(path)
+        total += time.perf_counter() - start
+        if value != expected:
+            errors += 1
+    return total / iterations * 1e6, errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--accounts', type=int, nargs='+', default=[1, 100, 2000])
+    parser.add_argument('--iterations', type=int, default=200)
+    args = parser.parse_args()
+
+    print(f"{'encoding':8} {'accounts':>8} {'size KB':>8} {'scenario':>9} "
+          f"{'legacy us':>10} {'cached us':>10} {'speedup':>8} {'wrong l/c':>10}")
+    with tempfile.TemporaryDirectory() as temp_dir:
+        path = os.path.join(temp_dir, 'microsip.ini')
+        for encoding in ENCODINGS:
+            for accounts in args.accounts:
+                for scenario in SCENARIOS:
+                    write_ini(path, accounts, 0, encoding)
+                    legacy, legacy_errors = measure(legacy_get_dnd_status, path, accounts, encoding,
+                                     args.iterations, scenario)
+                    write_ini(path, accounts, 0, encoding)
+                    reader = client.IniReader(path)
+                    cached, cached_errors = measure(lambda p: reader.get('DND'), path, accounts, encoding,
+                                     args.iterations, scenario)
+                    size = os.path.getsize(path) / 1024
+                    print(f"{encoding:8} {accounts:8d} {size:8.1f} {scenario:>9} "
+                          f"{legacy:10.1f} {cached:10.1f} {legacy / cached:7.1f}x "
+                          f"{legacy_errors:>4}/{cached_errors:<4}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,159 @@
+# bench_status.py
+"""Снимок статуса: прямое чтение против общего StatusService.
+
+Несколько потоков одновременно (как параллельные check_dnd_status от
+сервера, начальный статус и наблюдатель) запрашивают статус сериями.
+Пауза между сериями по умолчанию больше STATUS_TTL, как у реальных опросов
+сервера. Сравниваются число чтений с диска и задержка вызова для прямого
+чтения, для StatusService с ttl (опрос файла) и для StatusService с
+нативным наблюдателем (ttl = None, снимок сбрасывает только изменение
+файла). Проверяется, что после изменения файла и invalidate() читается
+новое значение.
+
+Бенчмарк завершается с кодом 1, если с наблюдателем было больше двух
+чтений с диска (первое и одно после изменения файла), новое значение не
+увидено или после invalidate() прочитано старое значение.
+
+Запуск: python benchmarks/bench_status.py [--readers 8] [--rounds 5] [--gap-ms 1500]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+
+from support import import_client, summarize
+
+os.environ['MICROSIP_PLATFORM'] = 'headless'
+client = import_client()
+
+
+def write_ini(path, dnd):
+    with open(path, 'w', encoding='utf-16') as f:
+        f.write(f'[Settings]\r\naccountId=1\r\nDND={dnd}\r\n[Account1]\r\nusername=1001\r\n')
+
+
+class SnapshotSource:
+    """Та же последовательность чтений, что у MicrosipClient.read_status_snapshot"""
+
+    def __init__(self, path):
+        self.reader = client.IniReader(path)
+        self.backend = client.get_backend()
+        self.reads = 0
+        self.lock = threading.Lock()
+
+    def read(self):
+        with self.lock:
+            self.reads += 1
+        running = self.backend.process_running(client.MICROSIP_PROCESS)
+        return client.StatusSnapshot(self.reader.get('DND'), running, self.reader.get('accountId'))
+
+
+def run_rounds(get, readers, rounds, gap):
+    """rounds серий: readers потоков одновременно вызывают get(); возвращает задержки"""
+    timings = []
+    lock = threading.Lock()
+    barrier = threading.Barrier(readers)
+
+    def worker():
+        local = []
+        for _ in range(rounds):
+            barrier.wait()
+            started = time.perf_counter()
+            get()
+            local.append(time.perf_counter() - started)
+            time.sleep(gap)
+        with lock:
+            timings.extend(local)
+
+    threads = [threading.Thread(target=worker) for _ in range(readers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return timings
+
+
+def run_watched(path, args):
+    """StatusService без ttl с нативным наблюдателем; посреди опросов файл меняется один раз"""
+    source = SnapshotSource(path)
+    service = client.StatusService(source.read, ttl=None)
+    watcher = client.create_file_watcher(path, lambda changed: service.invalidate())
+    watcher.start()
+    try:
+        half = args.rounds // 2
+        timings = run_rounds(service.get, args.readers, half, args.gap_ms / 1000)
+        write_ini(path, 0)
+        time.sleep(client.DND_DEBOUNCE + 0.2)  # Событие наблюдателя должно дойти
+        timings += run_rounds(service.get, args.readers, args.rounds - half, args.gap_ms / 1000)
+        seen = service.get().dnd
+    finally:
+        watcher.stop()
+        write_ini(path, 1)
+    return source, service, timings, watcher.name, seen
+
+
+def check_invalidation(path, iterations):
+    """После записи и invalidate() снимок должен сразу показывать новое значение"""
+    source = SnapshotSource(path)
+    service = client.StatusService(source.read, ttl=3600)
+    wrong = 0
+    for i in range(iterations):
+        write_ini(path, i % 2)
+        os.utime(path, ns=(i * 1000, i * 1000))
+        service.invalidate()
+        if service.get().dnd != str(i % 2):
+            wrong += 1
+    return wrong
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--readers', type=int, default=8, help="одновременных читателей")
+    parser.add_argument('--rounds', type=int, default=5)
+    parser.add_argument('--gap-ms', type=float, default=1500.0, help="пауза между сериями (больше STATUS_TTL)")
+    parser.add_argument('--ttl', type=float, default=client.STATUS_TTL)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        path = os.path.join(work_dir, 'microsip.ini')
+        write_ini(path, 1)
+        calls = args.readers * args.rounds
+
+        direct = SnapshotSource(path)
+        direct_timings = run_rounds(direct.read, args.readers, args.rounds, args.gap_ms / 1000)
+
+        shared = SnapshotSource(path)
+        service = client.StatusService(shared.read, ttl=args.ttl)
+        shared_timings = run_rounds(service.get, args.readers, args.rounds, args.gap_ms / 1000)
+
+        watched, watched_service, watched_timings, backend, seen = run_watched(path, args)
+
+        print(f"poll gap {args.gap_ms:g}ms, ttl {args.ttl:g}s, watcher backend: {backend}")
+        for name, source, timings in (('direct', direct, direct_timings), ('ttl', shared, shared_timings),
+                                      ('watched', watched, watched_timings)):
+            s = summarize(timings, scale=1e6)
+            print(f"{name:8} calls={calls} disk_reads={source.reads:<5} p50={s['p50']:8.1f}us "
+                  f"p99={s['p99']:8.1f}us max={s['max']:8.1f}us")
+        print(f"ttl counters: {service.stats()}")
+        print(f"watched counters: {watched_service.stats()}")
+        stale = check_invalidation(path, 100)
+        print(f"stale reads after invalidate: {stale}/100")
+
+    problems = []
+    if backend == 'polling':
+        problems.append("нативный наблюдатель недоступен")
+    if watched.reads > 2:
+        problems.append(f"с наблюдателем {watched.reads} чтений с диска (ожидалось 2: начальное и после изменения)")
+    if seen != '0':
+        problems.append(f"с наблюдателем после изменения файла прочитано DND={seen}")
+    if stale:
+        problems.append(f"после invalidate() прочитано старое значение: {stale}/100")
+    for problem in problems:
+        print(f"НАРУШЕНИЕ: {problem}")
+    return 1 if problems else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,131 @@
+# bench_update.py
+"""Бенчмарк проверки и загрузки обновлений против локального API релизов.
+
+Сравнивает первую проверку (200 с телом) с повторной условной (304),
+измеряет скорость загрузки, объем докачки после обрыва на середине и
+отказ от файла с неверной контрольной суммой. Установка (замена exe)
+не выполняется.
+
+Запуск: python benchmarks/bench_update.py [--size-mb 8] [--checks 50]
+"""
+import argparse
+import os
+import tempfile
+import time
+
+from support import import_client, summarize
+from mock_release_server import MockReleaseServer
+
+client = import_client()
+client.UPDATE_ROLLOUT_WINDOW = 0  # поэтапное развертывание проверяет update_fleet.py
+
+
+class SilentNotifications:
+    def show_notification(self, title, message):
+        pass
+
+
+class BenchUpdateManager(client.UpdateManager):
+    """Не заменяет исполняемый файл, а запоминает загруженный"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.installed = None
+
+    def install_update(self, update_file):
+        self.installed = update_file
+
+
+def make_manager(server, work_dir):
+    return BenchUpdateManager(SilentNotifications(), api_url=server.api_url,
+                              cache_path=os.path.join(work_dir, 'update_cache.json'),
+                              download_dir=os.path.join(work_dir, 'updates'))
+
+
+def measure_checks(server, work_dir, checks):
+    """Латентность первой и повторных (условных) проверок"""
+    manager = make_manager(server, work_dir)
+    started = time.perf_counter()
+    manager.fetch_latest_release()
+    first = time.perf_counter() - started
+    timings = []
+    for _ in range(checks):
+        started = time.perf_counter()
+        manager.fetch_latest_release()
+        timings.append(time.perf_counter() - started)
+    # Новый экземпляр (перезапуск клиента) тоже отправляет условный запрос
+    restarted = make_manager(server, work_dir)
+    restarted.fetch_latest_release()
+    return {
+        'first_ms': first * 1000,
+        'conditional': summarize(timings),
+        'not_modified': manager.counters['not_modified'] + restarted.counters['not_modified'],
+        'conditional_total': checks + 1,
+    }
+
+
+def measure_download(server, work_dir):
+    manager = make_manager(server, work_dir)
+    started = time.perf_counter()
+    manager.check_for_updates()
+    elapsed = time.perf_counter() - started
+    size = len(server.payload)
+    return {
+        'installed': manager.installed is not None,
+        'seconds': elapsed,
+        'mb_per_s': size / elapsed / 1024 / 1024,
+    }
+
+
+def measure_resume(server, work_dir):
+    """Обрыв на середине, затем повторная проверка должна докачать остаток"""
+    size = len(server.payload)
+    server.cut_after = size // 2
+    manager = make_manager(server, work_dir)
+    manager.check_for_updates()
+    interrupted = manager.installed is None
+    sent_before = server.bytes_sent
+    manager.check_for_updates()
+    return {
+        'interrupted': interrupted,
+        'installed': manager.installed is not None,
+        'bytes_resumed': manager.counters['bytes_resumed'],
+        'bytes_after_resume': server.bytes_sent - sent_before,
+        'size': size,
+    }
+
+
+def measure_corrupted(server, work_dir):
+    server.digest = '0' * 64
+    manager = make_manager(server, work_dir)
+    manager.check_for_updates()
+    return {'rejected': manager.installed is None}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size-mb', type=float, default=8)
+    parser.add_argument('--checks', type=int, default=50)
+    args = parser.parse_args()
+
+    size = int(args.size_mb * 1024 * 1024)
+    scenarios = [('checks', measure_checks, (args.checks,)), ('download', measure_download, ()),
+                 ('resume', measure_resume, ()), ('corrupted', measure_corrupted, ())]
+    for name, measure, extra in scenarios:
+        server = MockReleaseServer(size=size).start()
+        try:
+            with tempfile.TemporaryDirectory() as work_dir:
+                result = measure(server, work_dir, *extra)
+        finally:
+            server.stop()
+        if name == 'checks':
+            c = result['conditional']
+            print(f"checks: first={result['first_ms']:.2f}ms conditional p50={c['p50']:.2f}ms "
+                  f"p99={c['p99']:.2f}ms not_modified={result['not_modified']}/{result['conditional_total']}")
+        else:
+            print(f"{name}: " + ' '.join(f"{k}={v:.2f}" if isinstance(v, float) else f"{k}={v}"
+                                         for k, v in result.items()))
+
+
+if __name__ == '__main__':
+    main()
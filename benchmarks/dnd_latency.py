@@ -0,0 +1,153 @@
+# dnd_latency.py
+"""Задержка изменения DND в microsip.ini -> dnd_status: на сервере и файловый ввод-вывод в простое.
+
+Один клиент подключается к локальному серверу. Сначала он простаивает
+--idle-seconds: никто не меняет microsip.ini. За это время считаются
+открытия microsip.ini (аудит-событие open, покрывает open() и os.open) и
+вызовы stat() через get_file_fingerprint. Затем DND переключается
+--changes раз, и для каждой записи замеряется время до нового статуса на
+сервере.
+
+С --watcher polling нативный наблюдатель отключается. Резервный наблюдатель
+в простое делает stat(), но не читает файл.
+
+Бенчмарк завершается с кодом 1, если:
+- в простое microsip.ini открывался;
+- с нативным наблюдателем в простое был хоть один stat();
+- изменение не дошло до сервера;
+- p99 задержки больше --max-latency-ms (с polling - плюс интервал опроса).
+
+Запуск: python benchmarks/dnd_latency.py [--engine threads|asyncio] [--watcher auto|polling]
+        [--idle-seconds 5] [--changes 20]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+
+from support import summarize, write_dnd
+from mock_admin_server import MockAdminServer
+from fleet_sim import ENGINES, client, wait_for
+
+
+class IniAccess:
+    """Счетчики открытий и stat() одного файла"""
+
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        self.counting = False
+        self.opens = 0
+        self.stats = 0
+        sys.addaudithook(self._audit)  # Хук нельзя снять - он отключается флагом counting
+        fingerprint = client.get_file_fingerprint
+
+        def counted_fingerprint(target):
+            if self.counting and os.path.abspath(target) == self.path:
+                self.stats += 1
+            return fingerprint(target)
+
+        client.get_file_fingerprint = counted_fingerprint
+
+    def _audit(self, event, args):
+        if self.counting and event == 'open' and isinstance(args[0], (str, bytes, os.PathLike)):
+            if os.path.abspath(os.fsdecode(args[0])) == self.path:
+                self.opens += 1
+
+    def measure(self, seconds):
+        self.opens = self.stats = 0
+        self.counting = True
+        time.sleep(seconds)
+        self.counting = False
+        return {'opens': self.opens, 'stats': self.stats}
+
+
+def server_status(server, name):
+    connection = server.connections.get(name)
+    return connection.last_status if connection else None
+
+
+def run(args):
+    if args.watcher == 'polling':
+        client.WATCHER_BACKENDS = ()
+    server = MockAdminServer().start()
+    report = {'engine': args.engine}
+    with tempfile.TemporaryDirectory() as work_dir:
+        path = os.path.join(work_dir, 'microsip.ini')
+        write_dnd(path, 0)
+        access = IniAccess(path)
+        sim = ENGINES[args.engine]('latency', path, server.query_address, os.path.join(work_dir, 'server.json'))
+        thread = threading.Thread(target=sim.run, daemon=True)
+        thread.start()
+        try:
+            if not wait_for(lambda: server_status(server, 'latency') == '0', args.timeout):
+                raise RuntimeError("Клиент не подключился")
+            time.sleep(1)  # Начальные чтения и рукопожатие позади
+            report['watcher'] = sim.dnd_watcher.name if sim.dnd_watcher else None
+            report['idle'] = access.measure(args.idle_seconds)
+
+            latencies, lost = [], 0
+            for i in range(args.changes):
+                dnd = str((i + 1) % 2)
+                started = time.perf_counter()
+                write_dnd(path, dnd)
+                while server_status(server, 'latency') != dnd:
+                    if time.perf_counter() - started > args.timeout:
+                        lost += 1
+                        break
+                    time.sleep(0.001)
+                else:
+                    latencies.append(time.perf_counter() - started)
+                time.sleep(args.gap_ms / 1000)
+            report['latency_ms'] = summarize(latencies)
+            report['lost'] = lost
+        finally:
+            sim.stop()
+            thread.join(5)
+            server.stop()
+    return report
+
+
+def violations(report, args):
+    problems = []
+    idle = report['idle']
+    if idle['opens']:
+        problems.append(f"в простое microsip.ini открыт {idle['opens']} раз")
+    if report['watcher'] != 'polling' and idle['stats']:
+        problems.append(f"с наблюдателем {report['watcher']} в простое {idle['stats']} вызовов stat()")
+    if report['lost']:
+        problems.append(f"не дошло до сервера изменений: {report['lost']}/{args.changes}")
+    limit = args.max_latency_ms
+    if report['watcher'] == 'polling':
+        limit += client.DND_POLL_INTERVAL * 1000  # Изменение замечается только очередным stat()
+    if report['latency_ms']['p99'] > limit:
+        problems.append(f"p99 задержки {report['latency_ms']['p99']:.1f}ms больше {limit:g}ms")
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--engine', choices=sorted(ENGINES), default='threads')
+    parser.add_argument('--watcher', choices=('auto', 'polling'), default='auto')
+    parser.add_argument('--idle-seconds', type=float, default=5.0)
+    parser.add_argument('--changes', type=int, default=20)
+    parser.add_argument('--gap-ms', type=float, default=200.0, help="пауза между изменениями DND")
+    parser.add_argument('--max-latency-ms', type=float, default=200.0)
+    parser.add_argument('--timeout', type=float, default=10.0)
+    args = parser.parse_args()
+
+    report = run(args)
+    s = report['latency_ms']
+    print(f"engine={report['engine']} watcher={report['watcher']}")
+    print(f"  idle {args.idle_seconds:g}s: opens={report['idle']['opens']} stats={report['idle']['stats']}")
+    print(f"  change -> server: n={s['count']} p50={s['p50']:.1f}ms p90={s['p90']:.1f}ms "
+          f"p99={s['p99']:.1f}ms max={s['max']:.1f}ms lost={report['lost']}")
+    problems = violations(report, args)
+    for problem in problems:
+        print(f"  НАРУШЕНИЕ: {problem}")
+    return 1 if problems else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
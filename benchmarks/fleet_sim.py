@@ -0,0 +1,288 @@
+# fleet_sim.py
+"""Симулятор парка клиентов: N экземпляров MicrosipClient против локального сервера.
+
+Измеряет время подключения (при первом запуске и при перезапуске с кэшем
+сервера), RTT check_dnd_status и display_message (перцентили),
+длительность шторма переподключений после разрыва всех соединений, расход
+CPU/памяти/потоков на один клиент в простое, число ping в простое и под
+нагрузкой, RTT check_dnd_status, пока у клиентов открыто уведомление, и
+RTT команды stats (метрики, которые клиент собирает сам). С --protocol 2
+дополнительно отправляет пакет из медленной команды и нескольких быстрых одним
+кадром и проверяет, что быстрые ответы не ждут медленный. Работает на
+loopback без сети с headless-бэкендом (без Windows API).
+
+Запуск: python benchmarks/fleet_sim.py --clients 100 [--engine threads|asyncio] [--protocol 1|2] [--json out.json]
+"""
+import argparse
+import json
+import os
+import statistics
+import tempfile
+import threading
+import time
+
+from support import import_client, read_rss, summarize
+from mock_admin_server import MockAdminServer
+
+os.environ['MICROSIP_PLATFORM'] = 'headless'
+client = import_client()
+
+
+class SimulatedClientMixin:
+    """Заменяет платформенные части клиента: имя хоста, путь к ini, обновления"""
+    popup_seconds = 0  # Сколько "пользователь" держит уведомление открытым
+    slow_command_seconds = 0  # Искусственная задержка команды stats (медленная команда)
+
+    def __init__(self, name, settings_path, query_address, server_cache_path):
+        self.sim_name = name
+        self.sim_settings_path = settings_path
+        super().__init__(discovery_port=0, query_address=query_address,
+                         server_cache_path=server_cache_path)
+        self.notification_manager.backend.display_seconds = self.popup_seconds
+
+    def get_hostname(self):
+        return self.sim_name
+
+    def get_settings_path(self):
+        return self.sim_settings_path
+
+    def execute_command(self, command):
+        if command == "stats" and self.slow_command_seconds:
+            time.sleep(self.slow_command_seconds)
+        return super().execute_command(command)
+
+    def check_updates(self):
+        return None
+
+    async def update_task(self):
+        pass
+
+
+ENGINES = {
+    'threads': type('SimulatedClient', (SimulatedClientMixin, client.MicrosipClient), {}),
+    'asyncio': type('SimulatedAsyncClient', (SimulatedClientMixin, client.AsyncMicrosipClient), {}),
+}
+
+
+def wait_for(predicate, timeout):
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.01)
+    return False
+
+
+def start_fleet(engine, count, settings_dir, server, broadcast=True):
+    """Создает и запускает клиентов; возвращает [(клиент, поток, время старта)]"""
+    fleet = []
+    for i in range(count):
+        path = os.path.join(settings_dir, f'sim-{i}.ini')
+        with open(path, 'w', encoding='utf-16') as f:
+            f.write(f'[Settings]\r\nDND={i % 2}\r\n')
+        cache_path = os.path.join(settings_dir, f'sim-{i}.server.json')
+        started_at = time.perf_counter()
+        sim = ENGINES[engine](f'sim-{i}', path, server.query_address, cache_path)
+        thread = threading.Thread(target=sim.run, daemon=True)
+        thread.start()
+        fleet.append((sim, thread, started_at))
+    if broadcast:
+        for sim, _, _ in fleet:
+            if not wait_for(lambda: sim.discovery_port, 5):
+                raise RuntimeError(f"{sim.hostname}: discovery-сокет не открыт")
+            server.add_discovery_target(sim.discovery_port)
+    return fleet
+
+
+def stop_fleet(fleet):
+    for sim, _, _ in fleet:
+        sim.stop()
+    for _, thread, _ in fleet:
+        thread.join(5)
+
+
+def connect_times(server, fleet):
+    return [server.connections[sim.hostname].first_status_at - started_at
+            for sim, _, started_at in fleet]
+
+
+def measure_idle(server, seconds, count):
+    """CPU, потоки и ping за время простоя в пересчете на клиента"""
+    pings_before = server.pings_received()
+    cpu_before = time.process_time()
+    time.sleep(seconds)
+    cpu = time.process_time() - cpu_before
+    return {
+        'idle_seconds': seconds,
+        'cpu_ms_per_client_per_s': cpu / seconds / count * 1000,
+        'pings_per_client_per_min': (server.pings_received() - pings_before) / count / seconds * 60,
+        'threads_total': threading.active_count(),
+    }
+
+
+def measure_storm(server, count, timeout):
+    """Разрывает все соединения и ждет, пока клиенты вернутся"""
+    before = len(server.handshakes)
+    dropped_at = time.perf_counter()
+    server.drop_all()
+    recovered = server.wait_ready(count, timeout) and wait_for(
+        lambda: len(server.handshakes) - before >= count, timeout)
+    duration = time.perf_counter() - dropped_at
+    storm = [t - dropped_at for t, _ in server.handshakes[before:]]
+    buckets = {}
+    for offset in storm:
+        buckets[int(offset * 10)] = buckets.get(int(offset * 10), 0) + 1
+    return {
+        'recovered': recovered,
+        'duration_s': duration,
+        'handshakes': len(storm),
+        'peak_handshakes_per_100ms': max(buckets.values()) if buckets else 0,
+    }
+
+
+def measure_pipeline(server, hostnames, depth):
+    """Медленная команда и depth быстрых одним кадром batch: (протокол 2)"""
+    batches, fast, slow, overtaken = [], [], [], 0
+    for hostname in hostnames:
+        started = time.perf_counter()
+        replies = server.pipeline(hostname, ['stats'] + ['check_dnd_status'] * depth)
+        batches.append(time.perf_counter() - started)
+        slow_rtt = replies[0][1]
+        slow.append(slow_rtt)
+        fast.extend(rtt for _, rtt in replies[1:])
+        overtaken += sum(1 for _, rtt in replies[1:] if rtt < slow_rtt)
+    return {
+        'batch': summarize(batches),
+        'fast': summarize(fast),
+        'slow': summarize(slow),
+        'fast_before_slow': overtaken / len(fast) if fast else 0.0,
+    }
+
+
+def run(args):
+    report = {'clients': args.clients, 'engine': args.engine, 'protocol': args.protocol}
+    client.RECONNECT_BASE_DELAY = args.reconnect_base_delay
+    server = MockAdminServer(broadcast_interval=args.broadcast_interval, keepalive=args.keepalive,
+                             protocol=args.protocol, notify=True).start()
+    rss_before = read_rss()
+    threads_before = threading.active_count()
+
+    with tempfile.TemporaryDirectory() as settings_dir:
+        fleet = start_fleet(args.engine, args.clients, settings_dir, server)
+        if not server.wait_ready(args.clients, args.timeout):
+            raise RuntimeError(f"Подключились только {len(server.ready_hostnames())}/{args.clients}")
+        report['connect'] = summarize(connect_times(server, fleet))
+
+        hostnames = [sim.hostname for sim, _, _ in fleet]
+        rtts = []
+        pings_before = server.pings_received()
+        for _ in range(args.rounds):
+            rtts.extend(rtt for _, rtt in server.check_all(hostnames))
+        report['pings_under_load'] = server.pings_received() - pings_before
+        report['check_dnd_status_rtt'] = summarize(rtts)
+        report['check_dnd_status_lost'] = args.rounds * args.clients - len(rtts)
+
+        display = [server.display_message(h, 'Нагрузочный тест') for h in hostnames[:args.display_sample]]
+        report['display_message_rtt'] = summarize(display)
+        # Пока уведомления открыты, команды должны обрабатываться как обычно
+        report['check_during_popup_rtt'] = summarize(
+            [rtt for _, rtt in server.check_all(hostnames[:args.display_sample])])
+        wait_for(lambda: all(any(e.startswith('message_dismissed:') for e in server.notification_events(h))
+                             for h in hostnames[:args.display_sample]), SimulatedClientMixin.popup_seconds + 5)
+        report['display_acks_with_id'] = sum(1 for h in hostnames[:args.display_sample]
+                                             for ack in server.connections[h].display_acks
+                                             if ack.startswith('message_displayed:'))
+        report['notification_events'] = statistics.mean(
+            len(server.notification_events(h)) for h in hostnames[:args.display_sample]) if args.display_sample else 0
+
+        pulled = [server.request_stats(h) for h in hostnames[:args.display_sample]]
+        report['stats_rtt'] = summarize([rtt for _, rtt in pulled])
+        report['client_metrics'] = pulled[0][0] if pulled else {}
+        if args.protocol >= 2:
+            wait_for(lambda: all(server.connections[h].protocol >= 2 for h in hostnames), args.timeout)
+            SimulatedClientMixin.slow_command_seconds = args.slow_command_ms / 1000
+            report['pipeline'] = measure_pipeline(server, hostnames[:args.display_sample], args.pipeline_depth)
+            SimulatedClientMixin.slow_command_seconds = 0
+
+        report['idle'] = measure_idle(server, args.idle, args.clients)
+        report['idle']['threads_per_client'] = (threading.active_count() - threads_before) / args.clients
+        report['idle']['rss_kb_per_client'] = (read_rss() - rss_before) / 1024 / args.clients
+
+        report['reconnect_storm'] = measure_storm(server, args.clients, args.timeout)
+        stats = [sim.get_reconnect_stats() for sim, _, _ in fleet]
+        report['reconnect_storm']['attempts'] = sum(s['attempts'] for s in stats)
+        report['reconnect_storm']['give_ups'] = sum(s['give_ups'] for s in stats)
+        report['idle_after_storm'] = {'threads_total': threading.active_count()}
+        stop_fleet(fleet)
+
+        # Перезапуск: discovery-рассылка новым клиентам не идет, работают кэш и активный запрос
+        wait_for(lambda: not server.connections, args.timeout)
+        fleet = start_fleet(args.engine, args.clients, settings_dir, server, broadcast=False)
+        if not server.wait_ready(args.clients, args.timeout):
+            raise RuntimeError(f"После перезапуска подключились только {len(server.ready_hostnames())}/{args.clients}")
+        report['restart_connect'] = summarize(connect_times(server, fleet))
+        report['queries_answered'] = server.queries_answered
+        stop_fleet(fleet)
+    server.stop()
+    return report
+
+
+def print_report(report):
+    print(f"clients={report['clients']} engine={report['engine']} protocol={report['protocol']}")
+    for key in ('connect', 'restart_connect', 'check_dnd_status_rtt', 'display_message_rtt',
+                'check_during_popup_rtt', 'stats_rtt'):
+        s = report[key]
+        print(f"  {key:22} n={s['count']:<6} p50={s['p50']:8.2f}ms p90={s['p90']:8.2f}ms "
+              f"p99={s['p99']:8.2f}ms max={s['max']:8.2f}ms")
+    if 'pipeline' in report:
+        pipeline = report['pipeline']
+        for key in ('batch', 'fast', 'slow'):
+            s = pipeline[key]
+            print(f"  pipeline_{key:13} n={s['count']:<6} p50={s['p50']:8.2f}ms p90={s['p90']:8.2f}ms "
+                  f"p99={s['p99']:8.2f}ms max={s['max']:8.2f}ms")
+        print(f"  pipeline: fast replies before the slow one: {pipeline['fast_before_slow']:.0%}")
+    print(f"  check_dnd_status lost: {report['check_dnd_status_lost']}, "
+          f"notification events per message: {report['notification_events']:.1f}, "
+          f"acks with id: {report['display_acks_with_id']}/{report['display_message_rtt']['count']}")
+    idle = report['idle']
+    print(f"  idle: cpu={idle['cpu_ms_per_client_per_s']:.3f}ms/s per client, "
+          f"rss={idle['rss_kb_per_client']:.1f}KB per client, "
+          f"threads={idle['threads_per_client']:.1f} per client, "
+          f"pings={idle['pings_per_client_per_min']:.2f}/min per client")
+    print(f"  pings under load: {report['pings_under_load']}")
+    storm = report['reconnect_storm']
+    print(f"  reconnect storm: recovered={storm['recovered']} duration={storm['duration_s']:.2f}s "
+          f"handshakes={storm['handshakes']} peak={storm['peak_handshakes_per_100ms']}/100ms "
+          f"attempts={storm['attempts']} give_ups={storm['give_ups']}")
+    print(f"  threads after storm: {report['idle_after_storm']['threads_total']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--clients', type=int, default=50)
+    parser.add_argument('--engine', choices=sorted(ENGINES), default='threads')
+    parser.add_argument('--rounds', type=int, default=20, help="раундов опроса check_dnd_status")
+    parser.add_argument('--display-sample', type=int, default=10, help="клиентов для замера display_message")
+    parser.add_argument('--popup-seconds', type=float, default=1.0, help="сколько открыто уведомление")
+    parser.add_argument('--idle', type=float, default=5.0, help="секунд простоя для замера CPU")
+    parser.add_argument('--broadcast-interval', type=float, default=1.0)
+    parser.add_argument('--keepalive', type=int, help="таймаут живости, объявляемый сервером (keepalive=)")
+    parser.add_argument('--protocol', type=int, choices=(1, 2), default=1,
+                        help="версия протокола, предлагаемая сервером")
+    parser.add_argument('--pipeline-depth', type=int, default=5, help="быстрых команд в пакете (протокол 2)")
+    parser.add_argument('--slow-command-ms', type=float, default=50.0, help="задержка медленной команды stats")
+    parser.add_argument('--reconnect-base-delay', type=float, default=client.RECONNECT_BASE_DELAY)
+    parser.add_argument('--timeout', type=float, default=60.0)
+    parser.add_argument('--json', help="записать отчет в JSON-файл")
+    args = parser.parse_args()
+
+    SimulatedClientMixin.popup_seconds = args.popup_seconds
+    report = run(args)
+    print_report(report)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,347 @@
+# microbench.py
+"""Микробенчмарки горячих путей клиента с проверкой регрессий.
+
+Покрывает чтение статуса DND из microsip.ini (UTF-16/UTF-8/cp1251, файлы
+обычного и патологического размера: без изменений, с изменением значения
+перед каждым чтением и с изменением размера файла), разбор входящих кадров (фрагментированный поток,
+побайтовый поток, много кадров в одном пакете, пакеты batch: протокола 2),
+отправку через очередь OutboundQueue по socketpair и разбор пакетов
+discovery и рукопожатия. Каждый случай повторяется несколько раз, в отчет
+идет лучшее время на операцию.
+
+Результаты пишутся в JSON (--json) и сравниваются с ранее сохраненным
+отчетом (--baseline): если случай стал медленнее больше чем на порог,
+скрипт завершается с кодом 1. Порог задается общий (--threshold 0.2) и
+для отдельных случаев по шаблону (--case-threshold 'send.*=0.5').
+
+Запуск: python benchmarks/microbench.py [--json out.json] [--baseline old.json] [--filter 'frames.*'] [--quick]
+"""
+import argparse
+import fnmatch
+import json
+import os
+import platform
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+from types import SimpleNamespace
+
+from support import import_client
+from bench_ini_reader import ENCODINGS, build_ini
+
+client = import_client()
+from protocol import encode_batch, tag_frame  # noqa: E402
+
+INI_SIZES = {
+    'typical': 3,  # учетных записей
+    'large': 2000,
+    'huge': 20000,  # ~8 МБ в UTF-8, ~16 МБ в UTF-16
+}
+CASES = {}  # имя -> функция(масштаб) -> (run, операций за запуск)
+
+
+def case(name):
+    def register(func):
+        CASES[name] = func
+        return func
+    return register
+
+
+def timed(func):
+    """Запуск, замеряющий вызов целиком"""
+    def run():
+        started = time.perf_counter()
+        func()
+        return time.perf_counter() - started
+    return run
+
+
+# --- Статус DND ---
+
+def register_ini_cases():
+    for encoding in ENCODINGS:
+        for size, accounts in INI_SIZES.items():
+            for scenario in ('unchanged', 'changed', 'resized'):
+                name = f"dnd_status.{encoding.replace('-', '')}.{size}.{scenario}"
+                CASES[name] = lambda scale, e=encoding, a=accounts, s=scenario: ini_case(e, a, s, scale)
+
+
+def ini_case(encoding, accounts, scenario, scale):
+    directory = tempfile.mkdtemp(prefix='microbench-')
+    path = os.path.join(directory, 'microsip.ini')
+    contents = [build_ini(accounts, dnd).encode(encoding) for dnd in (0, 1)]
+    if scenario == 'resized':
+        # Размер меняется - сохраненные смещения не годятся, файл разбирается целиком
+        contents[1] = (build_ini(accounts, 1) + '; resized\r\n').encode(encoding)
+    with open(path, 'wb') as f:
+        f.write(contents[0])
+    reader = client.IniReader(path)
+    reader.get('DND')
+    # Перезапись большого файла дорогая, поэтому операций меньше
+    ops = max(1, int((2000 if scenario == 'unchanged' else 200 // max(1, accounts // 100)) * scale))
+    state = {'stamp': 0}
+
+    def run():
+        elapsed = 0.0
+        for i in range(ops):
+            if scenario != 'unchanged':
+                state['stamp'] += 1
+                with open(path, 'wb') as f:
+                    f.write(contents[state['stamp'] % 2])
+                os.utime(path, ns=(state['stamp'] * 1000, state['stamp'] * 1000))
+            started = time.perf_counter()
+            value = reader.get('DND')
+            elapsed += time.perf_counter() - started
+            expected = str(state['stamp'] % 2) if scenario != 'unchanged' else '0'
+            if value != expected:
+                raise AssertionError(f"{path}: DND={value}, ожидалось {expected}")
+        return elapsed
+
+    run.cleanup = lambda: shutil.rmtree(directory, ignore_errors=True)
+    return run, ops
+
+
+# --- Разбор входящих кадров ---
+
+def command_stream(count):
+    frames = []
+    for i in range(count):
+        if i % 3 == 0:
+            frames.append("check_dnd_status")
+        elif i % 3 == 1:
+            frames.append(f"display_message:Сообщение оператору №{i}: перезвоните клиенту")
+        else:
+            frames.append("pong")
+    return frames
+
+
+def frames_case(chunk_size, count, protocol):
+    if protocol == 2:
+        commands = [tag_frame(i, command) for i, command in enumerate(command_stream(count))]
+        frames = [encode_batch(commands[i:i + 10]) for i in range(0, len(commands), 10)]
+    else:
+        frames = command_stream(count)
+    data = ''.join(frame + '\n' for frame in frames).encode('utf-8')
+    chunks = [data[i:i + chunk_size] for i in range(0, len(data), chunk_size)]
+    parser = SimpleNamespace(protocol_version=protocol)
+    split_commands = client.MicrosipClient.split_commands
+
+    def parse():
+        decoder = client.FrameDecoder()
+        parsed = 0
+        for chunk in chunks:
+            for frame in decoder.feed(chunk):
+                parsed += len(split_commands(parser, frame))
+        if parsed != count:
+            raise AssertionError(f"разобрано {parsed} команд из {count}")
+
+    return timed(parse), count
+
+
+@case('frames.fragmented')
+def frames_fragmented(scale):
+    return frames_case(7, int(5000 * scale) or 1, 1)
+
+
+@case('frames.bytewise')
+def frames_bytewise(scale):
+    return frames_case(1, int(1000 * scale) or 1, 1)
+
+
+@case('frames.batched')
+def frames_batched(scale):
+    return frames_case(client.RECV_BUFFER_SIZE, int(20000 * scale) or 1, 1)
+
+
+@case('frames.protocol2_batch')
+def frames_protocol2(scale):
+    return frames_case(client.RECV_BUFFER_SIZE, int(20000 * scale) or 10, 2)
+
+
+# --- Отправка ---
+
+@case('send.outbound_queue')
+def send_outbound_queue(scale):
+    count = int(20000 * scale) or 1
+    message = "message_shown:12345"
+    expected = len(client.encode_frame(message)) * count
+
+    def run():
+        writer, reader = socket.socketpair()
+        received = [0]
+
+        def drain():
+            while received[0] < expected:
+                data = reader.recv(65536)
+                if not data:
+                    break
+                received[0] += len(data)
+
+        drainer = threading.Thread(target=drain, daemon=True)
+        drainer.start()
+        queue = client.OutboundQueue(writer, lambda: None, maxsize=count)
+        queue.start()
+        started = time.perf_counter()
+        for _ in range(count):
+            queue.put(message)
+        drainer.join(30)
+        elapsed = time.perf_counter() - started
+        queue.close()
+        queue.join()
+        writer.close()
+        reader.close()
+        if received[0] != expected:
+            raise AssertionError(f"получено {received[0]} байт из {expected}")
+        return elapsed
+
+    return run, count
+
+
+# --- Discovery и рукопожатие ---
+
+def parse_case(func, payloads, scale):
+    count = int(100000 * scale) or 1
+    items = (payloads * (count // len(payloads) + 1))[:count]
+
+    def run():
+        for item in items:
+            func(item)
+
+    return timed(run), count
+
+
+@case('discovery.server')
+def discovery_server(scale):
+    return parse_case(client.parse_discovery_message, [b"ADMIN_SERVER_DISCOVERY:192.168.10.25:12345"], scale)
+
+
+@case('discovery.update_announcement')
+def discovery_update(scale):
+    payload = f"UPDATE_AVAILABLE:1.0.2:{'ab' * 32}:12348".encode('utf-8')
+    return parse_case(client.parse_update_announcement, [payload], scale)
+
+
+@case('discovery.foreign')
+def discovery_foreign(scale):
+    return parse_case(client.parse_discovery_message, [b"M-SEARCH * HTTP/1.1\r\n", b"\xff\xfe\x00garbage"], scale)
+
+
+@case('handshake.reply')
+def handshake_reply(scale):
+    return parse_case(client.parse_handshake_reply, ["CONNECTION_ACCEPTED keepalive=30 proto=2"], scale)
+
+
+register_ini_cases()
+
+
+# --- Запуск и сравнение ---
+
+def measure(name, scale, repeat):
+    """Лучшее время на операцию (мкс) из repeat запусков после прогрева"""
+    run, ops = CASES[name](scale)
+    try:
+        run()
+        best = min(run() for _ in range(repeat))
+    finally:
+        if hasattr(run, 'cleanup'):
+            run.cleanup()
+    return {'us_per_op': best / ops * 1e6, 'ops_per_s': ops / best if best else 0.0, 'ops': ops, 'repeat': repeat}
+
+
+def threshold_for(name, default, overrides):
+    for pattern, value in overrides:
+        if fnmatch.fnmatch(name, pattern):
+            return value
+    return default
+
+
+def compare(results, baseline, default_threshold, overrides):
+    """Строки сравнения и список регрессий"""
+    rows, regressions = [], []
+    for name, result in results.items():
+        old = baseline.get(name)
+        if not old:
+            rows.append((name, result['us_per_op'], None, None, 'new'))
+            continue
+        change = result['us_per_op'] / old['us_per_op'] - 1
+        limit = threshold_for(name, default_threshold, overrides)
+        status = 'REGRESSION' if change > limit else 'ok'
+        if status != 'ok':
+            regressions.append(name)
+        rows.append((name, result['us_per_op'], old['us_per_op'], change, status))
+    return rows, regressions
+
+
+def parse_overrides(values):
+    overrides = []
+    for value in values:
+        pattern, _, threshold = value.rpartition('=')
+        overrides.append((pattern, float(threshold)))
+    return overrides
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--filter', action='append', help="шаблон имен случаев (можно несколько)")
+    parser.add_argument('--repeat', type=int, default=5, help="запусков каждого случая")
+    parser.add_argument('--quick', action='store_true', help="меньше операций (для быстрой проверки)")
+    parser.add_argument('--json', help="записать результаты в JSON-файл")
+    parser.add_argument('--baseline', help="JSON предыдущего прогона для сравнения")
+    parser.add_argument('--threshold', type=float, default=0.2, help="допустимое замедление (0.2 = 20%%)")
+    parser.add_argument('--case-threshold', action='append', default=[], metavar='ШАБЛОН=ПОРОГ',
+                        help="свой порог для случаев по шаблону")
+    parser.add_argument('--list', action='store_true', help="показать случаи и выйти")
+    args = parser.parse_args()
+
+    names = [name for name in CASES if not args.filter or any(fnmatch.fnmatch(name, f) for f in args.filter)]
+    if args.list:
+        print('\n'.join(names))
+        return 0
+    scale = 0.1 if args.quick else 1.0
+
+    results = {}
+    for name in names:
+        results[name] = measure(name, scale, args.repeat)
+        r = results[name]
+        print(f"{name:40} {r['us_per_op']:12.3f} us/op {r['ops_per_s']:14.0f} ops/s", flush=True)
+
+    report = {
+        'schema': 1,
+        'client_version': client.VERSION,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'scale': scale,
+        'results': results,
+    }
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+
+    if not args.baseline:
+        return 0
+    with open(args.baseline, 'r', encoding='utf-8') as f:
+        baseline = json.load(f)
+    if baseline.get('scale') != scale:
+        print(f"Внимание: базовый прогон выполнен с масштабом {baseline.get('scale')}, текущий - {scale}")
+    baseline = baseline['results']
+    rows, regressions = compare(results, baseline, args.threshold, parse_overrides(args.case_threshold))
+    print(f"\n{'case':40} {'now us':>12} {'base us':>12} {'change':>8}")
+    for name, now, old, change, status in rows:
+        if old is None:
+            print(f"{name:40} {now:12.3f} {'-':>12} {'-':>8} {status}")
+        else:
+            print(f"{name:40} {now:12.3f} {old:12.3f} {change:+8.1%} {status}")
+    if regressions:
+        print(f"\nРегрессии: {len(regressions)}: {', '.join(regressions)}")
+        return 1
+    print("\nРегрессий нет")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,401 @@
+# mock_admin_server.py
+"""Локальный заменитель сервера администратора для нагрузочных тестов.
+
+Говорит на том же протоколе, что и настоящий сервер: рассылает
+ADMIN_SERVER_DISCOVERY:ip:port и отвечает им же на активный запрос
+ADMIN_SERVER_QUERY, принимает hostname и отвечает
+CONNECTION_ACCEPTED (с опцией keepalive=, если задана), отправляет
+check_dnd_status и display_message:, принимает dnd_status:, message_displayed,
+ответ stats: на команду stats и отвечает pong на ping. С protocol=2
+предлагает в рукопожатии proto=2; клиентам, подтвердившим его, команды
+уходят с идентификаторами, а pipeline() отправляет несколько команд одним
+кадром batch:. Клиентские кадры batch: (состояние после переподключения)
+разбираются так же; с history=True сервер объявляет history=zlib и
+сохраняет присланную клиентом историю переходов. С sessions=True объявляет
+sessions=1 и ведет статусы пользователей службы (session_open:, кадры
+'@identity ...'); check_session() опрашивает одного пользователя. С
+notify=True объявляет notify=1: клиент подтверждает display_message:
+кадром message_displayed:id или message_dropped:id:причина и присылает
+события message_shown:/message_dismissed:. Работает на loopback в собственном потоке с циклом asyncio,
+а наружу дает синхронный API.
+"""
+import asyncio
+import collections
+import json
+import os
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from protocol import (FrameDecoder, encode_frame, encode_batch, parse_tagged, tag_frame,  # noqa: E402
+                      split_batch, decode_history, address_frame, parse_addressed, BATCH_PREFIX,
+                      HISTORY_PREFIX)
+
+
+class QueryProtocol(asyncio.DatagramProtocol):
+    """Отвечает на ADMIN_SERVER_QUERY объявлением сервера (unicast)"""
+
+    def __init__(self, server):
+        self.server = server
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        if data.strip() == b"ADMIN_SERVER_QUERY":
+            self.server.queries_answered += 1
+            self.transport.sendto(self.server.discovery_message(), addr)
+
+
+class ClientConnection:
+    """Состояние одного подключенного клиента на стороне сервера"""
+
+    def __init__(self, hostname, writer):
+        self.hostname = hostname
+        self.writer = writer
+        self.connected_at = time.perf_counter()
+        self.first_status_at = None
+        self.last_status = None
+        self.status_waiters = collections.deque()
+        self.display_waiters = collections.deque()
+        self.stats_waiters = collections.deque()
+        self.protocol = 1  # 2 - клиент подтвердил протокол с идентификаторами
+        self.requests = {}  # id -> (время отправки, future, вид ответа)
+        self.next_request_id = 1
+        self.frames_received = 0
+        self.pings_received = 0
+        self.notification_events = []  # (время, кадр message_shown:/message_dismissed:)
+        self.display_acks = []  # ответы на display_message: message_displayed[:id] / message_dropped:id:причина
+        self.status_frames = 0  # Кадров dnd_status: за соединение
+        self.history = []  # [время, сообщение] из кадров history:
+        self.sessions = {}  # identity -> последний статус DND пользователя службы
+        self.session_updates = []  # (время, identity, статус)
+        self.session_waiters = collections.defaultdict(collections.deque)  # identity -> (время, future)
+
+
+class MockAdminServer:
+    def __init__(self, host='127.0.0.1', port=0, broadcast_interval=1.0, keepalive=None, answer_pings=True,
+                 protocol=1, history=False, sessions=False, notify=False):
+        self.host = host
+        self.port = port
+        self.broadcast_interval = broadcast_interval
+        self.keepalive = keepalive  # таймаут живости, объявляемый клиентам в рукопожатии
+        self.answer_pings = answer_pings
+        self.protocol = protocol  # версия протокола, предлагаемая клиентам
+        self.history = history  # принимать историю переходов (history=zlib)
+        self.multiplexing = sessions  # принимать сессии пользователей (sessions=1)
+        self.notify = notify  # принимать id и события уведомлений (notify=1)
+        self.discovery_targets = set()  # порты discovery клиентов на loopback
+        self.connections = {}  # hostname -> ClientConnection
+        self.handshakes = []  # (время, hostname) каждого принятого рукопожатия
+        self.queries_answered = 0
+        self.query_port = None
+        self.loop = None
+        self.server = None
+        self.thread = None
+        self.accepting = True
+        self._ready = threading.Event()
+
+    # --- Управление жизненным циклом ---
+
+    def start(self):
+        self.thread = threading.Thread(target=self._thread_main, daemon=True)
+        self.thread.start()
+        self._ready.wait(5)
+        return self
+
+    def stop(self):
+        if self.loop:
+            self.call(self._shutdown())
+            self.loop.call_soon_threadsafe(self.loop.stop)
+        if self.thread:
+            self.thread.join(5)
+
+    def call(self, coroutine, timeout=None):
+        """Выполняет корутину в цикле сервера и возвращает результат"""
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result(timeout)
+
+    def _thread_main(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_until_complete(self._startup())
+        self._ready.set()
+        self.loop.run_forever()
+        self.loop.close()
+
+    async def _startup(self):
+        self.server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        self.udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.udp.setblocking(False)
+        self.query_transport, _ = await self.loop.create_datagram_endpoint(
+            lambda: QueryProtocol(self), local_addr=(self.host, 0))
+        self.query_port = self.query_transport.get_extra_info('sockname')[1]
+        self.broadcast_task = asyncio.ensure_future(self._broadcast_loop())
+
+    async def _shutdown(self):
+        self.broadcast_task.cancel()
+        self.server.close()
+        await self._drop_all()
+        self.udp.close()
+        self.query_transport.close()
+
+    # --- Discovery ---
+
+    @property
+    def address(self):
+        return self.host, self.port
+
+    @property
+    def query_address(self):
+        return self.host, self.query_port
+
+    def discovery_message(self):
+        return f"ADMIN_SERVER_DISCOVERY:{self.host}:{self.port}".encode('utf-8')
+
+    def add_discovery_target(self, port):
+        self.loop.call_soon_threadsafe(self.discovery_targets.add, port)
+
+    async def _broadcast_loop(self):
+        while True:
+            self.broadcast_now()
+            await asyncio.sleep(self.broadcast_interval)
+
+    def broadcast_now(self):
+        message = self.discovery_message()
+        for port in list(self.discovery_targets):
+            try:
+                self.udp.sendto(message, ('127.0.0.1', port))
+            except OSError:
+                pass
+
+    # --- TCP ---
+
+    async def _handle(self, reader, writer):
+        if not self.accepting:
+            writer.close()
+            return
+        decoder = FrameDecoder()
+        connection = None
+        try:
+            while True:
+                data = await reader.read(16384)
+                if not data:
+                    break
+                for frame in decoder.feed(data):
+                    frame = frame.strip()
+                    if connection is None:
+                        connection = ClientConnection(frame, writer)
+                        old = self.connections.get(frame)
+                        if old and old.writer is not writer:
+                            old.writer.close()
+                        self.connections[frame] = connection
+                        self.handshakes.append((connection.connected_at, frame))
+                        reply = "CONNECTION_ACCEPTED"
+                        if self.keepalive:
+                            reply += f" keepalive={self.keepalive}"
+                        if self.protocol >= 2:
+                            reply += f" proto={self.protocol}"
+                        if self.history:
+                            reply += " history=zlib"
+                        if self.multiplexing:
+                            reply += " sessions=1"
+                        if self.notify:
+                            reply += " notify=1"
+                        writer.write(encode_frame(reply))
+                        continue
+                    connection.frames_received += 1
+                    self._on_frame(connection, frame)
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            if connection and self.connections.get(connection.hostname) is connection:
+                del self.connections[connection.hostname]
+            for waiters in (connection.status_waiters, connection.display_waiters,
+                            connection.stats_waiters) if connection else ():
+                while waiters:
+                    waiters.popleft()[1].cancel()
+            for _, future, _ in connection.requests.values() if connection else ():
+                future.cancel()
+            for waiters in connection.session_waiters.values() if connection else ():
+                while waiters:
+                    waiters.popleft()[1].cancel()
+            writer.close()
+
+    def _on_frame(self, connection, frame):
+        now = time.perf_counter()
+        if frame.startswith(BATCH_PREFIX):
+            for item in split_batch(frame):
+                self._on_frame(connection, item)
+        elif frame.startswith(HISTORY_PREFIX):
+            connection.history.extend(decode_history(frame))
+        elif frame.startswith("#"):
+            request_id, payload = parse_tagged(frame)
+            if payload.startswith("@"):
+                self._on_session_frame(connection, payload, now)
+            request = connection.requests.pop(request_id, None)
+            if request and not request[1].done():
+                sent_at, future, kind = request
+                future.set_result(self._result(connection, kind, payload, sent_at, now))
+        elif frame.startswith("@"):
+            identity = self._on_session_frame(connection, frame, now)
+            waiters = connection.session_waiters.get(identity)
+            if waiters:
+                sent_at, future = waiters.popleft()
+                if not future.done():
+                    future.set_result((connection.sessions.get(identity), now - sent_at))
+        elif frame.startswith("session_open:"):
+            connection.sessions.setdefault(frame.split(':', 1)[1], None)
+        elif frame.startswith("session_close:"):
+            connection.sessions.pop(frame.split(':', 1)[1], None)
+        elif frame.startswith("proto:"):
+            connection.protocol = int(frame.split(':', 1)[1])
+        elif frame == "ping":
+            connection.pings_received += 1
+            if self.answer_pings:
+                connection.writer.write(encode_frame("pong"))
+        elif frame.startswith(("dnd_status:", "stats:", "message_displayed", "message_dropped:")):
+            # В протоколе 2 очереди ожидания пусты: кадр без тега - статус по инициативе клиента
+            kind = {'d': 'status_waiters', 's': 'stats_waiters', 'm': 'display_waiters'}[frame[0]]
+            waiters = getattr(connection, kind)
+            sent_at, future = waiters.popleft() if waiters else (now, None)
+            result = self._result(connection, kind, frame, sent_at, now)
+            if future and not future.done():
+                future.set_result(result)
+        elif frame.startswith("message_"):
+            connection.notification_events.append((now, frame))
+
+    def _on_session_frame(self, connection, frame, now):
+        """Кадр '@identity ...' от службы; возвращает identity"""
+        identity, payload = parse_addressed(frame)
+        if payload.startswith("dnd_status:"):
+            status = payload.split(':', 1)[1]
+            connection.sessions[identity] = status
+            connection.session_updates.append((now, identity, status))
+        return identity
+
+    def _result(self, connection, kind, payload, sent_at, now):
+        """Результат запроса по ответу клиента (в том же виде для протоколов 1 и 2)"""
+        rtt = now - sent_at
+        if payload.startswith("dnd_status:"):
+            connection.status_frames += 1
+            connection.last_status = payload.split(':', 1)[1]
+            if connection.first_status_at is None:
+                connection.first_status_at = now
+            if kind == 'status_waiters':
+                return connection.last_status, rtt
+        if kind == 'stats_waiters' and payload.startswith("stats:"):
+            return json.loads(payload[len("stats:"):]), rtt
+        if payload.startswith(("message_displayed", "message_dropped:")):
+            connection.display_acks.append(payload)
+        if kind == 'display_waiters':
+            return rtt
+        return payload, rtt
+
+    def _tag(self, connection, command, kind, future):
+        request_id = str(connection.next_request_id)
+        connection.next_request_id += 1
+        connection.requests[request_id] = (time.perf_counter(), future, kind)
+        return tag_frame(request_id, command)
+
+    async def _request(self, hostname, command, waiters_name, timeout):
+        connection = self.connections[hostname]
+        future = self.loop.create_future()
+        if connection.protocol >= 2:
+            command = self._tag(connection, command, waiters_name, future)
+        else:
+            getattr(connection, waiters_name).append((time.perf_counter(), future))
+        connection.writer.write(encode_frame(command))
+        return await asyncio.wait_for(future, timeout)
+
+    async def _session_request(self, hostname, identity, command, timeout):
+        connection = self.connections[hostname]
+        future = self.loop.create_future()
+        command = address_frame(identity, command)
+        if connection.protocol >= 2:
+            connection.writer.write(encode_frame(self._tag(connection, command, 'raw', future)))
+            payload, rtt = await asyncio.wait_for(future, timeout)
+            return parse_addressed(payload)[1].split(':', 1)[-1], rtt
+        connection.session_waiters[identity].append((time.perf_counter(), future))
+        connection.writer.write(encode_frame(command))
+        return await asyncio.wait_for(future, timeout)
+
+    async def _pipeline(self, hostname, commands, timeout):
+        connection = self.connections[hostname]
+        if connection.protocol < 2:
+            raise RuntimeError(f"{hostname}: клиент не согласовал протокол 2")
+        futures = [self.loop.create_future() for _ in commands]
+        batch = [self._tag(connection, command, 'raw', future) for command, future in zip(commands, futures)]
+        connection.writer.write(encode_frame(encode_batch(batch)))
+        return await asyncio.wait_for(asyncio.gather(*futures), timeout)
+
+    async def _check_all(self, hostnames, timeout):
+        results = await asyncio.gather(
+            *(self._request(h, "check_dnd_status", 'status_waiters', timeout) for h in hostnames),
+            return_exceptions=True
+        )
+        return [r for r in results if not isinstance(r, BaseException)]
+
+    async def _drop_all(self):
+        for connection in list(self.connections.values()):
+            connection.writer.close()
+        self.connections.clear()
+
+    # --- Синхронный API ---
+
+    def check_dnd_status(self, hostname, timeout=5.0):
+        """Отправляет check_dnd_status, возвращает (статус, RTT в секундах)"""
+        return self.call(self._request(hostname, "check_dnd_status", 'status_waiters', timeout))
+
+    def check_all(self, hostnames, timeout=5.0):
+        """Одновременно опрашивает всех клиентов, возвращает список (статус, RTT)"""
+        return self.call(self._check_all(list(hostnames), timeout))
+
+    def display_message(self, hostname, text, timeout=5.0):
+        """Отправляет display_message:, возвращает RTT подтверждения"""
+        return self.call(self._request(hostname, f"display_message:{text}", 'display_waiters', timeout))
+
+    def request_stats(self, hostname, timeout=5.0):
+        """Запрашивает метрики клиента командой stats, возвращает (словарь, RTT)"""
+        return self.call(self._request(hostname, "stats", 'stats_waiters', timeout))
+
+    def pipeline(self, hostname, commands, timeout=5.0):
+        """Отправляет команды одним кадром batch: (протокол 2), возвращает [(ответ, RTT)] в порядке команд"""
+        return self.call(self._pipeline(hostname, list(commands), timeout))
+
+    def check_session(self, hostname, identity, timeout=5.0):
+        """check_dnd_status для пользователя службы, возвращает (статус, RTT)"""
+        return self.call(self._session_request(hostname, identity, "check_dnd_status", timeout))
+
+    def sessions(self, hostname):
+        """Статусы пользователей службы: identity -> статус"""
+        return dict(self.connections[hostname].sessions)
+
+    def drop_all(self):
+        """Разрывает все соединения (имитация перезапуска сервера)"""
+        self.call(self._drop_all())
+
+    def pings_received(self):
+        """Сколько ping получено от подключенных сейчас клиентов"""
+        return sum(c.pings_received for c in list(self.connections.values()))
+
+    def notification_events(self, hostname):
+        """События уведомлений, полученные от клиента"""
+        return [frame for _, frame in self.connections[hostname].notification_events]
+
+    def ready_hostnames(self):
+        """Клиенты, которые подключены и уже прислали статус DND"""
+        return [h for h, c in list(self.connections.items()) if c.first_status_at is not None]
+
+    def wait_ready(self, count, timeout):
+        """Ждет, пока count клиентов подключатся и пришлют статус"""
+        deadline = time.perf_counter() + timeout
+        while time.perf_counter() < deadline:
+            if len(self.ready_hostnames()) >= count:
+                return True
+            time.sleep(0.01)
+        return False
@@ -0,0 +1,117 @@
+# mock_release_server.py
+"""Локальный заменитель API релизов GitHub для проверки обновлений.
+
+Отдает /releases/latest с ETag и отвечает 304 на If-None-Match, а файл
+обновления - с поддержкой Range (206/416). Может оборвать загрузку после
+заданного числа байт и подменить контрольную сумму, чтобы проверить
+докачку и отказ от поврежденного файла.
+"""
+import hashlib
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class ReleaseHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server.owner
+        server.requests.append((self.path, dict(self.headers)))
+        if self.path == '/releases/latest':
+            self._release(server)
+        elif self.path == '/download/update.exe':
+            self._download(server)
+        else:
+            self._send(404, b'')
+
+    def _send(self, code, body, headers=()):
+        self.send_response(code)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _release(self, server):
+        etag = server.etag()
+        if self.headers.get('If-None-Match') == etag:
+            server.not_modified += 1
+            self._send(304, b'', [('ETag', etag)])
+            return
+        body = json.dumps(server.release()).encode('utf-8')
+        self._send(200, body, [('ETag', etag), ('Content-Type', 'application/json')])
+
+    def _download(self, server):
+        payload = server.payload
+        start = 0
+        range_header = self.headers.get('Range', '')
+        if range_header.startswith('bytes='):
+            start = int(range_header[6:].split('-')[0])
+            if start >= len(payload):
+                self._send(416, b'', [('Content-Range', f'bytes */{len(payload)}')])
+                return
+        body = payload[start:]
+        self.send_response(206 if start else 200)
+        if start:
+            self.send_header('Content-Range', f'bytes {start}-{len(payload) - 1}/{len(payload)}')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.end_headers()
+        cut = server.cut_after
+        if cut is not None:
+            # Имитация обрыва: отдаем часть и закрываем соединение
+            server.cut_after = None
+            self.wfile.write(body[:cut])
+            self.wfile.flush()
+            self.close_connection = True
+            return
+        self.wfile.write(body)
+        server.bytes_sent += len(body)
+
+
+class MockReleaseServer:
+    def __init__(self, tag='v9.9.9', size=4 * 1024 * 1024, host='127.0.0.1'):
+        self.tag = tag
+        self.payload = bytes(range(256)) * (size // 256)
+        self.digest = hashlib.sha256(self.payload).hexdigest()
+        self.cut_after = None  # оборвать следующую загрузку после стольких байт
+        self.requests = []
+        self.not_modified = 0
+        self.bytes_sent = 0
+        self.httpd = ThreadingHTTPServer((host, 0), ReleaseHandler)
+        self.httpd.owner = self
+        self.thread = None
+
+    @property
+    def api_url(self):
+        host, port = self.httpd.server_address[:2]
+        return f'http://{host}:{port}/releases/latest'
+
+    def etag(self):
+        return f'"{self.tag}-{self.digest[:16]}"'
+
+    def release(self):
+        host, port = self.httpd.server_address[:2]
+        return {
+            'tag_name': self.tag,
+            'assets': [{
+                'id': 1,
+                'name': 'update.exe',
+                'size': len(self.payload),
+                'digest': f'sha256:{self.digest}',
+                'browser_download_url': f'http://{host}:{port}/download/update.exe',
+            }],
+        }
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
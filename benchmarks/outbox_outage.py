@@ -0,0 +1,151 @@
+# outbox_outage.py
+"""Разрыв связи с сервером: offline outbox против прежнего поведения.
+
+Сервер перестает принимать подключения и разрывает все соединения. Пока
+связи нет, у каждого клиента несколько раз переключается DND в
+microsip.ini и закрываются уведомления. Затем сервер снова принимает
+подключения, и замеряется: сколько кадров клиент прислал в первые
+мгновения после рукопожатия, совпадает ли итоговое состояние на сервере с
+реальным, дошли ли события уведомлений и сколько переходов сервер получил
+в истории (history=zlib). Базовая линия - тот же сценарий с отключенным
+outbox (изменения без связи теряются, как раньше).
+
+Бенчмарк завершается с кодом 1, если с outbox клиенты не переподключились,
+итоговое состояние на сервере хоть у одного клиента неверно или дошли не
+все события уведомлений.
+
+Запуск: python benchmarks/outbox_outage.py [--clients 20] [--engine threads|asyncio] [--toggles 20] [--protocol 2]
+"""
+import argparse
+import json
+import sys
+import tempfile
+import time
+
+from support import summarize, write_dnd
+from mock_admin_server import MockAdminServer
+from fleet_sim import ENGINES, client, start_fleet, stop_fleet, wait_for
+
+
+def run(args, outbox):
+    client.RECONNECT_BASE_DELAY = args.reconnect_base_delay
+    server = MockAdminServer(broadcast_interval=args.broadcast_interval, protocol=args.protocol,
+                             history=args.history, notify=True).start()
+    report = {'outbox': outbox, 'clients': args.clients, 'engine': args.engine,
+              'protocol': args.protocol, 'toggles': args.toggles}
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        fleet = start_fleet(args.engine, args.clients, work_dir, server)
+        sims = [sim for sim, _, _ in fleet]
+        if not outbox:
+            for sim in sims:
+                sim.outbox.record = lambda message, at=None: False
+        if not server.wait_ready(args.clients, args.timeout):
+            raise RuntimeError("Клиенты не подключились к серверу")
+
+        # Разрыв: сервер не принимает подключения
+        server.accepting = False
+        server.drop_all()
+        if not wait_for(lambda: not any(sim.connected for sim in sims), args.timeout):
+            raise RuntimeError("Клиенты не заметили разрыв")
+
+        expected = {}
+        for step in range(args.toggles):
+            for i, sim in enumerate(sims):
+                expected[sim.hostname] = str((i + step + 1) % 2)
+                write_dnd(sim.get_settings_path(), expected[sim.hostname])
+            time.sleep(args.toggle_interval)
+        for sim in sims:
+            for notification_id in range(args.notifications):
+                sim.on_notification_event('dismissed', f'{sim.hostname}-{notification_id}')
+        time.sleep(0.2)  # Последнее изменение должно пройти debounce наблюдателя
+        report['outbox_stats'] = sims[0].outbox.stats()
+
+        # Связь восстановлена
+        restored_at = time.perf_counter()
+        server.accepting = True
+        server.broadcast_now()
+        recovered = wait_for(lambda: all(sim.hostname in server.connections and
+                                         server.connections[sim.hostname].first_status_at is not None
+                                         for sim in sims), args.timeout)
+        report['recovered'] = recovered
+        time.sleep(args.settle)
+        connections = [server.connections.get(sim.hostname) for sim in sims]
+        connections = [c for c in connections if c]
+        report['reconnect'] = summarize([c.first_status_at - restored_at for c in connections])
+        report['frames_after_handshake'] = summarize([c.frames_received for c in connections], scale=1.0)
+        report['status_frames'] = sum(c.status_frames for c in connections)
+        report['state_correct'] = sum(1 for c in connections if c.last_status == expected[c.hostname])
+        report['notification_events'] = sum(len(c.notification_events) for c in connections)
+        report['notification_events_expected'] = args.clients * args.notifications
+        report['history_entries'] = sum(len(c.history) for c in connections)
+        stop_fleet(fleet)
+    server.stop()
+    return report
+
+
+def print_report(report):
+    mode = 'outbox' if report['outbox'] else 'baseline'
+    print(f"{mode}: clients={report['clients']} engine={report['engine']} protocol={report['protocol']} "
+          f"toggles={report['toggles']}")
+    if not report['recovered']:
+        print("  клиенты не переподключились за отведенное время")
+    reconnect = report['reconnect']
+    frames = report['frames_after_handshake']
+    print(f"  reconnect p50={reconnect['p50']:8.1f}ms max={reconnect['max']:8.1f}ms")
+    print(f"  frames after handshake p50={frames['p50']:.0f} max={frames['max']:.0f} "
+          f"(dnd_status total {report['status_frames']})")
+    print(f"  final state correct: {report['state_correct']}/{report['clients']}")
+    print(f"  notification events: {report['notification_events']}/{report['notification_events_expected']}")
+    print(f"  history entries received: {report['history_entries']}")
+    print(f"  outbox (first client): {report['outbox_stats']}")
+
+
+def violations(report):
+    """С outbox после разрыва ничего не должно теряться (базовая линия не проверяется)"""
+    if not report['outbox']:
+        return []
+    problems = []
+    if not report['recovered']:
+        problems.append("клиенты не переподключились")
+    if report['state_correct'] != report['clients']:
+        problems.append(f"итоговое состояние верно у {report['state_correct']}/{report['clients']} клиентов")
+    if report['notification_events'] != report['notification_events_expected']:
+        problems.append(f"событий уведомлений {report['notification_events']}, "
+                        f"ожидалось {report['notification_events_expected']}")
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--clients', type=int, default=20)
+    parser.add_argument('--engine', choices=sorted(ENGINES), default='threads')
+    parser.add_argument('--protocol', type=int, choices=(1, 2), default=2)
+    parser.add_argument('--no-history', dest='history', action='store_false',
+                        help="сервер не принимает историю переходов")
+    parser.add_argument('--toggles', type=int, default=20, help="переключений DND за время разрыва")
+    parser.add_argument('--toggle-interval', type=float, default=0.1)
+    parser.add_argument('--notifications', type=int, default=3, help="закрытых уведомлений за время разрыва")
+    parser.add_argument('--broadcast-interval', type=float, default=0.5)
+    parser.add_argument('--reconnect-base-delay', type=float, default=0.2)
+    parser.add_argument('--settle', type=float, default=0.5, help="сколько ждать кадров после переподключения")
+    parser.add_argument('--timeout', type=float, default=30.0)
+    parser.add_argument('--json', help="записать отчет в JSON-файл")
+    args = parser.parse_args()
+
+    reports = [run(args, outbox=False), run(args, outbox=True)]
+    problems = []
+    for report in reports:
+        print_report(report)
+        report['violations'] = violations(report)
+        problems += report['violations']
+    for problem in problems:
+        print(f"  НАРУШЕНИЕ: {problem}")
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(reports, f, indent=2, ensure_ascii=False)
+    return 1 if problems else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,199 @@
+# service_mode.py
+"""Терминальный сервер: процесс на каждого пользователя против одной службы.
+
+Сценарий "по процессу на пользователя" запускает N клиентов, у каждого свой
+microsip.ini, сокеты, потоки и соединение с сервером. Сценарий "служба"
+запускает один клиент в режиме службы (MICROSIP_SERVICE) с шаблоном
+профилей Users/*/MicroSIP/microsip.ini: статусы всех пользователей идут
+через одно соединение кадрами '@user@host ...'. Для обоих сценариев
+замеряются потоки, открытые дескрипторы, RSS и CPU в простое в пересчете на
+пользователя, задержка доставки изменения DND на сервер и ответы на
+адресные check_dnd_status. Клиенты работают в одном процессе, поэтому
+память интерпретатора на процесс в сценарий "по процессу" не входит - в
+реальности разница больше.
+
+Бенчмарк завершается с кодом 1, если в каком-либо сценарии изменение DND
+не дошло до сервера или check_dnd_status вернул неверный статус, а также
+если служба открыла больше одного соединения.
+
+Запуск: python benchmarks/service_mode.py [--users 50] [--engine threads|asyncio] [--protocol 2]
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+
+from support import open_fds, read_rss, summarize, write_dnd
+from mock_admin_server import MockAdminServer
+from fleet_sim import ENGINES, client, start_fleet, stop_fleet, wait_for
+
+
+class Baseline:
+    """Снимок потоков, дескрипторов и памяти до запуска клиентов"""
+
+    def __init__(self):
+        self.threads = threading.active_count()
+        self.fds = open_fds()
+        self.rss = read_rss()
+
+    def per_user(self, users):
+        fds = open_fds()
+        return {
+            'threads_per_user': (threading.active_count() - self.threads) / users,
+            'fds_per_user': (fds - self.fds) / users if fds is not None and self.fds is not None else None,
+            'rss_kb_per_user': (read_rss() - self.rss) / users / 1024,
+        }
+
+
+def measure_idle(seconds, users):
+    cpu_before = time.process_time()
+    time.sleep(seconds)
+    return (time.process_time() - cpu_before) / seconds / users * 1000
+
+
+def measure_propagation(paths, current, observed, timeout):
+    """Меняет DND у каждого пользователя по очереди; задержки до появления на сервере"""
+    delays = []
+    for key, path in paths.items():
+        current[key] = str(1 - int(current[key]))
+        changed_at = time.perf_counter()
+        write_dnd(path, current[key])
+        if wait_for(lambda: observed(key) == current[key], timeout):
+            delays.append(time.perf_counter() - changed_at)
+    return delays
+
+
+def run_per_user(args, work_dir):
+    server = MockAdminServer(broadcast_interval=args.broadcast_interval, protocol=args.protocol).start()
+    baseline = Baseline()
+    fleet = start_fleet(args.engine, args.users, work_dir, server)
+    if not server.wait_ready(args.users, args.timeout):
+        raise RuntimeError("Клиенты не подключились к серверу")
+    report = {'mode': 'per-user', 'users': args.users, 'connections': len(server.connections)}
+    report.update(baseline.per_user(args.users))
+    report['idle_cpu_ms_per_user_per_s'] = measure_idle(args.idle_seconds, args.users)
+    sample = fleet[:args.sample]
+    paths = {sim.hostname: sim.get_settings_path() for sim, _, _ in sample}
+    current = {sim.hostname: server.connections[sim.hostname].last_status for sim, _, _ in sample}
+    delays = measure_propagation(paths, current, lambda h: server.connections[h].last_status, args.timeout)
+    report['propagation'] = summarize(delays)
+    report['propagated'] = len(delays)
+    report['sampled'] = len(paths)
+    checks = [server.check_dnd_status(h) for h in paths]
+    report['check_rtt'] = summarize([rtt for _, rtt in checks])
+    report['check_correct'] = sum(1 for h, (status, _) in zip(paths, checks) if status == current[h])
+    stop_fleet(fleet)
+    server.stop()
+    return report
+
+
+def run_service(args, work_dir):
+    server = MockAdminServer(broadcast_interval=args.broadcast_interval, protocol=args.protocol,
+                             sessions=True).start()
+    paths = {}
+    for i in range(args.users):
+        path = os.path.join(work_dir, 'Users', f'user{i}', 'MicroSIP', 'microsip.ini')
+        os.makedirs(os.path.dirname(path))
+        write_dnd(path, i % 2)
+        paths[f'user{i}'] = path
+    client.SERVICE_MODE = True
+    client.SERVICE_PROFILES = os.path.join(work_dir, 'Users', '*', 'MicroSIP', 'microsip.ini')
+    client.SERVICE_POLL_INTERVAL = args.poll_interval
+    host_ini = os.path.join(work_dir, 'host.ini')
+    write_dnd(host_ini, 0)
+
+    baseline = Baseline()
+    sim = ENGINES[args.engine]('service-host', host_ini, server.query_address,
+                               os.path.join(work_dir, 'service.server.json'))
+    thread = threading.Thread(target=sim.run, daemon=True)
+    thread.start()
+    fleet = [(sim, thread, time.perf_counter())]
+    identities = {user: sim.sessions.identity(user) for user in paths}
+    ready = wait_for(lambda: sim.hostname in server.connections and
+                     all(server.connections[sim.hostname].sessions.get(i) is not None
+                         for i in identities.values()), args.timeout)
+    if not ready:
+        raise RuntimeError("Служба не передала статусы пользователей")
+    connection = server.connections[sim.hostname]
+    report = {'mode': 'service', 'users': args.users, 'connections': len(server.connections),
+              'poll_interval_s': args.poll_interval}
+    report.update(baseline.per_user(args.users))
+    report['idle_cpu_ms_per_user_per_s'] = measure_idle(args.idle_seconds, args.users)
+    sample = {identities[user]: paths[user] for user in list(paths)[:args.sample]}
+    current = {identity: connection.sessions[identity] for identity in sample}
+    delays = measure_propagation(sample, current, lambda i: connection.sessions.get(i), args.timeout)
+    report['propagation'] = summarize(delays)
+    report['propagated'] = len(delays)
+    report['sampled'] = len(sample)
+    checks = [server.check_session(sim.hostname, identity) for identity in sample]
+    report['check_rtt'] = summarize([rtt for _, rtt in checks])
+    report['check_correct'] = sum(1 for i, (status, _) in zip(sample, checks) if status == current[i])
+    report['registry'] = sim.sessions.stats()
+    stop_fleet(fleet)
+    server.stop()
+    client.SERVICE_MODE = False
+    return report
+
+
+def print_report(report):
+    print(f"{report['mode']}: users={report['users']} connections={report['connections']}")
+    fds = report['fds_per_user']
+    print(f"  per user: threads={report['threads_per_user']:.2f} "
+          f"fds={'-' if fds is None else f'{fds:.2f}'} rss={report['rss_kb_per_user']:.1f}KB "
+          f"idle cpu={report['idle_cpu_ms_per_user_per_s']:.4f}ms/s")
+    p = report['propagation']
+    print(f"  dnd change -> server: p50={p['p50']:.1f}ms max={p['max']:.1f}ms ({report['propagated']} changes)")
+    c = report['check_rtt']
+    print(f"  check_dnd_status: p50={c['p50']:.2f}ms correct={report['check_correct']}/{c['count']}")
+    if 'registry' in report:
+        print(f"  registry: {report['registry']}")
+
+
+def violations(report):
+    """Изменения DND и ответы на check_dnd_status не должны теряться ни в одном сценарии"""
+    problems = []
+    mode = report['mode']
+    if report['propagated'] != report['sampled']:
+        problems.append(f"{mode}: до сервера дошло изменений {report['propagated']}/{report['sampled']}")
+    if report['check_correct'] != report['check_rtt']['count']:
+        problems.append(f"{mode}: check_dnd_status верен для {report['check_correct']}/{report['check_rtt']['count']}")
+    if mode == 'service' and report['connections'] != 1:
+        problems.append(f"{mode}: соединений с сервером {report['connections']}, ожидалось одно")
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--engine', choices=sorted(ENGINES), default='threads')
+    parser.add_argument('--protocol', type=int, choices=(1, 2), default=2)
+    parser.add_argument('--poll-interval', type=float, default=client.SERVICE_POLL_INTERVAL)
+    parser.add_argument('--idle-seconds', type=float, default=3.0)
+    parser.add_argument('--sample', type=int, default=10, help="пользователей для замера задержки")
+    parser.add_argument('--broadcast-interval', type=float, default=0.5)
+    parser.add_argument('--timeout', type=float, default=30.0)
+    parser.add_argument('--json', help="записать отчет в JSON-файл")
+    args = parser.parse_args()
+
+    reports = []
+    for run in (run_per_user, run_service):
+        with tempfile.TemporaryDirectory() as work_dir:
+            reports.append(run(args, work_dir))
+    problems = []
+    for report in reports:
+        print_report(report)
+        report['violations'] = violations(report)
+        problems += report['violations']
+    for problem in problems:
+        print(f"  НАРУШЕНИЕ: {problem}")
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(reports, f, indent=2, ensure_ascii=False)
+    return 1 if problems else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
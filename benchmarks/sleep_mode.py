@@ -0,0 +1,146 @@
+# sleep_mode.py
+"""Режим сна: клиент без запущенного MicroSIP против бодрствующего клиента.
+
+Вместо MicroSIP запускается заглушка - копия sleep под именем
+microsip.exe (в /proc/PID/comm она видна так же, как процесс под Wine).
+Клиент с MICROSIP_SLEEP стартует без заглушки и спит; замеряются потоки,
+дескрипторы, RSS, CPU потоков клиента и пробуждения (добровольные
+переключения контекста потоков клиента) в секунду. Затем заглушка запускается - замеряется время
+до подключения к серверу и те же показатели в бодрствовании; после
+остановки заглушки - время до засыпания и показатели снова. Потоки
+локального сервера и самого бенчмарка в подсчет CPU и пробуждений не входят.
+
+Бенчмарк завершается с кодом 1, если во сне клиент тратит больше CPU или
+просыпается чаще, чем в бодрствовании.
+
+Запуск: python benchmarks/sleep_mode.py [--engine threads|asyncio] [--seconds 5]
+"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from support import open_fds, read_rss, task_switches, thread_cpu
+from mock_admin_server import MockAdminServer
+from fleet_sim import ENGINES, client, wait_for
+
+
+def measure(seconds, exclude, baseline_threads, baseline_fds):
+    switches = task_switches(exclude)
+    cpu = thread_cpu(exclude)
+    time.sleep(seconds)
+    return {
+        'threads': threading.active_count() - baseline_threads,
+        'fds': open_fds() - baseline_fds,
+        'rss_kb': read_rss() / 1024,
+        'cpu_ms_per_s': (thread_cpu(exclude) - cpu) / seconds * 1000,
+        'wakeups_per_s': (task_switches(exclude) - switches) / seconds,
+    }
+
+
+def start_stand_in(work_dir):
+    """Процесс с именем microsip.exe (копия sleep)"""
+    path = os.path.join(work_dir, client.MICROSIP_PROCESS)
+    if not os.path.exists(path):
+        shutil.copy(shutil.which('sleep'), path)
+    return subprocess.Popen([path, '3600'])
+
+
+def run(args):
+    client.SLEEP_MODE = True
+    server = MockAdminServer(broadcast_interval=args.broadcast_interval).start()
+    exclude = {threading.main_thread().native_id, server.thread.native_id}
+    report = {'engine': args.engine}
+    with tempfile.TemporaryDirectory() as work_dir:
+        path = os.path.join(work_dir, 'microsip.ini')
+        with open(path, 'w', encoding='utf-16') as f:
+            f.write('[Settings]\r\nDND=0\r\n')
+        baseline_threads, baseline_fds = threading.active_count(), open_fds()
+        sim = ENGINES[args.engine]('sleepy', path, server.query_address, os.path.join(work_dir, 'server.json'))
+        thread = threading.Thread(target=sim.run, daemon=True)
+        thread.start()
+        baseline_threads += 1  # Поток sim.run - это "процесс" клиента
+        time.sleep(1)
+        report['dormant'] = measure(args.seconds, exclude, baseline_threads, baseline_fds)
+        report['dormant']['connected'] = 'sleepy' in server.connections
+
+        stand_in = start_stand_in(work_dir)
+        started = time.perf_counter()
+        try:
+            if not wait_for(lambda: 'sleepy' in server.connections and
+                            server.connections['sleepy'].first_status_at is not None, args.timeout):
+                raise RuntimeError("Клиент не проснулся")
+            report['wake_to_connected_ms'] = (time.perf_counter() - started) * 1000
+            time.sleep(1)
+            report['awake'] = measure(args.seconds, exclude, baseline_threads, baseline_fds)
+        finally:
+            stand_in.kill()
+            stand_in.wait()
+        stopped = time.perf_counter()
+        if not wait_for(lambda: not sim.active and 'sleepy' not in server.connections, args.timeout):
+            raise RuntimeError("Клиент не уснул")
+        report['sleep_after_exit_ms'] = (time.perf_counter() - stopped) * 1000
+        time.sleep(1)
+        report['dormant_again'] = measure(args.seconds, exclude, baseline_threads, baseline_fds)
+        report['wakeups'] = sim.wakeups
+        report['detector'] = sim.process_detector.stats()
+        sim.stop()
+        thread.join(5)
+    server.stop()
+    client.SLEEP_MODE = False
+    return report
+
+
+def print_report(report):
+    print(f"engine={report['engine']}")
+    for phase in ('dormant', 'awake', 'dormant_again'):
+        r = report[phase]
+        print(f"  {phase:14} threads={r['threads']:3d} fds={r['fds']:3d} rss={r['rss_kb']:9.0f}KB "
+              f"cpu={r['cpu_ms_per_s']:7.3f}ms/s wakeups={r['wakeups_per_s']:6.1f}/s")
+    print(f"  MicroSIP started -> connected: {report['wake_to_connected_ms']:.0f}ms")
+    print(f"  MicroSIP exited -> asleep:     {report['sleep_after_exit_ms']:.0f}ms")
+    print(f"  wakeups={report['wakeups']} detector={report['detector']}")
+
+
+def violations(report):
+    """Сон не должен стоить дороже бодрствования"""
+    awake = report['awake']
+    problems = []
+    for phase in ('dormant', 'dormant_again'):
+        r = report[phase]
+        if r['cpu_ms_per_s'] > awake['cpu_ms_per_s']:
+            problems.append(f"{phase}: CPU {r['cpu_ms_per_s']:.3f}ms/s больше, чем в бодрствовании "
+                            f"({awake['cpu_ms_per_s']:.3f}ms/s)")
+        if r['wakeups_per_s'] > awake['wakeups_per_s']:
+            problems.append(f"{phase}: пробуждений {r['wakeups_per_s']:.1f}/s больше, чем в бодрствовании "
+                            f"({awake['wakeups_per_s']:.1f}/s)")
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--engine', choices=sorted(ENGINES), default='threads')
+    parser.add_argument('--seconds', type=float, default=5.0, help="длительность замера каждой фазы")
+    parser.add_argument('--broadcast-interval', type=float, default=0.5)
+    parser.add_argument('--timeout', type=float, default=10.0)
+    parser.add_argument('--json', help="записать отчет в JSON-файл")
+    args = parser.parse_args()
+
+    report = run(args)
+    print_report(report)
+    report['violations'] = violations(report)
+    for problem in report['violations']:
+        print(f"  НАРУШЕНИЕ: {problem}")
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+    return 1 if report['violations'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
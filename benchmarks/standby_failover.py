@@ -0,0 +1,219 @@
+# standby_failover.py
+"""Переключение между двумя серверами администратора: горячий резерв против обычного поиска.
+
+Клиенты подключаются к приоритетному серверу (он указан в списке
+приоритетов), резервный сервер объявляет себя через discovery. Затем
+приоритетный сервер "падает": замеряется время до подключения к резервному.
+Потом он поднимается на том же порту, и замеряется время возврата на него
+(не раньше STANDBY_FAILBACK_DELAY). Все время отдельный поток следит, не
+числится ли клиент одновременно на обоих серверах (split-brain). Тот же
+сценарий без горячего резерва дает базовую линию.
+
+Бенчмарк завершается с кодом 1, если переключение не уложилось в
+--max-failover-ms (базовая линия - в --max-baseline-failover-ms), возврат
+случился раньше failback-delay или не случился, или клиент хоть раз числился
+на двух серверах либо в конце подключен не ровно к одному.
+
+Запуск: python benchmarks/standby_failover.py [--clients 5] [--engine threads|asyncio] [--failback-delay 2]
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+
+from support import summarize
+from mock_admin_server import MockAdminServer
+from fleet_sim import ENGINES, client, stop_fleet, wait_for
+
+
+class DualSampler:
+    """Фиксирует моменты, когда клиент числится на обоих серверах сразу"""
+
+    def __init__(self, servers, hostnames, period=0.002):
+        self.servers = servers  # список, элементы можно заменять (перезапуск сервера)
+        self.hostnames = hostnames
+        self.period = period
+        self.samples = 0
+        self.dual_samples = 0
+        self.longest_dual = 0.0
+        self.running = True
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        dual_since = {}
+        while self.running:
+            now = time.perf_counter()
+            for hostname in self.hostnames:
+                present = sum(1 for server in self.servers if hostname in server.connections)
+                self.samples += 1
+                if present > 1:
+                    self.dual_samples += 1
+                    started = dual_since.setdefault(hostname, now)
+                    self.longest_dual = max(self.longest_dual, now - started)
+                else:
+                    dual_since.pop(hostname, None)
+            time.sleep(self.period)
+
+    def stop(self):
+        self.running = False
+        self.thread.join(1)
+
+
+def on_server(server, hostnames, since):
+    """Все клиенты подключены к server и прислали статус после момента since"""
+    return all(h in server.connections and server.connections[h].first_status_at is not None
+               and server.connections[h].connected_at >= since for h in hostnames)
+
+
+def switch_times(server, hostnames, since):
+    return [server.connections[h].first_status_at - since for h in hostnames]
+
+
+def run(args, standby):
+    client.STANDBY_ENABLED = standby
+    client.STANDBY_PROBE_INTERVAL = args.probe_interval
+    client.STANDBY_FAILBACK_DELAY = args.failback_delay
+    client.STANDBY_FAILOVER_JITTER = args.failover_jitter
+    client.RECONNECT_BASE_DELAY = args.reconnect_base_delay
+    primary = MockAdminServer(broadcast_interval=args.broadcast_interval).start()
+    secondary = MockAdminServer(broadcast_interval=args.broadcast_interval).start()
+    client.SERVER_PRIORITY = f"{primary.host}:{primary.port}"
+    servers = [primary, secondary]
+    report = {'standby': standby, 'clients': args.clients, 'engine': args.engine}
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        fleet = []
+        for i in range(args.clients):
+            path = os.path.join(work_dir, f'sim-{i}.ini')
+            with open(path, 'w', encoding='utf-16') as f:
+                f.write('[Settings]\r\nDND=0\r\n')
+            sim = ENGINES[args.engine](f'standby-{i}', path, primary.query_address,
+                                       os.path.join(work_dir, f'sim-{i}.server.json'))
+            thread = threading.Thread(target=sim.run, daemon=True)
+            thread.start()
+            fleet.append((sim, thread, time.perf_counter()))
+        hostnames = [sim.hostname for sim, _, _ in fleet]
+        if not wait_for(lambda: on_server(primary, hostnames, 0), args.timeout):
+            raise RuntimeError("Клиенты не подключились к приоритетному серверу")
+        for sim, _, _ in fleet:
+            secondary.add_discovery_target(sim.discovery_port)
+        if standby and not wait_for(lambda: all(sim.standby.stats()['healthy'] for sim, _, _ in fleet),
+                                    args.timeout):
+            raise RuntimeError("Резервный сервер не стал доступным")
+
+        sampler = DualSampler(servers, hostnames)
+        sampler.thread.start()
+
+        # Падение приоритетного сервера
+        port = primary.port
+        crashed_at = time.perf_counter()
+        primary.stop()
+        failed_over = wait_for(lambda: on_server(secondary, hostnames, crashed_at), args.timeout)
+        report['failover'] = summarize(switch_times(secondary, hostnames, crashed_at)) if failed_over else None
+
+        # Приоритетный сервер вернулся
+        restarted_at = time.perf_counter()
+        primary = MockAdminServer(port=port, broadcast_interval=args.broadcast_interval).start()
+        servers[0] = primary
+        failed_back = wait_for(lambda: on_server(primary, hostnames, restarted_at), args.failback_timeout)
+        report['failback'] = summarize(switch_times(primary, hostnames, restarted_at), scale=1.0) \
+            if failed_back else None
+        report['failback_min_s'] = min(switch_times(primary, hostnames, restarted_at)) if failed_back else None
+        time.sleep(0.2)  # Даем серверам заметить закрытые соединения
+        sampler.stop()
+        report['split_brain'] = {
+            'dual_samples': sampler.dual_samples,
+            'samples': sampler.samples,
+            'longest_dual_ms': sampler.longest_dual * 1000,
+            'not_on_one_server': [h for h in hostnames
+                                  if sum(1 for server in servers if h in server.connections) != 1],
+        }
+        if standby:
+            report['standby_stats'] = fleet[0][0].standby.stats()
+        stop_fleet(fleet)
+    for server in servers:
+        server.stop()
+    return report
+
+
+def violations(report, args):
+    """Нарушения ограничений прогона (пустой список - все в порядке)"""
+    problems = []
+    limit = args.max_failover_ms if report['standby'] else args.max_baseline_failover_ms
+    failover = report['failover']
+    if failover is None:
+        problems.append("переключение на резервный сервер не произошло")
+    elif failover['max'] > limit:
+        problems.append(f"переключение заняло {failover['max']:.1f} мс (предел {limit:.0f} мс)")
+    if report['standby']:
+        if report['failback'] is None:
+            problems.append("возврат на приоритетный сервер не произошел")
+        elif report['failback_min_s'] < args.failback_delay:
+            problems.append(f"возврат через {report['failback_min_s']:.2f} с, "
+                            f"раньше failback-delay {args.failback_delay:g} с")
+    split = report['split_brain']
+    if split['dual_samples']:
+        problems.append(f"клиенты на двух серверах сразу: {split['dual_samples']} замеров, "
+                        f"до {split['longest_dual_ms']:.1f} мс")
+    if split['not_on_one_server']:
+        problems.append(f"в конце подключены не ровно к одному серверу: {', '.join(split['not_on_one_server'])}")
+    return problems
+
+
+def print_report(report):
+    mode = 'standby' if report['standby'] else 'baseline'
+    print(f"{mode}: clients={report['clients']} engine={report['engine']}")
+    failover = report['failover']
+    if failover:
+        print(f"  failover  p50={failover['p50']:8.1f}ms p90={failover['p90']:8.1f}ms max={failover['max']:8.1f}ms")
+    else:
+        print("  failover  не произошел за отведенное время")
+    failback = report['failback']
+    if failback:
+        print(f"  failback  p50={failback['p50']:8.2f}s  p90={failback['p90']:8.2f}s  max={failback['max']:8.2f}s")
+    else:
+        print("  failback  не произошел за отведенное время")
+    split = report['split_brain']
+    print(f"  split-brain: {split['dual_samples']}/{split['samples']} samples, "
+          f"longest {split['longest_dual_ms']:.1f}ms")
+    if 'standby_stats' in report:
+        print(f"  standby: {report['standby_stats']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--clients', type=int, default=5)
+    parser.add_argument('--engine', choices=sorted(ENGINES), default='threads')
+    parser.add_argument('--probe-interval', type=float, default=0.5)
+    parser.add_argument('--failback-delay', type=float, default=2.0)
+    parser.add_argument('--failover-jitter', type=float, default=client.STANDBY_FAILOVER_JITTER)
+    parser.add_argument('--broadcast-interval', type=float, default=0.5)
+    parser.add_argument('--reconnect-base-delay', type=float, default=client.RECONNECT_BASE_DELAY)
+    parser.add_argument('--timeout', type=float, default=30.0)
+    parser.add_argument('--failback-timeout', type=float, default=15.0)
+    parser.add_argument('--max-failover-ms', type=float, default=1000.0,
+                        help="предел переключения с горячим резервом (max по клиентам)")
+    parser.add_argument('--max-baseline-failover-ms', type=float, default=15000.0,
+                        help="предел переключения без горячего резерва")
+    parser.add_argument('--json', help="записать отчет в JSON-файл")
+    args = parser.parse_args()
+
+    reports = [run(args, standby=False), run(args, standby=True)]
+    failed = False
+    for report in reports:
+        print_report(report)
+        report['violations'] = violations(report, args)
+        for problem in report['violations']:
+            print(f"  НАРУШЕНИЕ: {problem}")
+        failed = failed or bool(report['violations'])
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(reports, f, indent=2, ensure_ascii=False)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,89 @@
+# support.py
+"""Общие функции для бенчмарков: импорт client.py, статистика, замеры процесса и запись microsip.ini."""
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def import_client():
+    """Импортирует client.py из корня репозитория (вне Windows - с headless-бэкендом)"""
+    if ROOT not in sys.path:
+        sys.path.insert(0, ROOT)
+    import client
+    return client
+
+
+def percentile(values, fraction):
+    """Перцентиль по отсортированной выборке (ближайший ранг)"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(fraction * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def summarize(values, scale=1000.0):
+    """p50/p90/p99/max выборки (по умолчанию секунды -> миллисекунды)"""
+    return {
+        'count': len(values),
+        'p50': percentile(values, 0.50) * scale,
+        'p90': percentile(values, 0.90) * scale,
+        'p99': percentile(values, 0.99) * scale,
+        'max': (max(values) if values else 0.0) * scale,
+    }
+
+
+def read_rss():
+    """Текущий RSS процесса в байтах (Linux), иначе пиковый из getrusage"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        import resource
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def open_fds():
+    """Число открытых дескрипторов процесса; None, если /proc недоступен"""
+    try:
+        return len(os.listdir('/proc/self/fd'))
+    except OSError:
+        return None
+
+
+def task_switches(exclude):
+    """Сумма добровольных переключений контекста по потокам процесса (кроме exclude)"""
+    total = 0
+    for tid in os.listdir('/proc/self/task'):
+        if int(tid) in exclude:
+            continue
+        try:
+            with open(f'/proc/self/task/{tid}/status') as f:
+                for line in f:
+                    if line.startswith('voluntary_ctxt_switches'):
+                        total += int(line.split()[1])
+        except OSError:
+            pass
+    return total
+
+
+def thread_cpu(exclude):
+    """Процессорное время потоков процесса (кроме exclude) в секундах - по /proc/PID/task/*/schedstat (Linux)"""
+    total = 0
+    for tid in os.listdir('/proc/self/task'):
+        if int(tid) in exclude:
+            continue
+        try:
+            with open(f'/proc/self/task/{tid}/schedstat') as f:
+                total += int(f.read().split()[0])
+        except (OSError, ValueError, IndexError):
+            pass
+    return total / 1e9
+
+
+def write_dnd(path, dnd):
+    """Записывает microsip.ini с учетной записью и DND, как MicroSIP (UTF-16)"""
+    with open(path, 'w', encoding='utf-16') as f:
+        f.write(f'[Settings]\r\naccountId=1\r\nDND={dnd}\r\n')
@@ -0,0 +1,211 @@
+# timer_wakeups.py
+"""Пробуждения клиента в простое: планировщик таймеров против циклов со sleep.
+
+Живой замер: один клиент подключен к локальному серверу и простаивает
+(рассылка сервера и ping редкие, чтобы не заслонять собственные таймеры
+клиента). Замеряются добровольные переключения контекста потоков клиента в
+секунду (потоки сервера и самого бенчмарка не считаются), CPU и число
+потоков. С --compare REV тот же замер выполняется для ревизии REV
+(git archive во временный каталог, отдельный процесс) - базовая линия.
+С --polling-watcher нативные наблюдатели отключены и microsip.ini
+опрашивается каждые DND_POLL_INTERVAL секунд.
+
+Прокрутка времени: задачи простаивающего клиента (проверка MicroSIP, опрос
+microsip.ini и профилей, резервные серверы, ping, проверка обновлений)
+выполняются на подменных часах - час проходит за миллисекунды. Сравнивается
+число пробуждений планировщика с суммой запусков задач (столько пробуждений
+дали бы отдельные циклы), проверяется, что два прогона с одним seed дают
+одинаковое расписание.
+
+Запуск: python benchmarks/timer_wakeups.py [--engine threads|asyncio] [--seconds 10] [--compare HEAD~1] [--polling-watcher]
+"""
+import argparse
+import hashlib
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from support import ROOT, task_switches
+
+
+def load_client(root):
+    """Импортирует client.py из root (для --compare - из распакованной ревизии)"""
+    os.environ['MICROSIP_PLATFORM'] = 'headless'
+    sys.path.insert(0, root)
+    import client
+    return client
+
+
+def measure_live(args):
+    client = load_client(args.root or ROOT)
+    from mock_admin_server import MockAdminServer
+    from fleet_sim import ENGINES, wait_for
+
+    class IdleClient(ENGINES[args.engine]):
+        def check_updates_periodically(self):  # Ревизии до планировщика таймеров
+            pass
+
+    if args.polling_watcher:
+        client.WATCHER_BACKENDS = []
+    server = MockAdminServer(broadcast_interval=args.broadcast_interval, keepalive=args.keepalive).start()
+    exclude = {threading.main_thread().native_id, server.thread.native_id}
+    with tempfile.TemporaryDirectory() as work_dir:
+        path = os.path.join(work_dir, 'microsip.ini')
+        with open(path, 'w', encoding='utf-16') as f:
+            f.write('[Settings]\r\nDND=0\r\n')
+        baseline_threads = threading.active_count()
+        sim = IdleClient('idle', path, server.query_address, os.path.join(work_dir, 'server.json'))
+        thread = threading.Thread(target=sim.run, daemon=True)
+        thread.start()
+        if not wait_for(lambda: 'idle' in server.connections and
+                        server.connections['idle'].first_status_at is not None, args.timeout):
+            raise RuntimeError("Клиент не подключился к серверу")
+        time.sleep(1)
+
+        switches = task_switches(exclude)
+        cpu = time.process_time()
+        time.sleep(args.seconds)
+        report = {
+            'root': args.root or ROOT,
+            'engine': args.engine,
+            'polling_watcher': args.polling_watcher,
+            'wakeups_per_s': (task_switches(exclude) - switches) / args.seconds,
+            'cpu_ms_per_s': (time.process_time() - cpu) / args.seconds * 1000,
+            'threads': threading.active_count() - baseline_threads,
+        }
+        if hasattr(sim, 'timers'):
+            report['timers'] = sim.timers.stats()
+        sim.stop()
+        thread.join(5)
+    server.stop()
+    return report
+
+
+def measure_compare(args):
+    """Тот же живой замер для ревизии args.compare в отдельном процессе"""
+    with tempfile.TemporaryDirectory() as root:
+        archive = subprocess.run(['git', '-C', ROOT, 'archive', args.compare], check=True, capture_output=True)
+        subprocess.run(['tar', '-x', '-C', root], input=archive.stdout, check=True)
+        out = os.path.join(root, 'report.json')
+        command = [sys.executable, os.path.abspath(__file__), '--live-only', '--root', root, '--json', out,
+                   '--engine', args.engine, '--seconds', str(args.seconds),
+                   '--broadcast-interval', str(args.broadcast_interval), '--keepalive', str(args.keepalive)]
+        if args.polling_watcher:
+            command.append('--polling-watcher')
+        subprocess.run(command, check=True, cwd=root)
+        with open(out, encoding='utf-8') as f:
+            report = json.load(f)
+    report['root'] = args.compare
+    return report
+
+
+class ManualClock:
+    """Подменные часы: время идет, только когда его двигают"""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def simulate(client, hours, seed):
+    """Прокручивает hours часов задач простаивающего клиента; пробуждения, запуски и отпечаток расписания"""
+    clock = ManualClock()
+    timers = client.TimerScheduler(clock=clock, rng=random.Random(seed))
+    trace = hashlib.sha256()
+    heartbeat = {'interval': client.PING_INTERVAL}
+
+    def job(name, result=None):
+        def run():
+            trace.update(f'{clock.now:.6f}:{name};'.encode())
+            return result() if result else None
+        return run
+
+    def ping():
+        # Как Heartbeat на стабильном канале: интервал растет до предела
+        heartbeat['interval'] = min(client.PING_MAX_INTERVAL, heartbeat['interval'] * 1.5)
+        return heartbeat['interval']
+
+    timers.every('activity', client.SLEEP_AWAKE_PROBE_INTERVAL, job('activity'))
+    timers.every('dnd_poll', client.DND_POLL_INTERVAL, job('dnd_poll'))
+    timers.every('sessions', client.SERVICE_POLL_INTERVAL, job('sessions'))
+    timers.every('standby', client.STANDBY_PROBE_INTERVAL, job('standby'))
+    timers.call_later('heartbeat', heartbeat['interval'], job('heartbeat', ping))
+    timers.every('updates', client.UPDATE_CHECK_INTERVAL, job('updates'), jitter=client.UPDATE_CHECK_JITTER)
+
+    end = hours * 3600
+    started = time.perf_counter()
+    wakeups = 0
+    while True:
+        wake = timers.next_wakeup()
+        if wake is None or wake > end:
+            break
+        clock.now = wake
+        timers.run_due()
+        wakeups += 1
+    stats = timers.stats()
+    return {
+        'simulated_hours': hours,
+        'elapsed_ms': (time.perf_counter() - started) * 1000,
+        'wakeups': wakeups,
+        'runs': stats['runs'],
+        'coalesced': stats['coalesced'],
+        'trace': trace.hexdigest(),
+    }
+
+
+def print_live(report):
+    line = (f"  {report['root']}: wakeups={report['wakeups_per_s']:6.2f}/s "
+            f"cpu={report['cpu_ms_per_s']:6.3f}ms/s threads={report['threads']}")
+    if 'timers' in report:
+        line += f" timers={report['timers']}"
+    print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--engine', choices=('threads', 'asyncio'), default='threads')
+    parser.add_argument('--seconds', type=float, default=10.0, help="длительность замера простоя")
+    parser.add_argument('--broadcast-interval', type=float, default=60.0)
+    parser.add_argument('--keepalive', type=float, default=120.0, help="таймаут живости сервера (ping - до половины)")
+    parser.add_argument('--polling-watcher', action='store_true', help="опрашивать microsip.ini вместо inotify")
+    parser.add_argument('--compare', metavar='REV', help="ревизия git для базовой линии")
+    parser.add_argument('--hours', type=float, default=1.0, help="сколько часов прокрутить на подменных часах")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--timeout', type=float, default=10.0)
+    parser.add_argument('--root', help=argparse.SUPPRESS)
+    parser.add_argument('--live-only', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--json', help="записать отчет в JSON-файл")
+    args = parser.parse_args()
+
+    if args.live_only:
+        report = measure_live(args)
+    else:
+        report = {'live': [measure_live(args)]}
+        if args.compare:
+            report['live'].insert(0, measure_compare(args))
+        client = sys.modules['client']
+        runs = [simulate(client, args.hours, args.seed) for _ in range(2)]
+        report['simulated'] = runs[0]
+        report['simulated']['deterministic'] = runs[0]['trace'] == runs[1]['trace']
+
+        print(f"idle client, engine={args.engine}{' (polling watcher)' if args.polling_watcher else ''}")
+        for live in report['live']:
+            print_live(live)
+        sim = report['simulated']
+        print(f"fast-forward {sim['simulated_hours']:g}h in {sim['elapsed_ms']:.1f}ms: "
+              f"scheduler wakeups={sim['wakeups']} vs separate loops={sim['runs']} "
+              f"(coalesced {sim['coalesced']}), deterministic={sim['deterministic']}")
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,168 @@
+# update_fleet.py
+"""Поэтапное развертывание обновления по парку клиентов в отдельных процессах.
+
+Запускает локальный API релизов и N процессов клиента, каждый со своим
+discovery-портом. Клиенты ждут свою долю окна развертывания; первый
+загрузивший файл из "интернета" (MockReleaseServer) после "перезапуска"
+объявляет его через UDP discovery и раздает соседям. Отчет показывает,
+сколько раз файл скачан из интернета, а сколько - у соседей.
+
+Запуск: python benchmarks/update_fleet.py --clients 10 [--window 5] [--engine threads|asyncio]
+"""
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from support import summarize
+from mock_release_server import MockReleaseServer
+
+
+def free_udp_ports(count):
+    sockets = []
+    for _ in range(count):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind(('127.0.0.1', 0))
+        sockets.append(sock)
+    ports = [sock.getsockname()[1] for sock in sockets]
+    for sock in sockets:
+        sock.close()
+    return ports
+
+
+def run_child(args):
+    """Один клиент: ждет обновление, после установки раздает его соседям"""
+    os.chdir(args.work_dir)
+    from support import import_client
+    client = import_client()
+    client.GITHUB_API_URL = args.api_url
+    client.UPDATE_CHECK_INTERVAL = args.check_interval
+    client.UPDATE_ROLLOUT_WINDOW = args.window
+    client.UPDATE_ANNOUNCE_INTERVAL = args.announce_interval
+    client.UPDATE_PEER_PORT = 0
+    started_at = time.time()
+
+    class FleetUpdateManager(client.UpdateManager):
+        def install_update(self, update_file):
+            counters = self.stats()
+            source = 'peer' if counters['peer_downloads'] else 'wan'
+            print(json.dumps({'index': args.index, 'source': source,
+                              'seconds': time.time() - started_at}), flush=True)
+            # Имитация перезапуска новой версией: начинаем раздачу
+            client.VERSION = self.cache['seed']['version']
+            self.start_peer_cache()
+
+    class FleetClient(ENGINES[args.engine](client)):
+        def get_hostname(self):
+            return f'update-{args.index}'
+
+        def get_settings_path(self):
+            return os.path.join(args.work_dir, 'microsip.ini')
+
+        def display_message(self, message):
+            return "message_displayed"
+
+    client.UpdateManager = FleetUpdateManager
+    ports = [int(p) for p in args.ports.split(',')]
+    sim = FleetClient(discovery_port=ports[args.index], query_address=('127.0.0.1', 9),
+                      server_cache_path=os.path.join(args.work_dir, 'server_cache.json'))
+    sim.update_manager.peer_targets = [('127.0.0.1', port) for port in ports]
+    sim.run()
+
+
+ENGINES = {
+    'threads': lambda client: client.MicrosipClient,
+    'asyncio': lambda client: client.AsyncMicrosipClient,
+}
+
+
+def run(args):
+    server = MockReleaseServer(size=int(args.size_mb * 1024 * 1024)).start()
+    ports = free_udp_ports(args.clients)
+    results = []
+    processes = []
+    with tempfile.TemporaryDirectory() as root:
+        started_at = time.time()
+        for index in range(args.clients):
+            work_dir = os.path.join(root, f'client-{index}')
+            os.makedirs(work_dir)
+            with open(os.path.join(work_dir, 'microsip.ini'), 'w', encoding='utf-16') as f:
+                f.write('[Settings]\r\nDND=0\r\n')
+            command = [sys.executable, os.path.abspath(__file__), '--child', '--index', str(index),
+                       '--ports', ','.join(map(str, ports)), '--api-url', server.api_url,
+                       '--work-dir', work_dir, '--window', str(args.window),
+                       '--check-interval', str(args.check_interval),
+                       '--announce-interval', str(args.announce_interval), '--engine', args.engine]
+            processes.append(subprocess.Popen(command, stdout=subprocess.PIPE,
+                                              stderr=subprocess.DEVNULL, text=True))
+
+        def collect(process):
+            for line in process.stdout:
+                if line.startswith('{'):
+                    results.append(json.loads(line))
+
+        readers = [threading.Thread(target=collect, args=(p,), daemon=True) for p in processes]
+        for reader in readers:
+            reader.start()
+        deadline = time.time() + args.timeout
+        while len(results) < args.clients and time.time() < deadline:
+            time.sleep(0.1)
+        elapsed = time.time() - started_at
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait(10)
+    wan_requests = sum(1 for path, _ in server.requests if path == '/download/update.exe')
+    server.stop()
+
+    return {
+        'clients': args.clients,
+        'window_s': args.window,
+        'updated': len(results),
+        'wan_downloads': sum(1 for r in results if r['source'] == 'wan'),
+        'peer_downloads': sum(1 for r in results if r['source'] == 'peer'),
+        'wan_requests': wan_requests,
+        'wan_bytes_per_payload': server.bytes_sent / len(server.payload),
+        'update_time': summarize([r['seconds'] for r in results], scale=1.0),
+        'elapsed_s': elapsed,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--clients', type=int, default=10)
+    parser.add_argument('--window', type=float, default=5.0, help="окно поэтапного развертывания, с")
+    parser.add_argument('--check-interval', type=float, default=1.0)
+    parser.add_argument('--announce-interval', type=float, default=1.0)
+    parser.add_argument('--size-mb', type=float, default=8)
+    parser.add_argument('--engine', choices=sorted(ENGINES), default='threads')
+    parser.add_argument('--timeout', type=float, default=60.0)
+    parser.add_argument('--json', help="записать отчет в JSON-файл")
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--index', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--ports', help=argparse.SUPPRESS)
+    parser.add_argument('--api-url', help=argparse.SUPPRESS)
+    parser.add_argument('--work-dir', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_child(args)
+        return
+    report = run(args)
+    t = report['update_time']
+    print(f"clients={report['clients']} window={report['window_s']}s updated={report['updated']}")
+    print(f"  wan downloads={report['wan_downloads']} peer downloads={report['peer_downloads']} "
+          f"wan requests={report['wan_requests']} wan bytes={report['wan_bytes_per_payload']:.2f}x payload")
+    print(f"  time to update: p50={t['p50']:.2f}s p90={t['p90']:.2f}s max={t['max']:.2f}s")
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+
+
+if __name__ == '__main__':
+    main()
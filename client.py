@@ -1,4 +1,5 @@
 # client.py
+import abc
 import socket
 import threading
 import time
@@ -6,130 +7,670 @@ import sys
 import os
 import subprocess
 import platform
+import codecs
+import re
 import ctypes
+import ctypes.util
+import select
+import struct
 import logging
+import random
+import heapq
 from datetime import datetime
+from collections import deque
 import json
-import requests
+import glob
+import hashlib
 import tempfile
 from pathlib import Path
-import win32gui
-import win32con
-import win32api
-import win32com.client
-from win32com.client import Dispatch
-from packaging import version
-
-# Настройка логирования
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('client.log', encoding='utf-8'),
-        logging.StreamHandler(sys.stdout)
-    ]
-)
+from protocol import (FrameDecoder, encode_frame, tag_frame, parse_tagged, split_batch, encode_batch,
+                      encode_history, address_frame, parse_addressed,
+                      RECV_BUFFER_SIZE, PROTOCOL_VERSION)
+from metrics import Registry, SLOW_BUCKETS, start_http_server
+from logpipeline import setup_logging
+from backends import get_backend
 
 # Константы
 DISCOVERY_PORT = 12346
 SERVER_PORT = 12345
+DISCOVERY_QUERY_PORT = 12347  # UDP-порт сервера для активных запросов ADMIN_SERVER_QUERY
+DISCOVERY_QUERY_MESSAGE = b"ADMIN_SERVER_QUERY"
+DISCOVERY_QUERY_INTERVAL = 5  # Интервал повторных активных запросов, пока нет подключения
+DISCOVERY_COLLECT_WINDOW = 0.2  # Окно сбора ответов нескольких серверов перед выбором
+SERVER_PROBE_TIMEOUT = 0.5  # Таймаут замера RTT до сервера-кандидата
+SERVER_CACHE_FILE = 'server_cache.json'  # Последний сервер, к которому удалось подключиться
+CACHED_SERVER_CONNECT_TIMEOUT = 1.0  # Таймаут TCP-подключения к серверу из кэша (дальше - discovery)
+SERVER_CONNECT_TIMEOUT = 10  # Таймаут TCP-подключения и ожидания CONNECTION_ACCEPTED
 BUFFER_SIZE = 1024
-RECONNECT_DELAY = 5  # Задержка перед повторным подключением
-MAX_RECONNECT_ATTEMPTS = 3  # Максимальное количество попыток переподключения
+RECONNECT_BASE_DELAY = 2  # Базовая задержка переподключения (удваивается после каждой неудачи)
+RECONNECT_MAX_DELAY = 60  # Верхняя граница задержки переподключения
+MAX_RECONNECT_ATTEMPTS = 3  # Неудачных попыток подряд, после которых возвращаемся к поиску сервера
+STANDBY_ENABLED = os.getenv('MICROSIP_STANDBY', '0') == '1'  # Следить за резервными серверами и переключаться сразу
+STANDBY_PROBE_INTERVAL = 5  # Интервал проверки резервных серверов (секунды)
+STANDBY_FAILOVER_JITTER = 0.2  # Разброс момента переключения, чтобы парк не приходил одновременно
+STANDBY_FAILBACK_DELAY = 30  # Сколько приоритетный сервер должен быть доступен до возврата на него
+SERVER_PRIORITY = os.getenv('MICROSIP_SERVER_PRIORITY', '')  # "ip:port,ip:port" - серверы по убыванию приоритета
+PING_INTERVAL = 15  # Начальный интервал ping (если не было другого трафика)
+PING_MIN_INTERVAL = 5  # Интервал ping после сбоев
+PING_MAX_INTERVAL = 60  # Верхняя граница интервала ping на стабильном канале
+SERVER_RESPONSE_TIMEOUT = int(os.getenv('MICROSIP_SERVER_TIMEOUT', 60))  # Время без данных от сервера, после которого соединение считается потерянным (сервер может задать keepalive= в рукопожатии)
+COMMAND_READ_TIMEOUT = 30.0  # Таймаут сокета на чтение команд (и на отправку пакета)
+OUTBOUND_QUEUE_SIZE = 256  # Максимальное число сообщений в очереди отправки
+COMMAND_WORKERS = 4  # Потоков для команд с идентификатором запроса (протокол 2)
+OUTBOX_MAX_KEYS = 64  # Максимум разных ключей состояния, копящихся без связи
+OUTBOX_HISTORY_SIZE = 500  # Сколько последних переходов хранить для сервера (history=zlib)
+SERVICE_MODE = os.getenv('MICROSIP_SERVICE', '0') == '1'  # Один процесс на профили всех пользователей хоста
+SERVICE_PROFILES = os.getenv('MICROSIP_PROFILES', '')  # Шаблон путей к microsip.ini ('*' - пользователь); пусто - по ОС
+SERVICE_POLL_INTERVAL = 1  # Интервал проверки профилей (stat; файл читается, только если изменился)
+SERVICE_SCAN_INTERVAL = 30  # Интервал поиска новых и удаленных профилей
 
 # Константы для обновлений
 GITHUB_REPO = "knyazev692/checkas"  # Замените на ваш репозиторий
 GITHUB_API_URL = f"https://api.github.com/repos/{GITHUB_REPO}/releases/latest"
 VERSION = "1.0.1"  # Текущая версия клиента
 UPDATE_CHECK_INTERVAL = 3600  # Проверка обновлений каждый час
+UPDATE_CACHE_FILE = 'update_cache.json'  # ETag и метаданные последнего релиза
+UPDATE_DOWNLOAD_DIR = 'updates'  # Частично загруженные обновления (для докачки)
+UPDATE_HTTP_TIMEOUT = (5, 30)  # Таймауты HTTP: подключение, чтение
+UPDATE_CHUNK_MIN = 64 * 1024  # Начальный размер блока загрузки
+UPDATE_CHUNK_MAX = 1024 * 1024  # Максимальный размер блока загрузки
+UPDATE_CHECK_JITTER = 0.2  # Разброс интервала проверки (+-20%), чтобы клиенты не ходили в API разом
+UPDATE_ROLLOUT_WINDOW = 4 * 3600  # Окно поэтапного развертывания: клиент ждет свою долю окна, прежде чем качать из интернета
+UPDATE_PEER_PORT = 12348  # HTTP-порт раздачи проверенного обновления соседям по сети
+UPDATE_ANNOUNCE_INTERVAL = 300  # Интервал объявления о раздаче через UDP discovery
+UPDATE_ANNOUNCE_PREFIX = "UPDATE_AVAILABLE:"  # UPDATE_AVAILABLE:версия:sha256:порт
+
+# Логирование (настраивается при запуске, см. setup_logging)
+LOG_FILE = 'client.log'
+LOG_LEVEL = os.getenv('MICROSIP_LOG_LEVEL', 'INFO').upper()
+
+# Метрики
+METRICS_PORT = int(os.getenv('MICROSIP_METRICS_PORT', 0))  # Порт /metrics на 127.0.0.1 (0 - отключено)
+
+# Константы для уведомлений
+NOTIFY_MAX_PENDING = 5  # Максимум уведомлений в очереди показа
+NOTIFY_DEDUP_WINDOW = 30  # Одинаковое уведомление в течение этого времени не повторяется (секунды)
+NOTIFY_RATE_BURST = 5  # Сколько уведомлений можно показать подряд
+NOTIFY_RATE_INTERVAL = 10  # Дальше - не чаще одного за столько секунд
+
+# Константы для отслеживания файла настроек MicroSIP
+DND_POLL_INTERVAL = 2  # Интервал опроса для резервного (polling) наблюдателя
+DND_DEBOUNCE = 0.05  # Окно подавления серии записей в файл (секунды)
+
+# Константы планировщика таймеров
+TIMER_SLACK = 0.1  # Доля задержки, на которую задача может опоздать, чтобы выполниться в одно пробуждение с другими
+TIMER_MAX_SLACK = 1.0  # Но не больше секунды
+
+# Константы снимка статуса
+STATUS_TTL = 1.0  # Устарелость снимка статуса, когда microsip.ini опрашивается (без нативного наблюдателя)
+MICROSIP_PROCESS = 'microsip.exe'  # Имя процесса MicroSIP
+
+# Константы режима сна
+SLEEP_MODE = os.getenv('MICROSIP_SLEEP', '1' if sys.platform == 'win32' else '0') == '1'  # Спать, пока MicroSIP не запущен
+SLEEP_PROBE_INTERVAL = 0.5  # Первая проверка запуска MicroSIP после засыпания
+SLEEP_PROBE_MAX_INTERVAL = 2.0  # Во сне интервал проверок растет до этого предела (задержка пробуждения)
+SLEEP_PROBE_BACKOFF = 1.5  # Во сколько раз растет интервал после каждой проверки без MicroSIP
+SLEEP_AWAKE_PROBE_INTERVAL = 1  # Проверка, что MicroSIP еще работает (засыпаем не позже чем через секунду)
+
+class NotificationDispatcher:
+    """Неблокирующий показ уведомлений.
+
+    submit() только ставит уведомление в очередь и сразу возвращается, а
+    модальные окна по одному показывает отдельный UI-поток. Повторы того же
+    текста в течение NOTIFY_DEDUP_WINDOW, превышение лимита частоты и
+    переполнение очереди отбрасываются. О показе и закрытии сообщается
+    через on_event(событие, id); об отказе вызывающий узнает из результата
+    submit().
+
+    Собственные уведомления клиента (show_notification, например от
+    UpdateManager) идут через ту же очередь, но без id протокола и без
+    событий серверу.
+    """
+
+    def __init__(self, backend, on_event=None, max_pending=NOTIFY_MAX_PENDING,
+                 dedup_window=NOTIFY_DEDUP_WINDOW, burst=NOTIFY_RATE_BURST, rate_interval=NOTIFY_RATE_INTERVAL):
+        self.backend = backend
+        self.on_event = on_event
+        self.max_pending = max_pending
+        self.dedup_window = dedup_window
+        self.burst = burst
+        self.rate_interval = rate_interval
+        self.condition = threading.Condition()
+        self.queue = deque()  # (id, title, message)
+        self.recent = {}  # (title, message) -> когда последний раз принято
+        self.current = None  # (title, message), показываемое сейчас
+        self.tokens = burst
+        self.tokens_at = time.monotonic()
+        self.next_id = 0
+        self.closed = False
+        self.counters = {'submitted': 0, 'shown': 0, 'dismissed': 0,
+                         'duplicate': 0, 'rate_limited': 0, 'queue_full': 0, 'internal': 0}
+        self.thread = None  # UI-поток запускается при первом уведомлении
+
+    def submit(self, title, message):
+        """Ставит уведомление в очередь; возвращает (id, причина отказа или None).
+
+        Отброшенные тоже получают id."""
+        with self.condition:
+            self.next_id += 1
+            notification_id = self.next_id
+            self.counters['submitted'] += 1
+            reason = self._enqueue(notification_id, title, message)
+            if reason is not None:
+                self.counters[reason] += 1
+        if reason is not None:
+            logging.warning(f"Уведомление {notification_id} отброшено: {reason}")
+        return notification_id, reason
 
-class NotificationManager:
-    def __init__(self):
-        self.app_id = "MicroSip"
-        try:
-            self.shell = Dispatch("WScript.Shell")
-        except Exception as e:
-            logging.error(f"Failed to initialize WScript.Shell: {e}")
-            self.shell = None
-        
     def show_notification(self, title, message, duration=5):
-        """Показывает уведомление в правом нижнем углу экрана"""
-        try:
-            if self.shell:
-                try:
-                    # Создаем объект уведомления через WScript.Shell
-                    notification = self.shell.CreateObject("WScript.Shell.1")
-                    notification.Popup(
-                        "MicroSip",
-                        message,
-                        duration,
-                        0x1  # Information icon
-                    )
-                    return "message_displayed"
-                except Exception as e:
-                    logging.error(f"Failed to show WScript notification: {e}")
-            
-            # Если WScript.Shell не работает, используем стандартное окно сообщения
-            ctypes.windll.user32.MessageBoxW(0, message, "MicroSip", 0x40)
-            return "message_displayed"
-        except Exception as e:
-            logging.error(f"Ошибка при показе уведомления: {e}")
+        """Собственное уведомление клиента (UpdateManager): без id протокола и событий серверу"""
+        with self.condition:
+            reason = self._enqueue(None, title, message)
+            if reason is None:
+                self.counters['internal'] += 1
+        if reason is not None:
+            logging.info(f"Уведомление клиента \"{title}\" отброшено: {reason}")
+        return "message_displayed"
+
+    def _enqueue(self, notification_id, title, message):
+        """Ставит уведомление в очередь под self.condition; причина отказа или None"""
+        now = time.monotonic()
+        key = (title, message)
+        # Собственные уведомления клиента не расходуют лимит частоты сообщений сервера
+        reason = self._admit(key, now, limit_rate=notification_id is not None)
+        if reason is None:
+            self.queue.append((notification_id, title, message))
+            self.recent[key] = now
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, daemon=True, name='notifications')
+                self.thread.start()
+            self.condition.notify()
+        return reason
+
+    def _admit(self, key, now, limit_rate=True):
+        if key == self.current or any(key == (t, m) for _, t, m in self.queue):
+            return 'duplicate'
+        if now - self.recent.get(key, -self.dedup_window) < self.dedup_window:
+            return 'duplicate'
+        if len(self.queue) >= self.max_pending:
+            return 'queue_full'
+        if limit_rate:
+            self.tokens = min(self.burst, self.tokens + (now - self.tokens_at) / self.rate_interval)
+            self.tokens_at = now
+            if self.tokens < 1:
+                return 'rate_limited'
+            self.tokens -= 1
+        # Старые записи для дедупликации больше не нужны
+        for old in [k for k, t in self.recent.items() if now - t >= self.dedup_window]:
+            del self.recent[old]
+        return None
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.queue and not self.closed:
+                    self.condition.wait()
+                if self.closed:
+                    return
+                notification_id, title, message = self.queue.popleft()
+                self.current = (title, message)
+                if notification_id is not None:
+                    self.counters['shown'] += 1
+            self._emit('shown', notification_id)
+            try:
+                self.backend.show_notification(title, message)
+            except Exception as e:
+                logging.error(f"Ошибка при показе уведомления: {e}")
+            with self.condition:
+                self.current = None
+                if notification_id is not None:
+                    self.counters['dismissed'] += 1
+            self._emit('dismissed', notification_id)
+
+    def _emit(self, event, notification_id, reason=None):
+        if self.on_event and notification_id is not None:
+            try:
+                self.on_event(event, notification_id, reason)
+            except Exception as e:
+                logging.error(f"Ошибка при обработке события уведомления: {e}")
+
+    def close(self):
+        """Отбрасывает очередь и останавливает UI-поток (открытое окно не закрывается)"""
+        with self.condition:
+            self.closed = True
+            self.queue.clear()
+            self.condition.notify_all()
+
+    def stats(self):
+        with self.condition:
+            return dict(self.counters, pending=len(self.queue))
 
 class UpdateManager:
-    def __init__(self, notification_manager):
+    """Проверка и установка обновлений из релизов GitHub.
+
+    Запросы идут через одну сессию с пулом соединений. Метаданные релиза
+    кэшируются на диске вместе с ETag/Last-Modified, и повторная проверка
+    отправляет условный запрос: ответ 304 не тратит лимит API. Загрузка
+    докачивается запросом Range после обрыва, а перед установкой файл
+    сверяется с контрольной суммой SHA-256 из релиза.
+    """
+
+    def __init__(self, notification_manager, api_url=None, cache_path=UPDATE_CACHE_FILE,
+                 download_dir=UPDATE_DOWNLOAD_DIR, hostname=None, timers=None, on_install=None):
         self.notification_manager = notification_manager
-        
+        self.on_install = on_install  # Останавливает клиент, когда запущена замена исполняемого файла
+        self.api_url = api_url or GITHUB_API_URL
+        self.cache_path = cache_path
+        self.download_dir = download_dir
+        self.hostname = hostname or socket.gethostname()
+        self._session = None
+        self.cache = self.load_cache()
+        self.not_before = 0  # Не обращаться к API до этого момента (лимит запросов)
+        self.counters = {'checks': 0, 'not_modified': 0, 'bytes_downloaded': 0, 'bytes_resumed': 0,
+                         'wan_downloads': 0, 'peer_downloads': 0, 'peer_failures': 0}
+        # Раздача обновления соседям
+        self.peers = {}  # sha256 -> {(ip, port): время объявления}
+        self.peer_targets = [('<broadcast>', DISCOVERY_PORT)]
+        self.peer_server = None
+        self.announce_socket = None
+        self.timers = timers  # Планировщик клиента (объявления о раздаче)
+        self.pending = None  # sha256 обновления, отложенного до своей доли окна развертывания
+        self.next_check_at = None
+
+    @property
+    def session(self):
+        """HTTP-сессия с пулом соединений; requests импортируется при первой проверке"""
+        if self._session is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+            session = requests.Session()
+            session.mount('http://', HTTPAdapter(pool_maxsize=2, max_retries=2))
+            session.mount('https://', HTTPAdapter(pool_maxsize=2, max_retries=2))
+            session.headers.update({
+                'User-Agent': f'checkas-client/{VERSION}',
+                'Accept': 'application/vnd.github+json',
+            })
+            self._session = session
+        return self._session
+
+    def load_cache(self):
+        """Читает сохраненные ETag и метаданные релиза"""
+        try:
+            with open(self.cache_path, 'r', encoding='utf-8') as f:
+                cache = json.load(f)
+            if isinstance(cache, dict) and isinstance(cache.get('release'), dict):
+                return cache
+        except (OSError, ValueError):
+            pass
+        return {}
+
+    def save_cache(self, response, release):
+        """Сохраняет метаданные релиза и валидаторы ответа"""
+        self.cache.update({
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+            'release': {
+                'tag_name': release.get('tag_name', ''),
+                'assets': [
+                    {key: asset.get(key) for key in ('id', 'name', 'size', 'digest', 'browser_download_url')}
+                    for asset in release.get('assets', [])
+                ],
+            },
+        })
+        self.write_cache()
+
+    def write_cache(self):
+        try:
+            temp_path = f"{self.cache_path}.tmp"
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump(self.cache, f)
+            os.replace(temp_path, self.cache_path)
+        except OSError as e:
+            logging.warning(f"Не удалось сохранить кэш обновлений: {e}")
+
+    def fetch_latest_release(self):
+        """Возвращает метаданные последнего релиза (условный запрос к API)"""
+        if time.time() < self.not_before:
+            return None
+        headers = {}
+        if self.cache.get('etag'):
+            headers['If-None-Match'] = self.cache['etag']
+        if self.cache.get('last_modified'):
+            headers['If-Modified-Since'] = self.cache['last_modified']
+
+        self.counters['checks'] += 1
+        response = self.session.get(self.api_url, headers=headers, timeout=UPDATE_HTTP_TIMEOUT)
+        if response.status_code == 304:
+            self.counters['not_modified'] += 1
+            return self.cache.get('release')
+        if response.status_code == 200:
+            release = response.json()
+            self.save_cache(response, release)
+            return self.cache['release']
+        if response.status_code in (403, 429):
+            self.not_before = self.rate_limit_reset(response)
+            logging.warning(f"Лимит запросов к API обновлений, следующая проверка не раньше "
+                            f"{datetime.fromtimestamp(self.not_before):%H:%M:%S}")
+        else:
+            logging.warning(f"API обновлений вернул код {response.status_code}")
+        return None
+
+    @staticmethod
+    def rate_limit_reset(response):
+        """Момент, после которого можно повторить запрос (Retry-After / X-RateLimit-Reset)"""
+        try:
+            if 'Retry-After' in response.headers:
+                return time.time() + int(response.headers['Retry-After'])
+            if 'X-RateLimit-Reset' in response.headers:
+                return float(response.headers['X-RateLimit-Reset'])
+        except ValueError:
+            pass
+        return time.time() + UPDATE_CHECK_INTERVAL
+
     def check_for_updates(self):
         """Проверяет наличие обновлений"""
+        from packaging import version
         try:
-            response = requests.get(GITHUB_API_URL)
-            if response.status_code == 200:
-                latest_release = response.json()
-                latest_version = latest_release['tag_name'].lstrip('v')
-                
-                if version.parse(latest_version) > version.parse(VERSION):
-                    self.notification_manager.show_notification(
-                        "Доступно обновление",
-                        f"Обновление до версии {latest_version}"
-                    )
-                    self.download_and_install_update(latest_release['assets'][0]['browser_download_url'])
+            latest_release = self.fetch_latest_release()
+            if not latest_release:
+                return False
+            latest_version = latest_release['tag_name'].lstrip('v')
+
+            if version.parse(latest_version) > version.parse(VERSION):
+                asset = self.select_asset(latest_release)
+                if asset is None:
+                    logging.error(f"В релизе {latest_version} нет файла обновления")
+                    return False
+                expected = self.expected_digest(latest_release, asset)
+                if not expected:
+                    logging.error(f"Для {asset['name']} не опубликована контрольная сумма, установка отменена")
+                    return False
+
+                peers = self.peer_sources(expected)
+                wait = self.rollout_wait(latest_version)
+                if not peers and wait > 0:
+                    # Пока не наша очередь - ждем, не появится ли файл у соседей
+                    logging.info(f"Обновление {latest_version} отложено на {wait:.0f} с (поэтапное развертывание)")
+                    self.pending = expected
+                    self.next_check_at = time.time() + wait
+                    return False
+                self.pending = None
+                self.next_check_at = None
+
+                self.notification_manager.show_notification(
+                    "Доступно обновление",
+                    f"Обновление до версии {latest_version}"
+                )
+                update_file = self.download_update(latest_release, asset, expected, peers)
+                if update_file:
+                    self.install_update(update_file)
                     return True
             return False
         except Exception as e:
             logging.error(f"Ошибка при проверке обновлений: {e}")
             return False
 
-    def download_and_install_update(self, download_url):
-        """Загружает и устанавливает обновление"""
+    @staticmethod
+    def select_asset(release):
+        """Файл обновления из релиза (исполняемый файл, иначе первый не .sha256)"""
+        assets = [a for a in release.get('assets', []) if not a['name'].lower().endswith('.sha256')]
+        for asset in assets:
+            if asset['name'].lower().endswith('.exe'):
+                return asset
+        return assets[0] if assets else None
+
+    def expected_digest(self, release, asset):
+        """SHA-256 файла: поле digest ассета или соседний файл <имя>.sha256"""
+        digest = asset.get('digest') or ''
+        if digest.startswith('sha256:'):
+            return digest.split(':', 1)[1].lower()
+        for candidate in release.get('assets', []):
+            if candidate['name'] == f"{asset['name']}.sha256":
+                response = self.session.get(candidate['browser_download_url'], timeout=UPDATE_HTTP_TIMEOUT)
+                response.raise_for_status()
+                return response.text.split()[0].lower()
+        return None
+
+    def download_update(self, release, asset, expected, peers=()):
+        """Загружает файл обновления (сначала у соседей); возвращает путь после проверки SHA-256"""
+        from requests import RequestException
+        os.makedirs(self.download_dir, exist_ok=True)
+        version_tag = release['tag_name'].lstrip('v')
+        update_file = os.path.join(self.download_dir, f"update-{version_tag}.exe")
+        part_file = f"{update_file}.part"
+        if os.path.exists(update_file) and self.file_digest(update_file) == expected:
+            return self.complete_download(version_tag, expected, update_file)
+
+        for peer in peers:
+            url = f"http://{peer[0]}:{peer[1]}/update/{expected}"
+            try:
+                if self.fetch(url, part_file, expected):
+                    logging.info(f"Обновление {version_tag} загружено у соседа {peer[0]}")
+                    self.counters['peer_downloads'] += 1
+                    return self.complete_download(version_tag, expected, part_file)
+            except (RequestException, OSError) as e:
+                logging.warning(f"Не удалось загрузить обновление у соседа {peer[0]}: {e}")
+            self.counters['peer_failures'] += 1
+            self.peers.get(expected, {}).pop(peer, None)
+
+        if not self.fetch(asset['browser_download_url'], part_file, expected):
+            self.notification_manager.show_notification(
+                "Ошибка обновления",
+                "Загруженный файл поврежден"
+            )
+            return None
+        self.counters['wan_downloads'] += 1
+        return self.complete_download(version_tag, expected, part_file)
+
+    def fetch(self, url, part_file, expected):
+        """Загружает url в part_file с докачкой; True, если SHA-256 совпал"""
+        hasher = hashlib.sha256()
+        offset = os.path.getsize(part_file) if os.path.exists(part_file) else 0
+        headers = {'Accept': 'application/octet-stream'}
+        if offset:
+            headers['Range'] = f"bytes={offset}-"
+
+        with self.session.get(url, headers=headers, stream=True, timeout=UPDATE_HTTP_TIMEOUT) as response:
+            if response.status_code == 416 and offset:
+                # Часть уже загружена целиком
+                mode = None
+            elif response.status_code == 206 and offset:
+                logging.info(f"Докачка обновления с {offset} байт")
+                self.counters['bytes_resumed'] += offset
+                mode = 'ab'
+            else:
+                response.raise_for_status()
+                offset = 0
+                mode = 'wb'
+
+            if offset:
+                self.file_digest(part_file, hasher)
+            if mode:
+                with open(part_file, mode) as f:
+                    self.copy_stream(response.raw, f, hasher)
+
+        if hasher.hexdigest() != expected:
+            logging.error(f"Контрольная сумма загрузки {url} не совпадает, файл удален")
+            os.remove(part_file)
+            return False
+        return True
+
+    def complete_download(self, version_tag, expected, path):
+        """Запоминает проверенный файл - после установки он раздается соседям"""
+        update_file = path[:-len('.part')] if path.endswith('.part') else path
+        if path != update_file:
+            os.replace(path, update_file)
+        self.cache['seed'] = {'version': version_tag, 'sha256': expected, 'path': os.path.abspath(update_file)}
+        self.write_cache()
+        return update_file
+
+    def rollout_wait(self, latest_version):
+        """Сколько еще ждать своей доли окна развертывания (секунды)"""
+        rollout = self.cache.setdefault('rollout', {})
+        if latest_version not in rollout:
+            rollout.clear()
+            rollout[latest_version] = time.time()
+            self.write_cache()
+        key = hashlib.sha256(f"{self.hostname}:{latest_version}".encode('utf-8')).digest()
+        share = int.from_bytes(key[:4], 'big') / 2 ** 32
+        return rollout[latest_version] + share * UPDATE_ROLLOUT_WINDOW - time.time()
+
+    def next_check_delay(self):
+        """Интервал до следующей проверки: со случайным разбросом, не позже своей очереди"""
+        delay = UPDATE_CHECK_INTERVAL * random.uniform(1 - UPDATE_CHECK_JITTER, 1 + UPDATE_CHECK_JITTER)
+        if self.next_check_at is not None:
+            delay = min(delay, max(0.0, self.next_check_at - time.time()))
+        return delay
+
+    # --- Раздача соседям ---
+
+    def on_peer_announcement(self, ip, data):
+        """Обрабатывает UPDATE_AVAILABLE из discovery; True, если ждущее обновление появилось у соседей"""
+        announcement = parse_update_announcement(data)
+        if not announcement:
+            return False
+        _, sha256, port = announcement
+        self.peers.setdefault(sha256, {})[(ip, port)] = time.monotonic()
+        return sha256 == self.pending
+
+    def peer_sources(self, sha256):
+        """Соседи, недавно объявившие файл с этим хэшем, в случайном порядке"""
+        known = self.peers.get(sha256, {})
+        expired = time.monotonic() - 3 * UPDATE_ANNOUNCE_INTERVAL
+        for peer in [p for p, seen in known.items() if seen < expired]:
+            del known[peer]
+        peers = list(known)
+        random.shuffle(peers)
+        return peers
+
+    def start_peer_cache(self):
+        """Раздает соседям проверенный файл текущей версии и объявляет о нем"""
+        seed = self.cache.get('seed')
+        if self.peer_server or not seed or seed.get('version') != VERSION:
+            return False
+        path = seed['path']
+        if not os.path.exists(path) or self.file_digest(path) != seed['sha256']:
+            logging.warning("Файл обновления для раздачи отсутствует или поврежден")
+            return False
+        self.remove_stale_downloads(path)
+
+        from http.server import ThreadingHTTPServer
+        handler = peer_update_handler()
         try:
-            # Создаем временную директорию
-            with tempfile.TemporaryDirectory() as temp_dir:
-                # Загружаем новую версию
-                response = requests.get(download_url, stream=True)
-                update_file = os.path.join(temp_dir, "update.exe")
-                
-                with open(update_file, 'wb') as f:
-                    for chunk in response.iter_content(chunk_size=8192):
-                        if chunk:
-                            f.write(chunk)
-
-                # Создаем батник для обновления
-                update_script = os.path.join(temp_dir, "update.bat")
-                current_exe = sys.executable
-                with open(update_script, 'w') as f:
-                    f.write(f'''@echo off
+            server = ThreadingHTTPServer(('', UPDATE_PEER_PORT), handler)
+        except OSError:
+            # Порт занят (второй экземпляр) - берем любой свободный, он попадет в объявление
+            server = ThreadingHTTPServer(('', 0), handler)
+        server.daemon_threads = True
+        server.path = path
+        server.sha256 = seed['sha256']
+        server.bytes_served = 0
+        self.peer_server = server
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        message = f"{UPDATE_ANNOUNCE_PREFIX}{VERSION}:{seed['sha256']}:{server.server_address[1]}".encode('utf-8')
+        self.announce_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.announce_socket.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        if self.timers is None:
+            # Без клиента объявления отправляет свой планировщик
+            self.timers = TimerScheduler()
+            self.timers.start()
+        self.timers.every('update_announce', UPDATE_ANNOUNCE_INTERVAL, lambda: self.announce(message),
+                          delay=0, jitter=0.2)
+        logging.info(f"Раздаем обновление {VERSION} соседям на порту {server.server_address[1]}")
+        return True
+
+    def announce(self, message):
+        """Объявляет о раздаче через UDP discovery (задача таймеров)"""
+        sock = self.announce_socket
+        if sock is None:
+            return
+        for target in self.peer_targets:
+            try:
+                sock.sendto(message, target)
+            except OSError as e:
+                logging.debug(f"Не удалось отправить объявление об обновлении: {e}")
+
+    def stop_peer_cache(self):
+        if self.timers:
+            self.timers.cancel('update_announce')
+        sock, self.announce_socket = self.announce_socket, None
+        if sock:
+            sock.close()
+        server, self.peer_server = self.peer_server, None
+        if server:
+            server.shutdown()
+            server.server_close()
+
+    def remove_stale_downloads(self, keep):
+        """Удаляет загрузки прошлых версий"""
+        try:
+            for name in os.listdir(self.download_dir):
+                path = os.path.join(self.download_dir, name)
+                if name.startswith('update-') and os.path.abspath(path) != keep:
+                    os.remove(path)
+        except OSError as e:
+            logging.debug(f"Не удалось очистить каталог загрузок: {e}")
+
+    def copy_stream(self, raw, f, hasher):
+        """Копирует ответ блоками, подстраивая размер блока под скорость канала"""
+        chunk_size = UPDATE_CHUNK_MIN
+        while True:
+            started = time.perf_counter()
+            chunk = raw.read(chunk_size, decode_content=True)
+            if not chunk:
+                break
+            f.write(chunk)
+            hasher.update(chunk)
+            self.counters['bytes_downloaded'] += len(chunk)
+            elapsed = time.perf_counter() - started
+            if elapsed < 0.05 and chunk_size < UPDATE_CHUNK_MAX:
+                chunk_size *= 2
+            elif elapsed > 0.5 and chunk_size > UPDATE_CHUNK_MIN:
+                chunk_size //= 2
+
+    @staticmethod
+    def file_digest(path, hasher=None):
+        """SHA-256 файла (или дописывает файл в переданный hasher)"""
+        hasher = hasher or hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(UPDATE_CHUNK_MAX), b''):
+                hasher.update(chunk)
+        return hasher.hexdigest()
+
+    def stats(self):
+        """Счетчики проверок, загрузок и раздачи соседям"""
+        server = self.peer_server
+        return dict(self.counters, bytes_served=server.bytes_served if server else 0)
+
+    def install_update(self, update_file):
+        """Запускает замену исполняемого файла и завершает процесс.
+
+        Проверка обновлений идет в пуле потоков, где sys.exit завершил бы только
+        рабочий поток, поэтому клиент останавливается через on_install: run()
+        выходит, и процесс завершается до того, как скрипт заменит файл."""
+        try:
+            # Создаем батник для обновления
+            update_file = os.path.abspath(update_file)
+            update_script = os.path.join(tempfile.gettempdir(), "checkas_update.bat")
+            current_exe = sys.executable
+            with open(update_script, 'w') as f:
+                f.write(f'''@echo off
 timeout /t 2 /nobreak
 copy /Y "{update_file}" "{current_exe}"
 start "" "{current_exe}"
 del "%~f0"
 ''')
 
-                # Запускаем скрипт обновления
-                subprocess.Popen(['cmd', '/c', update_script], 
-                               creationflags=subprocess.CREATE_NO_WINDOW,
-                               cwd=temp_dir)
-                
-                # Завершаем текущий процесс
+            # Запускаем скрипт обновления
+            subprocess.Popen(['cmd', '/c', update_script], 
+                           creationflags=subprocess.CREATE_NO_WINDOW,
+                           cwd=os.path.dirname(update_script))
+            
+            # Завершаем текущий процесс
+            logging.info("Запущена установка обновления, клиент завершает работу")
+            if self.on_install:
+                self.on_install()
+            else:
                 sys.exit(0)
 
         except Exception as e:
@@ -139,29 +680,2010 @@ del "%~f0"
                 "Не удалось установить обновление"
             )
 
+def peer_update_handler():
+    """Класс обработчика раздачи обновления; http.server импортируется только при раздаче"""
+    from http.server import BaseHTTPRequestHandler
+
+    class PeerUpdateHandler(BaseHTTPRequestHandler):
+        """Отдает соседям проверенный файл обновления (GET /update/<sha256>, поддерживает Range)"""
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, format, *args):
+            logging.debug("Раздача обновления %s: " + format, self.client_address[0], *args)
+
+        def do_GET(self):
+            server = self.server
+            if self.path != f"/update/{server.sha256}":
+                self.send_error(404)
+                return
+            size = os.path.getsize(server.path)
+            start = 0
+            match = re.fullmatch(r'bytes=(\d+)-', self.headers.get('Range', ''))
+            if match:
+                start = int(match.group(1))
+                if start >= size:
+                    self.send_response(416)
+                    self.send_header('Content-Range', f"bytes */{size}")
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+            self.send_response(206 if start else 200)
+            if start:
+                self.send_header('Content-Range', f"bytes {start}-{size - 1}/{size}")
+            self.send_header('Content-Length', str(size - start))
+            self.send_header('Accept-Ranges', 'bytes')
+            self.end_headers()
+            with open(server.path, 'rb') as f:
+                f.seek(start)
+                for chunk in iter(lambda: f.read(UPDATE_CHUNK_MAX), b''):
+                    self.wfile.write(chunk)
+                    server.bytes_served += len(chunk)
+
+    return PeerUpdateHandler
+
+def get_file_fingerprint(path):
+    """Возвращает отпечаток файла (mtime, size, inode) или None, если файла нет"""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+class FileWatcher(abc.ABC):
+    """Базовый наблюдатель за файлом: вызывает callback только при изменении отпечатка"""
+    name = "base"
+
+    def __init__(self, path, callback, debounce=DND_DEBOUNCE):
+        self.path = os.path.abspath(path)
+        self.directory = os.path.dirname(self.path)
+        self.filename = os.path.basename(self.path)
+        self.callback = callback
+        self.debounce = debounce
+        self.last_fingerprint = get_file_fingerprint(self.path)
+        self.running = False
+        self.thread = None
+
+    @classmethod
+    def is_supported(cls):
+        return True
+
+    def start(self):
+        """Запускает поток наблюдения"""
+        if self.running:
+            return
+        self.running = True
+        self.thread = threading.Thread(target=self._run_safe, daemon=True)
+        self.thread.start()
+        logging.info(f"Запущено отслеживание {self.path} (backend: {self.name})")
+
+    def stop(self):
+        """Останавливает наблюдение и дожидается завершения потока"""
+        if not self.running:
+            return
+        self.running = False
+        self._wakeup()
+        if self.thread and self.thread is not threading.current_thread():
+            self.thread.join(timeout=2)
+        self.thread = None
+
+    def check(self):
+        """Сравнивает отпечаток файла с предыдущим и вызывает callback при изменении"""
+        fingerprint = get_file_fingerprint(self.path)
+        if fingerprint == self.last_fingerprint:
+            return False
+        self.last_fingerprint = fingerprint
+        try:
+            self.callback(self.path)
+        except Exception as e:
+            logging.error(f"Ошибка в обработчике изменения файла: {e}")
+        return True
+
+    def _run_safe(self):
+        try:
+            self._run()
+        except Exception as e:
+            logging.error(f"Ошибка наблюдателя {self.name}: {e}")
+        finally:
+            self._close()
+
+    @abc.abstractmethod
+    def _run(self):
+        """Цикл наблюдения (в потоке наблюдателя), пока self.running"""
+
+    def _wakeup(self):
+        pass
+
+    def _close(self):
+        pass
+
+class PollingWatcher(FileWatcher):
+    """Резервный наблюдатель: периодический stat() без чтения содержимого файла.
+
+    С планировщиком таймеров опрос - его задача, без него - свой поток."""
+    name = "polling"
+
+    def __init__(self, path, callback, debounce=DND_DEBOUNCE, interval=DND_POLL_INTERVAL, timers=None):
+        super().__init__(path, callback, debounce)
+        self.interval = interval
+        self.timers = timers
+        self.job_name = f"watch:{self.path}"
+        self.pending = None  # Отпечаток, который ждет окончания серии записей
+        self._stop_event = threading.Event()
+
+    def start(self):
+        if self.timers is None:
+            return super().start()
+        if self.running:
+            return
+        self.running = True
+        self.timers.every(self.job_name, self.interval, self.poll)
+        logging.info(f"Запущено отслеживание {self.path} (backend: {self.name}, таймер)")
+
+    def stop(self):
+        if self.timers is None:
+            return super().stop()
+        self.running = False
+        self.timers.cancel(self.job_name)
+
+    def poll(self):
+        """Одна проверка; возвращает задержку до следующей"""
+        fingerprint = get_file_fingerprint(self.path)
+        if fingerprint == self.last_fingerprint:
+            self.pending = None
+            return self.interval
+        if fingerprint != self.pending:
+            # Ждем, пока серия записей закончится
+            self.pending = fingerprint
+            return self.debounce
+        self.pending = None
+        if self.running:
+            self.check()
+        return self.interval
+
+    def _run(self):
+        self._stop_event.clear()
+        delay = self.interval
+        while not self._stop_event.wait(delay):
+            delay = self.poll()
+
+    def _wakeup(self):
+        self._stop_event.set()
+
+class InotifyWatcher(FileWatcher):
+    """Наблюдатель на inotify (Linux): поток спит в select() до изменения каталога"""
+    name = "inotify"
+
+    IN_MODIFY = 0x00000002
+    IN_ATTRIB = 0x00000004
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_Q_OVERFLOW = 0x00004000
+    WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM |
+                  IN_MOVED_TO | IN_CREATE | IN_DELETE)
+    EVENT_HEADER = struct.Struct('iIII')
+
+    _libc = None
+
+    @classmethod
+    def is_supported(cls):
+        if not sys.platform.startswith('linux'):
+            return False
+        if cls._libc is None:
+            try:
+                libc = ctypes.CDLL(ctypes.util.find_library('c') or None, use_errno=True)
+                libc.inotify_init1
+                cls._libc = libc
+            except (OSError, AttributeError):
+                return False
+        return True
+
+    def __init__(self, path, callback, debounce=DND_DEBOUNCE):
+        super().__init__(path, callback, debounce)
+        if not self.is_supported():
+            raise OSError("inotify недоступен")
+        self.fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(self.directory), self.WATCH_MASK)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(errno, f"inotify_add_watch failed for {self.directory}")
+        self._wake_r, self._wake_w = os.pipe()
+
+    def _drain(self):
+        """Читает накопленные события и возвращает True, если они касаются нашего файла"""
+        relevant = False
+        while True:
+            try:
+                data = os.read(self.fd, 4096)
+            except BlockingIOError:
+                return relevant
+            offset = 0
+            while offset + self.EVENT_HEADER.size <= len(data):
+                _, mask, _, length = self.EVENT_HEADER.unpack_from(data, offset)
+                offset += self.EVENT_HEADER.size
+                name = data[offset:offset + length].rstrip(b'\0')
+                offset += length
+                if mask & self.IN_Q_OVERFLOW or os.fsdecode(name) == self.filename:
+                    relevant = True
+
+    def _run(self):
+        while self.running:
+            readable, _, _ = select.select([self.fd, self._wake_r], [], [])
+            if self._wake_r in readable:
+                return
+            if not self._drain():
+                continue
+            # Debounce: ждем тишины в течение self.debounce
+            while True:
+                readable, _, _ = select.select([self.fd, self._wake_r], [], [], self.debounce)
+                if not readable:
+                    break
+                if self._wake_r in readable:
+                    return
+                self._drain()
+            self.check()
+
+    def _wakeup(self):
+        try:
+            os.write(self._wake_w, b'x')
+        except OSError:
+            pass
+
+    def _close(self):
+        for fd in (self.fd, self._wake_r, self._wake_w):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+class Win32ChangeWatcher(FileWatcher):
+    """Наблюдатель на FindFirstChangeNotification (Windows): без опроса файла"""
+    name = "win32"
+
+    FILE_NOTIFY_CHANGE_FILE_NAME = 0x00000001
+    FILE_NOTIFY_CHANGE_SIZE = 0x00000008
+    FILE_NOTIFY_CHANGE_LAST_WRITE = 0x00000010
+    WAIT_OBJECT_0 = 0x00000000
+    WAIT_TIMEOUT = 0x00000102
+    INFINITE = 0xFFFFFFFF
+    INVALID_HANDLE_VALUE = ctypes.c_void_p(-1).value
+
+    @classmethod
+    def is_supported(cls):
+        return platform.system() == 'Windows'
+
+    def __init__(self, path, callback, debounce=DND_DEBOUNCE):
+        super().__init__(path, callback, debounce)
+        kernel32 = ctypes.windll.kernel32
+        kernel32.FindFirstChangeNotificationW.restype = ctypes.c_void_p
+        kernel32.FindFirstChangeNotificationW.argtypes = [ctypes.c_wchar_p, ctypes.c_int, ctypes.c_uint32]
+        kernel32.FindNextChangeNotification.argtypes = [ctypes.c_void_p]
+        kernel32.FindCloseChangeNotification.argtypes = [ctypes.c_void_p]
+        kernel32.CreateEventW.restype = ctypes.c_void_p
+        kernel32.SetEvent.argtypes = [ctypes.c_void_p]
+        kernel32.CloseHandle.argtypes = [ctypes.c_void_p]
+        kernel32.WaitForMultipleObjects.argtypes = [ctypes.c_uint32, ctypes.c_void_p,
+                                                    ctypes.c_int, ctypes.c_uint32]
+        kernel32.WaitForMultipleObjects.restype = ctypes.c_uint32
+        self.kernel32 = kernel32
+        self.change_handle = kernel32.FindFirstChangeNotificationW(
+            self.directory, False,
+            self.FILE_NOTIFY_CHANGE_FILE_NAME | self.FILE_NOTIFY_CHANGE_SIZE |
+            self.FILE_NOTIFY_CHANGE_LAST_WRITE
+        )
+        if not self.change_handle or self.change_handle == self.INVALID_HANDLE_VALUE:
+            raise OSError(f"FindFirstChangeNotification failed for {self.directory}")
+        self.stop_handle = kernel32.CreateEventW(None, True, False, None)
+        self.handles = (ctypes.c_void_p * 2)(self.stop_handle, self.change_handle)
+
+    def _wait(self, timeout):
+        return self.kernel32.WaitForMultipleObjects(2, self.handles, False, timeout)
+
+    def _run(self):
+        while self.running:
+            result = self._wait(self.INFINITE)
+            if result != self.WAIT_OBJECT_0 + 1:
+                return
+            self.kernel32.FindNextChangeNotification(self.change_handle)
+            # Debounce: ждем тишины в течение self.debounce
+            while True:
+                result = self._wait(int(self.debounce * 1000))
+                if result == self.WAIT_TIMEOUT:
+                    break
+                if result != self.WAIT_OBJECT_0 + 1:
+                    return
+                self.kernel32.FindNextChangeNotification(self.change_handle)
+            self.check()
+
+    def _wakeup(self):
+        self.kernel32.SetEvent(self.stop_handle)
+
+    def _close(self):
+        self.kernel32.FindCloseChangeNotification(self.change_handle)
+        self.kernel32.CloseHandle(self.stop_handle)
+
+WATCHER_BACKENDS = [Win32ChangeWatcher, InotifyWatcher]
+
+def create_file_watcher(path, callback, debounce=DND_DEBOUNCE, poll_interval=DND_POLL_INTERVAL, timers=None):
+    """Создает наблюдатель с нативным backend, при недоступности - polling"""
+    for backend in WATCHER_BACKENDS:
+        if not backend.is_supported():
+            continue
+        try:
+            return backend(path, callback, debounce)
+        except Exception as e:
+            logging.warning(f"Backend {backend.name} недоступен: {e}")
+    return PollingWatcher(path, callback, debounce, poll_interval, timers)
+
+def detect_ini_encoding(raw):
+    """Определяет кодировку ini-файла, возвращает (кодировка, длина BOM)"""
+    if raw.startswith(codecs.BOM_UTF8):
+        return 'utf-8', len(codecs.BOM_UTF8)
+    if raw.startswith(codecs.BOM_UTF16_LE):
+        return 'utf-16-le', len(codecs.BOM_UTF16_LE)
+    if raw.startswith(codecs.BOM_UTF16_BE):
+        return 'utf-16-be', len(codecs.BOM_UTF16_BE)
+    # Без BOM UTF-16 выдает себя нулевыми байтами в ASCII-символах
+    sample = raw[:4096]
+    if sample and sample.count(0) > len(sample) // 4:
+        if sample[1::2].count(0) >= sample[0::2].count(0):
+            return 'utf-16-le', 0
+        return 'utf-16-be', 0
+    try:
+        raw.decode('utf-8')
+        return 'utf-8', 0
+    except UnicodeDecodeError:
+        return 'cp1251', 0
+
+class IniReader:
+    """Кэширующий читатель ini-файла.
+
+    Файл разбирается только при изменении отпечатка (mtime, size, inode).
+    Кодировка определяется один раз для inode. Запрошенный ключ ищется
+    по байтам файла в его кодировке: декодируется только найденная строка,
+    поиск останавливается на первом совпадении. Для ключа хранится байтовое
+    смещение строки, поэтому перезапись файла без изменения размера
+    (например, DND=0 -> DND=1) читается точечно.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.fingerprint = None
+        self.encoding = None
+        self.bom_length = 0
+        self.values = {}  # ключ -> значение для текущего отпечатка
+        self.missing = set()  # ключи, которых нет в текущей версии файла
+        self.offsets = {}  # ключ -> (начало, конец) строки "KEY=value" в байтах
+        self.patterns = {}  # ключ -> регулярное выражение строки ключа
+
+    def get(self, key, default=None):
+        """Возвращает значение ключа; FileNotFoundError, если файла нет"""
+        with self.lock:
+            fingerprint = get_file_fingerprint(self.path)
+            if fingerprint is None:
+                self._reset()
+                raise FileNotFoundError(self.path)
+            if fingerprint != self.fingerprint:
+                self._invalidate(fingerprint)
+            if key in self.values:
+                return self.values[key]
+            if key in self.missing:
+                return default
+            value = self._read_at_offset(key)
+            if value is None:
+                value = self._parse(key)
+            if value is None:
+                self.missing.add(key)
+                return default
+            self.values[key] = value
+            return value
+
+    def _reset(self):
+        self.fingerprint = None
+        self.encoding = None
+        self.values = {}
+        self.missing = set()
+        self.offsets = {}
+
+    def _invalidate(self, fingerprint):
+        old = self.fingerprint
+        if old is None or old[2] != fingerprint[2]:
+            # Другой файл - заново определяем кодировку
+            self.encoding = None
+            self.offsets = {}
+        elif old[1] != fingerprint[1]:
+            # Размер изменился - смещения больше не верны
+            self.offsets = {}
+        self.fingerprint = fingerprint
+        self.values = {}
+        self.missing = set()
+
+    def _read_at_offset(self, key):
+        """Точечно читает строку ключа по сохраненному смещению"""
+        if key not in self.offsets or not self.encoding:
+            return None
+        start, end = self.offsets[key]
+        unit = 2 if self.encoding.startswith('utf-16') else 1
+        begin = max(start - unit, self.bom_length)
+        try:
+            with open(self.path, 'rb') as f:
+                f.seek(begin)
+                chunk = f.read(end + unit - begin)
+            text = chunk.decode(self.encoding)
+        except (OSError, UnicodeError):
+            return None
+        if begin < start:
+            if text[:1] not in ('\n', '\r'):
+                return None
+            text = text[1:]
+        prefix = f"{key}="
+        if not text.startswith(prefix) or text[-1:] not in ('\n', '\r'):
+            return None
+        value = text[len(prefix):-1]
+        if '\n' in value or '\r' in value:
+            return None
+        return value.strip()
+
+    def _parse(self, key):
+        """Ищет первую строку ключа во всем файле; значение или None"""
+        with open(self.path, 'rb') as f:
+            raw = f.read()
+        if not self.encoding:
+            self.encoding, self.bom_length = detect_ini_encoding(raw)
+        found = self._search(raw, key)
+        if found is None:
+            # Файл могли перезаписать в другой кодировке под тем же inode
+            encoding = detect_ini_encoding(raw)
+            if encoding != (self.encoding, self.bom_length):
+                self.encoding, self.bom_length = encoding
+                self.offsets = {}
+                found = self._search(raw, key)
+        if found is None:
+            self.offsets.pop(key, None)
+            return None
+        value, self.offsets[key] = found
+        return value
+
+    def _search(self, raw, key):
+        """Первая строка "key=value" (допускаются пробелы вокруг ключа): (значение, смещения) или None"""
+        encoding = self.encoding
+        unit = 2 if encoding.startswith('utf-16') else 1
+        needle = key.encode(encoding)
+        newline = '\n'.encode(encoding)
+        pattern = self.patterns.get(key)
+        if pattern is None:
+            pattern = self.patterns[key] = re.compile(r'([ \t]*)(' + re.escape(key) + r')[ \t]*=([^\r\n]*)')
+        position = raw.find(needle, self.bom_length)
+        while position != -1:
+            if (position - self.bom_length) % unit == 0:
+                line_start = self._line_start(raw, newline, position, unit)
+                line_end = self._line_end(raw, newline, position, unit)
+                line = raw[line_start:line_end].decode(encoding, errors='replace')
+                match = pattern.match(line)
+                if match:
+                    byte_start = line_start + len(match.group(1).encode(encoding))
+                    byte_end = line_start + len(line[:match.end()].encode(encoding))
+                    return match.group(3).strip(), (byte_start, byte_end)
+            position = raw.find(needle, position + 1)
+        return None
+
+    def _line_start(self, raw, newline, position, unit):
+        start = raw.rfind(newline, self.bom_length, position)
+        while start != -1 and (start - self.bom_length) % unit:
+            start = raw.rfind(newline, self.bom_length, start)
+        return self.bom_length if start == -1 else start + len(newline)
+
+    def _line_end(self, raw, newline, position, unit):
+        end = raw.find(newline, position)
+        while end != -1 and (end - self.bom_length) % unit:
+            end = raw.find(newline, end + 1)
+        return len(raw) if end == -1 else end
+
+class OfflineOutbox:
+    """Состояние, накопленное, пока нет связи с сервером.
+
+    Хранит только сообщения о состоянии: dnd_status: и события уведомлений
+    (последнее событие на каждое уведомление). На каждый ключ остается одно,
+    последнее значение, поэтому после переподключения уходит одна короткая
+    пачка, а не вся очередь изменений. Все переходы с отметками времени
+    пишутся в ограниченную историю - ее получает сервер, объявивший
+    history=zlib. Ответы на команды и ping не копятся: после разрыва они
+    никому не нужны.
+    """
+
+    def __init__(self, max_keys=OUTBOX_MAX_KEYS, history_size=OUTBOX_HISTORY_SIZE):
+        self.max_keys = max_keys
+        self.lock = threading.Lock()
+        self.latest = {}  # ключ -> сообщение (порядок - по времени последнего изменения)
+        self.history = deque(maxlen=history_size)  # (время, сообщение)
+        self.counters = {'recorded': 0, 'compacted': 0, 'evicted': 0, 'flushed': 0}
+
+    @staticmethod
+    def key(message):
+        """Ключ состояния сообщения или None, если сообщение не копится"""
+        identity, message = parse_addressed(message)
+        if identity is not None:
+            key = OfflineOutbox.key(message)
+            return f"@{identity} {key}" if key else None
+        if message.startswith("dnd_status:"):
+            return "dnd_status"
+        if message.startswith("message_") and ':' in message:
+            # message_shown:id[:причина] - важно только последнее событие уведомления
+            return "message:" + message.split(':', 2)[1]
+        return None
+
+    def record(self, message, at=None):
+        """Запоминает сообщение; False, если оно не относится к состоянию"""
+        key = self.key(message)
+        if key is None:
+            return False
+        with self.lock:
+            if self.latest.pop(key, None) is not None:
+                self.counters['compacted'] += 1
+            elif len(self.latest) >= self.max_keys:
+                del self.latest[next(iter(self.latest))]
+                self.counters['evicted'] += 1
+            self.latest[key] = message
+            self.history.append((time.time() if at is None else at, message))
+            self.counters['recorded'] += 1
+        return True
+
+    def drain(self):
+        """Забирает сжатое состояние и историю: ([сообщения], [(время, сообщение)])"""
+        with self.lock:
+            messages, self.latest = list(self.latest.values()), {}
+            history = list(self.history)
+            self.history.clear()
+            self.counters['flushed'] += len(messages)
+        return messages, history
+
+    def __len__(self):
+        with self.lock:
+            return len(self.latest)
+
+    def stats(self):
+        with self.lock:
+            result = dict(self.counters)
+            result['pending'] = len(self.latest)
+            return result
+
+class ProcessDetector:
+    """Дешевая проверка, запущен ли MicroSIP.
+
+    Пока процесс не найден, вызов обходит список процессов
+    (backend.find_process); найденный PID запоминается, и дальше проверяется
+    только он (backend.process_alive). Обход пропускается, если метка
+    backend.process_generation() не менялась с двух последних обходов: новых
+    процессов не было, а второй обход уже перечитал имена процессов,
+    застанных между fork и exec. Бэкенд - любой объект с этими методами
+    (process_generation необязателен), поэтому детектор легко подменить в тестах.
+    """
+
+    def __init__(self, backend, image_name=MICROSIP_PROCESS):
+        self.backend = backend
+        self.image_name = image_name
+        self.pid = None
+        self.generation = None  # Метка списка процессов при последнем обходе
+        self.settled = False  # Метка не менялась между двумя последними обходами
+        self.lock = threading.Lock()
+        self.counters = {'scans': 0, 'pid_checks': 0, 'skipped_scans': 0}
+
+    def running(self):
+        """True/False; None, если платформа не позволяет узнать"""
+        with self.lock:
+            return self._probe()
+
+    def _probe(self):
+        if self.pid:
+            self.counters['pid_checks'] += 1
+            if self.backend.process_alive(self.pid, self.image_name):
+                return True
+            self.pid = None
+        generation = getattr(self.backend, 'process_generation', lambda: None)()
+        if generation is not None and generation == self.generation and self.settled:
+            self.counters['skipped_scans'] += 1
+            return False
+        self.counters['scans'] += 1
+        pid = self.backend.find_process(self.image_name)
+        if pid is None:
+            return None
+        self.settled = generation is not None and generation == self.generation
+        self.generation = generation
+        self.pid = pid or None
+        return bool(pid)
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters, pid=self.pid)
+
+class StatusSnapshot:
+    """Компактный снимок статуса: DND, запущен ли MicroSIP, учетная запись"""
+    __slots__ = ('dnd', 'running', 'account', 'taken_at')
+
+    def __init__(self, dnd, running=None, account=None, taken_at=0.0):
+        self.dnd = dnd  # "0" или "1"
+        self.running = running  # True/False, None - неизвестно
+        self.account = account  # 'configured', 'none' или None - неизвестно
+        self.taken_at = taken_at
+
+    def as_dict(self):
+        return {'dnd': self.dnd, 'running': self.running, 'account': self.account}
+
+class StatusService:
+    """Общий для всех читателей снимок статуса.
+
+    Снимок, снятый не раньше чем ttl секунд назад, отдается без обращения к
+    диску. Если снимок устарел, его перечитывает только первый пришедший
+    поток, а остальные ждут его результат (single-flight). invalidate()
+    вызывается наблюдателем за файлом, поэтому изменения видны сразу. С
+    нативным наблюдателем ttl = None: снимок живет до invalidate(), и опросы
+    сервера с любым интервалом не трогают диск; ttl нужен только при опросе
+    файла по таймеру.
+    """
+
+    def __init__(self, read_snapshot, ttl=STATUS_TTL, clock=time.monotonic):
+        self.read_snapshot = read_snapshot
+        self.ttl = ttl
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.snapshot = None
+        self.refreshing = None  # Event текущего обновления
+        self.generation = 0  # Растет при каждом invalidate()
+        self.counters = {'hits': 0, 'refreshes': 0, 'coalesced': 0}
+
+    def get(self):
+        """Свежий снимок статуса (из кэша или перечитанный)"""
+        with self.lock:
+            snapshot = self.snapshot
+            if snapshot is not None and (self.ttl is None or self.clock() - snapshot.taken_at <= self.ttl):
+                self.counters['hits'] += 1
+                return snapshot
+            done = self.refreshing
+            if done is None:
+                self.refreshing = done = threading.Event()
+                generation = self.generation
+                leader = True
+            else:
+                self.counters['coalesced'] += 1
+                leader = False
+
+        if not leader:
+            done.wait(10)
+            snapshot = self.snapshot
+            return snapshot if snapshot is not None else self._read()
+
+        snapshot = None
+        try:
+            snapshot = self._read()
+            return snapshot
+        finally:
+            with self.lock:
+                # Снимок, начатый до invalidate(), мог прочитать старый файл - не кэшируем
+                if snapshot is not None and generation == self.generation:
+                    self.snapshot = snapshot
+                self.refreshing = None
+            done.set()
+
+    def _read(self):
+        started = self.clock()
+        snapshot = self.read_snapshot()
+        snapshot.taken_at = started
+        with self.lock:
+            self.counters['refreshes'] += 1
+        return snapshot
+
+    def set_ttl(self, ttl):
+        """None - снимок живет до invalidate() (изменения сообщает нативный наблюдатель)"""
+        with self.lock:
+            self.ttl = ttl
+
+    def invalidate(self):
+        """Сбрасывает снимок (файл настроек изменился)"""
+        with self.lock:
+            self.snapshot = None
+            self.generation += 1
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters)
+
+class ProfileSession:
+    """Профиль MicroSIP одного пользователя в режиме службы"""
+    __slots__ = ('user', 'identity', 'path', 'reader', 'last_dnd_status')
+
+    def __init__(self, user, identity, path):
+        self.user = user
+        self.identity = identity
+        self.path = path
+        self.reader = IniReader(path)
+        self.last_dnd_status = None  # Последний отправленный серверу статус
+
+    def dnd_status(self):
+        """Статус DND пользователя; None, если профиля уже нет"""
+        try:
+            value = self.reader.get('DND')
+        except FileNotFoundError:
+            return None
+        return value if value is not None and value.isdigit() else "1"
+
+    def snapshot(self):
+        try:
+            account_id = self.reader.get('accountId')
+        except FileNotFoundError:
+            return StatusSnapshot(None, None, None)
+        account = 'configured' if account_id and account_id.strip() not in ('', '0') else 'none'
+        return StatusSnapshot(self.dnd_status(), None, account)
+
+class SessionRegistry:
+    """Профили пользователей хоста, которые служба обслуживает через одно соединение.
+
+    Профили находятся по шаблону пути, где '*' - каталог пользователя, и
+    пересканируются раз в scan_interval. На профиль приходится только
+    IniReader: poll() делает один stat() на профиль, а файл перечитывается,
+    только если он изменился, поэтому ни потоков, ни сокетов на пользователя
+    не добавляется.
+    """
+
+    def __init__(self, pattern, hostname, scan_interval=SERVICE_SCAN_INTERVAL, clock=time.monotonic):
+        self.pattern = pattern
+        self.hostname = hostname
+        self.scan_interval = scan_interval
+        self.clock = clock
+        parts = re.split(r'[\\/]', pattern)
+        self.user_part = next((i for i, part in enumerate(parts) if '*' in part), None)
+        self.lock = threading.RLock()
+        self.sessions = {}  # identity -> ProfileSession
+        self.next_scan = 0.0
+        self.counters = {'scans': 0, 'opened': 0, 'closed': 0, 'changes': 0}
+
+    def identity(self, user):
+        """Идентичность пользователя для сервера: user@hostname (без пробелов)"""
+        return re.sub(r'\s', '_', f"{user}@{self.hostname}")
+
+    def user_for(self, path):
+        parts = re.split(r'[\\/]', path)
+        if self.user_part is None or self.user_part >= len(parts):
+            return os.path.basename(os.path.dirname(path))
+        return parts[self.user_part]
+
+    def scan(self):
+        """Сверяет профили с диском; возвращает (открытые сессии, identity закрытых)"""
+        found = {}
+        for path in glob.glob(self.pattern):
+            session = ProfileSession(self.user_for(path), None, path)
+            session.identity = self.identity(session.user)
+            found[session.identity] = session
+        with self.lock:
+            self.counters['scans'] += 1
+            self.next_scan = self.clock() + self.scan_interval
+            opened = [found[i] for i in found if i not in self.sessions]
+            closed = [i for i in self.sessions if i not in found]
+            for identity in closed:
+                del self.sessions[identity]
+            for session in opened:
+                self.sessions[session.identity] = session
+            self.counters['opened'] += len(opened)
+            self.counters['closed'] += len(closed)
+        if opened or closed:
+            logging.info(f"Профили пользователей: +{len(opened)} -{len(closed)}, всего {len(self.sessions)}")
+        return opened, closed
+
+    def poll(self):
+        """Изменения с прошлого вызова: (открытые, закрытые, [(сессия, новый статус)])"""
+        opened, closed = self.scan() if self.clock() >= self.next_scan else ([], [])
+        changed = []
+        with self.lock:
+            for session in self.sessions.values():
+                status = session.dnd_status()
+                if status is not None and status != session.last_dnd_status:
+                    changed.append((session, status))
+            self.counters['changes'] += len(changed)
+        return opened, closed, changed
+
+    def get(self, identity):
+        with self.lock:
+            return self.sessions.get(identity)
+
+    def all(self):
+        with self.lock:
+            return list(self.sessions.values())
+
+    def __len__(self):
+        with self.lock:
+            return len(self.sessions)
+
+    def stats(self):
+        with self.lock:
+            result = dict(self.counters)
+            result['sessions'] = len(self.sessions)
+            return result
+
+class OutboundQueue:
+    """Очередь исходящих сообщений с единственным потоком-писателем.
+
+    Сообщения из любых потоков ставятся в ограниченную очередь, писатель
+    забирает все накопленное и отправляет одним sendall. Устаревшие сообщения
+    схлопываются: в очереди остается только последний dnd_status:, а ping
+    не ставится, если отправка и так ожидается.
+    """
+
+    def __init__(self, sock, on_error, maxsize=OUTBOUND_QUEUE_SIZE, on_sent=None, metrics=None):
+        self.sock = sock
+        self.on_error = on_error
+        self.on_sent = on_sent
+        self.metrics = metrics
+        self.maxsize = maxsize
+        self.condition = threading.Condition()
+        self.queue = deque()  # элементы: [ключ схлопывания, сообщение, время постановки]
+        self.closed = False
+        self.thread = None
+        # Метрики
+        self.max_depth = 0
+        self.frames_sent = 0
+        self.batches_sent = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+    @staticmethod
+    def coalesce_key(message):
+        """Ключ, по которому новое сообщение заменяет ожидающее в очереди"""
+        if message == "ping":
+            return "ping"
+        if message.startswith("dnd_status:"):
+            return "dnd_status"
+        return None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def put(self, message):
+        """Ставит сообщение в очередь; False, если очередь закрыта или переполнена"""
+        key = self.coalesce_key(message)
+        with self.condition:
+            if self.closed:
+                return False
+            if key == "ping" and self.queue:
+                # Любой ожидающий кадр и так подтвердит живость соединения
+                self.coalesced += 1
+                return True
+            if key:
+                for item in self.queue:
+                    if item[0] == key:
+                        item[1] = message
+                        self.coalesced += 1
+                        return True
+            if len(self.queue) >= self.maxsize:
+                self.dropped += 1
+                return False
+            self.queue.append([key, message, time.perf_counter()])
+            self.max_depth = max(self.max_depth, len(self.queue))
+            self.condition.notify()
+            return True
+
+    def close(self):
+        """Останавливает писателя; неотправленные сообщения отбрасываются"""
+        with self.condition:
+            self.closed = True
+            self.queue.clear()
+            self.condition.notify()
+
+    def join(self, timeout=1.0):
+        if self.thread and self.thread is not threading.current_thread():
+            self.thread.join(timeout)
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.queue and not self.closed:
+                    self.condition.wait()
+                if self.closed:
+                    return
+                batch = list(self.queue)
+                self.queue.clear()
+
+            try:
+                self.sock.sendall(b''.join(encode_frame(item[1]) for item in batch))
+            except socket.timeout:
+                logging.error("Таймаут при отправке сообщения")
+                self._fail()
+                return
+            except Exception as e:
+                logging.error(f"Ошибка при отправке сообщения: {str(e)}")
+                self._fail()
+                return
+
+            now = time.perf_counter()
+            if self.on_sent:
+                self.on_sent()
+            with self.condition:
+                self.batches_sent += 1
+                self.frames_sent += len(batch)
+                for item in batch:
+                    latency = now - item[2]
+                    self.latency_total += latency
+                    self.latency_max = max(self.latency_max, latency)
+            if self.metrics:
+                for item in batch:
+                    self.metrics.send_latency.observe(now - item[2])
+
+    def _fail(self):
+        with self.condition:
+            if self.closed:
+                return
+            self.closed = True
+            self.queue.clear()
+        if self.metrics:
+            self.metrics.send_failures.labels('socket_error').inc()
+        self.on_error()
+
+    def stats(self):
+        """Глубина очереди и задержка отправки"""
+        with self.condition:
+            return {
+                'depth': len(self.queue),
+                'max_depth': self.max_depth,
+                'frames_sent': self.frames_sent,
+                'batches_sent': self.batches_sent,
+                'coalesced': self.coalesced,
+                'dropped': self.dropped,
+                'latency_avg_ms': self.latency_total / self.frames_sent * 1000 if self.frames_sent else 0.0,
+                'latency_max_ms': self.latency_max * 1000,
+            }
+
+class TimerJob:
+    """Задача планировщика таймеров"""
+    __slots__ = ('name', 'func', 'interval', 'jitter', 'slack', 'executor', 'scheduled_at', 'deadline',
+                 'due_by', 'generation', 'running', 'triggered', 'cancelled', 'runs')
+
+    def __init__(self, name, func, interval, jitter=0.0, slack=None, executor=None):
+        self.name = name
+        self.func = func
+        self.interval = interval  # None - разовая задача
+        self.jitter = jitter  # Разброс интервала (0.2 = +-20%)
+        self.slack = slack  # Допустимое опоздание (None - доля задержки, см. TIMER_SLACK)
+        self.executor = executor  # Пул для блокирующих задач (None - в потоке планировщика)
+        self.scheduled_at = None
+        self.deadline = None
+        self.due_by = None
+        self.generation = 0  # Актуальна только запись кучи с этим поколением
+        self.running = False
+        self.triggered = False
+        self.cancelled = False
+        self.runs = 0
+
+class TimerScheduler:
+    """Планировщик периодической работы: одна куча сроков вместо циклов со sleep.
+
+    Задачи лежат в куче по крайнему сроку - сроку плюс допустимое опоздание
+    (по умолчанию доля задержки). Планировщик просыпается к ближайшему
+    крайнему сроку и выполняет все задачи, чей срок уже наступил, поэтому
+    близкие сроки объединяются в одно пробуждение. Функция задачи может
+    вернуть задержку до следующего запуска; иначе задача повторяется через
+    интервал с разбросом jitter, а без интервала выполняется один раз.
+    Интервал меняется на ходу (set_interval), задачу можно запустить сразу
+    (trigger) или отменить - изменения будят планировщик немедленно.
+    Блокирующие задачи выполняются в executor и не задерживают остальные.
+
+    Выполнять задачи может поток (run, start) или цикл событий asyncio
+    (run_async). Часы и генератор случайных чисел подменяются, а
+    next_wakeup() и run_due() позволяют прокручивать время вперед без
+    потоков и ожидания.
+    """
+
+    def __init__(self, clock=time.monotonic, rng=None):
+        self.clock = clock
+        self.rng = rng or random.Random()
+        self.condition = threading.Condition()
+        self.heap = []  # (крайний срок, порядковый номер, поколение, задача)
+        self.jobs = {}
+        self.sequence = 0
+        self.stopped = False
+        self.notify = None  # Будит run_async из других потоков
+        self.thread = None
+        # Счетчики
+        self.wakeups = 0
+        self.batches = 0
+        self.runs = 0
+
+    def every(self, name, interval, func, delay=None, jitter=0.0, slack=None, executor=None):
+        """Добавляет задачу (или заменяет одноименную); первый запуск - через delay, по умолчанию через интервал"""
+        job = TimerJob(name, func, interval, jitter, slack, executor)
+        with self.condition:
+            previous = self.jobs.get(name)
+            if previous:
+                previous.cancelled = True
+            self.jobs[name] = job
+            self._schedule(job, self.clock(), interval if delay is None else delay, jitter=delay is None)
+        return job
+
+    def call_later(self, name, delay, func, executor=None):
+        """Разовая задача (вернув задержку, функция запланирует себя снова)"""
+        return self.every(name, None, func, delay=delay, executor=executor)
+
+    def set_interval(self, name, interval):
+        """Меняет интервал задачи; ближайший срок отсчитывается от прошлого планирования"""
+        with self.condition:
+            job = self.jobs.get(name)
+            if not job:
+                return False
+            job.interval = interval
+            if not job.running and interval is not None:
+                self._schedule(job, job.scheduled_at, interval, jitter=False)
+            return True
+
+    def trigger(self, name):
+        """Запускает задачу как можно скорее (выполняющуюся - сразу после завершения)"""
+        with self.condition:
+            job = self.jobs.get(name)
+            if not job:
+                return False
+            if job.running:
+                job.triggered = True
+            else:
+                self._schedule(job, self.clock(), 0, jitter=False)
+            return True
+
+    def cancel(self, *names):
+        """Отменяет задачи; выполняющаяся задача доработает, но не повторится"""
+        with self.condition:
+            for name in names:
+                job = self.jobs.pop(name, None)
+                if job:
+                    job.cancelled = True
+
+    def _schedule(self, job, now, delay, jitter=True):
+        if jitter and job.jitter:
+            delay *= self.rng.uniform(1 - job.jitter, 1 + job.jitter)
+        delay = max(0.0, delay)
+        job.generation += 1
+        job.scheduled_at = now
+        job.deadline = now + delay
+        job.due_by = job.deadline + (job.slack if job.slack is not None else min(TIMER_MAX_SLACK, delay * TIMER_SLACK))
+        self.sequence += 1
+        entry = (job.due_by, self.sequence, job.generation, job)
+        heapq.heappush(self.heap, entry)
+        if self.heap[0] is entry:
+            # Новый ближайший срок - ждущий планировщик должен пересчитать таймаут
+            self.condition.notify_all()
+            if self.notify:
+                self.notify()
+
+    @staticmethod
+    def _current(entry):
+        _, _, generation, job = entry
+        return generation == job.generation and not job.cancelled and not job.running
+
+    def _drop_stale(self):
+        while self.heap and not self._current(self.heap[0]):
+            heapq.heappop(self.heap)
+
+    def next_wakeup(self):
+        """Момент (по часам планировщика), к которому нужно проснуться; None - задач нет"""
+        with self.condition:
+            self._drop_stale()
+            return self.heap[0][0] if self.heap else None
+
+    def _timeout(self):
+        self._drop_stale()
+        if not self.heap:
+            return None
+        return max(0.0, self.heap[0][0] - self.clock())
+
+    def run_due(self):
+        """Выполняет все задачи, чей срок наступил; возвращает их число"""
+        now = self.clock()
+        with self.condition:
+            due, pending = [], []
+            for entry in self.heap:
+                if not self._current(entry):
+                    continue
+                if entry[3].deadline <= now:
+                    due.append(entry[3])
+                else:
+                    pending.append(entry)
+            if not due:
+                return 0
+            heapq.heapify(pending)
+            self.heap = pending
+            self.batches += 1
+            for job in due:
+                job.running = True
+        for index, job in enumerate(due):
+            try:
+                if job.executor is None:
+                    self._execute(job, now)
+                    continue
+                job.executor.submit(self._execute, job, None)
+            except RuntimeError:
+                # Пул остановлен (клиент засыпает) - задача больше не нужна
+                with self.condition:
+                    job.running = False
+                    job.cancelled = True
+            except BaseException:
+                # SystemExit из задачи: остальные задачи пробуждения возвращаются в кучу
+                with self.condition:
+                    for rest in due[index + 1:]:
+                        rest.running = False
+                        self._schedule(rest, now, 0, jitter=False)
+                raise
+        return len(due)
+
+    def _execute(self, job, now):
+        delay = None
+        try:
+            delay = job.func()
+        except Exception as e:
+            logging.error(f"Ошибка в задаче {job.name}: {e}")
+        finally:
+            # И после SystemExit задача не должна навсегда остаться выполняющейся
+            self._finish(job, now, delay)
+
+    def _finish(self, job, now, delay):
+        """Снимает отметку выполнения и планирует следующий запуск"""
+        with self.condition:
+            job.running = False
+            job.runs += 1
+            self.runs += 1
+            if job.cancelled:
+                return
+            now = self.clock() if now is None else now
+            base, jitter = now, False
+            if job.triggered:
+                job.triggered = False
+                delay = 0
+            elif delay is None and job.interval is not None:
+                # Интервал отсчитывается от срока, а не от пробуждения: опоздание в пределах slack не копится
+                delay, jitter = job.interval, True
+                base = job.deadline if job.deadline + delay > now else now
+            if delay is None:
+                if self.jobs.get(job.name) is job:
+                    del self.jobs[job.name]
+                return
+            self._schedule(job, base, delay, jitter)
+
+    def run(self):
+        """Выполняет задачи в текущем потоке до stop()"""
+        while True:
+            with self.condition:
+                if self.stopped:
+                    return
+                timeout = self._timeout()
+                if timeout is None or timeout > 0:
+                    self.condition.wait(timeout)
+                    self.wakeups += 1
+                    if self.stopped:
+                        return
+            self.run_due()
+
+    def start(self):
+        """Выполняет задачи в отдельном потоке"""
+        self.thread = threading.Thread(target=self.run, daemon=True, name='timers')
+        self.thread.start()
+
+    async def run_async(self):
+        """Выполняет задачи в цикле событий asyncio (до отмены)"""
+        import asyncio
+        loop = asyncio.get_running_loop()
+        wakeup = asyncio.Event()
+
+        def notify():
+            try:
+                loop.call_soon_threadsafe(wakeup.set)
+            except RuntimeError:
+                pass  # Цикл событий уже закрыт
+
+        with self.condition:
+            self.notify = notify
+        try:
+            while not self.stopped:
+                with self.condition:
+                    timeout = self._timeout()
+                if timeout is None or timeout > 0:
+                    try:
+                        await asyncio.wait_for(wakeup.wait(), timeout)
+                    except asyncio.TimeoutError:
+                        pass
+                    wakeup.clear()
+                    self.wakeups += 1
+                self.run_due()
+        finally:
+            with self.condition:
+                self.notify = None
+
+    def stop(self):
+        """Останавливает выполнение задач (сразу, не дожидаясь ближайшего срока)"""
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+            if self.notify:
+                self.notify()
+        if self.thread and self.thread is not threading.current_thread():
+            self.thread.join(1)
+
+    def stats(self):
+        """Число задач и счетчики пробуждений (coalesced - запуски, разделившие пробуждение с другими)"""
+        with self.condition:
+            return {
+                'jobs': len(self.jobs),
+                'wakeups': self.wakeups,
+                'batches': self.batches,
+                'runs': self.runs,
+                'coalesced': max(0, self.runs - self.batches),
+            }
+
+class ReconnectScheduler:
+    """Планировщик переподключений: экспоненциальная задержка с полным джиттером.
+
+    Состояния: discovery (ждем адрес сервера), backoff (ждем попытки),
+    connecting, connected. После max_attempts неудач подряд размыкатель
+    срабатывает: вызывается on_give_up и планировщик ждет нового адреса от
+    discovery. Задержка следующей попытки - случайная в [0, min(cap, base * 2^n)],
+    поэтому клиенты после перезапуска сервера не переподключаются синхронно.
+    У каждого start() свой поток и свое событие остановки: новый поток ждет,
+    пока прежний закончит зависшую попытку, поэтому connect() никогда не
+    выполняется в двух потоках сразу.
+    """
+    STATE_DISCOVERY = 'discovery'
+    STATE_BACKOFF = 'backoff'
+    STATE_CONNECTING = 'connecting'
+    STATE_CONNECTED = 'connected'
+
+    def __init__(self, connect, on_give_up, base_delay, max_delay, max_attempts):
+        self.connect = connect
+        self.on_give_up = on_give_up
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_attempts = max_attempts
+        self.condition = threading.Condition()
+        self.state = self.STATE_DISCOVERY
+        self.deadline = None
+        self.failures = 0  # неудачных попыток подряд
+        self.lost_while_connecting = False
+        self.requested_while_connecting = False  # discovery дал адрес во время попытки
+        self.awaiting_discovery = False  # попытка решила ждать адрес от discovery
+        self.stop_event = threading.Event()  # Событие остановки текущего потока
+        self.stop_event.set()
+        self.thread = None
+        # Счетчики
+        self.attempts = 0
+        self.successes = 0
+        self.failures_total = 0
+        self.give_ups = 0
+        self.connection_losses = 0
+        self.last_delay = 0.0
+
+    def backoff_delay(self):
+        """Случайная задержка (full jitter) для текущего числа неудач"""
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** self.failures))
+
+    def _schedule(self, delay):
+        self.state = self.STATE_BACKOFF
+        self.deadline = time.monotonic() + delay
+        self.last_delay = delay
+        self.condition.notify_all()
+
+    def request_connect(self):
+        """Discovery сообщил адрес сервера"""
+        with self.condition:
+            if self.state == self.STATE_CONNECTING:
+                # Не теряем адрес: если текущая попытка не удастся, следующая - сразу
+                self.requested_while_connecting = True
+                return
+            if self.state != self.STATE_DISCOVERY:
+                return
+            # Первое подключение - сразу, после срабатывания размыкателя - с задержкой
+            self._schedule(self.backoff_delay() if self.failures else 0)
+
+    def connection_lost(self, delay=None):
+        """Установленное соединение разорвано (delay - своя задержка вместо экспоненциальной)"""
+        with self.condition:
+            if self.state == self.STATE_CONNECTING:
+                self.lost_while_connecting = True
+                return
+            if self.state != self.STATE_CONNECTED:
+                return
+            self.connection_losses += 1
+            self._schedule(self.backoff_delay() if delay is None else delay)
+
+    def seconds_until_attempt(self):
+        """Сколько ждать до попытки; None, если попытка не запланирована"""
+        with self.condition:
+            if self.state != self.STATE_BACKOFF:
+                return None
+            return max(0.0, self.deadline - time.monotonic())
+
+    def wait_for_discovery(self):
+        """Вызывается из попытки: после ее неудачи ждать адрес от discovery, а не повторять"""
+        with self.condition:
+            self.awaiting_discovery = True
+
+    def begin_attempt(self):
+        with self.condition:
+            self.state = self.STATE_CONNECTING
+            self.lost_while_connecting = False
+            self.requested_while_connecting = False
+            self.awaiting_discovery = False
+            self.attempts += 1
+
+    def finish_attempt(self, success):
+        """Фиксирует результат попытки; True, если сработал размыкатель"""
+        with self.condition:
+            if success:
+                self.state = self.STATE_CONNECTED
+                self.failures = 0
+                self.successes += 1
+                if self.lost_while_connecting:
+                    self.connection_losses += 1
+                    self._schedule(self.backoff_delay())
+                return False
+            if self.requested_while_connecting:
+                # Новый адрес от discovery пробуем сразу, неудача прежнего в счет не идет
+                self.failures_total += 1
+                self._schedule(0)
+                return False
+            if self.awaiting_discovery:
+                self.failures_total += 1
+                self.state = self.STATE_DISCOVERY
+                self.deadline = None
+                return False
+            self.failures += 1
+            self.failures_total += 1
+            if self.failures % self.max_attempts == 0:
+                self.state = self.STATE_DISCOVERY
+                self.give_ups += 1
+                return True
+            self._schedule(self.backoff_delay())
+            return False
+
+    def reset(self):
+        """Забывает состояние и неудачи (клиент уснул; после пробуждения - как при старте)"""
+        with self.condition:
+            self.state = self.STATE_DISCOVERY
+            self.deadline = None
+            self.failures = 0
+            self.lost_while_connecting = False
+
+    def start(self):
+        with self.condition:
+            stop = self.stop_event = threading.Event()
+            previous, self.thread = self.thread, threading.Thread(target=self._run, args=(stop, self.thread),
+                                                                  daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        with self.condition:
+            self.stop_event.set()
+            self.condition.notify_all()
+        if self.thread and self.thread is not threading.current_thread():
+            self.thread.join(1)
+
+    def _run(self, stop, previous):
+        if previous is not None and previous is not threading.current_thread():
+            # Прежний поток мог зависнуть в connect() - две попытки одновременно недопустимы
+            previous.join()
+        while True:
+            with self.condition:
+                while not stop.is_set():
+                    if self.state == self.STATE_BACKOFF:
+                        remaining = self.deadline - time.monotonic()
+                        if remaining <= 0:
+                            break
+                        self.condition.wait(remaining)
+                    else:
+                        self.condition.wait()
+                if stop.is_set():
+                    return
+            self.begin_attempt()
+            logging.info(f"Попытка подключения {self.failures + 1} (задержка {self.last_delay:.1f} с)")
+            success = False
+            try:
+                success = self.connect()
+            except Exception as e:
+                logging.error(f"Ошибка при подключении к серверу: {str(e)}")
+            if stop.is_set():
+                return  # Планировщик остановлен во время попытки: ее результат уже не нужен
+            if self.finish_attempt(success):
+                logging.warning(f"Не удалось подключиться {self.max_attempts} раз подряд, возвращаемся к поиску сервера")
+                self.on_give_up()
+
+    def stats(self):
+        """Текущее состояние и счетчики"""
+        with self.condition:
+            return {
+                'state': self.state,
+                'consecutive_failures': self.failures,
+                'attempts': self.attempts,
+                'successes': self.successes,
+                'failures': self.failures_total,
+                'give_ups': self.give_ups,
+                'connection_losses': self.connection_losses,
+                'last_delay_s': self.last_delay,
+            }
+
+class ServerDirectory:
+    """Известные серверы администратора.
+
+    Хранит на диске последний сервер, к которому удалось подключиться, и его
+    RTT, чтобы после перезапуска подключаться к нему сразу. Серверы, ответившие
+    на discovery, собираются в течение короткого окна и ранжируются по времени
+    установления TCP-соединения. Серверы, объявившиеся во время подключения,
+    только запоминаются и становятся кандидатами после разрыва.
+    """
+
+    def __init__(self, cache_path, collect_window=DISCOVERY_COLLECT_WINDOW):
+        self.cache_path = cache_path
+        self.collect_window = collect_window
+        self.lock = threading.Lock()
+        self.candidates = []
+        self.standby = []  # Объявились, пока клиент был подключен
+        self.selection_deadline = None
+
+    def load_cache(self):
+        """Возвращает ((ip, port), rtt) последнего удачного сервера или None"""
+        if not self.cache_path:
+            return None
+        try:
+            with open(self.cache_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            return (data['host'], int(data['port'])), float(data.get('rtt', 0.0))
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logging.warning(f"Не удалось прочитать кэш сервера: {e}")
+            return None
+
+    def save_cache(self, address, rtt):
+        """Сохраняет сервер и RTT рукопожатия (атомарной заменой файла)"""
+        if not self.cache_path:
+            return
+        try:
+            temp_path = f"{self.cache_path}.tmp"
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump({'host': address[0], 'port': address[1], 'rtt': rtt,
+                           'saved_at': datetime.now().isoformat(timespec='seconds')}, f)
+            os.replace(temp_path, self.cache_path)
+        except Exception as e:
+            logging.warning(f"Не удалось сохранить кэш сервера: {e}")
+
+    def add_candidate(self, address):
+        """Добавляет кандидата; True, если с него началось окно сбора"""
+        with self.lock:
+            if address not in self.candidates:
+                self.candidates.append(address)
+            if self.selection_deadline is None:
+                self.selection_deadline = time.monotonic() + self.collect_window
+                return True
+            return False
+
+    def add_standby(self, address):
+        """Запоминает сервер, объявившийся во время подключения; True, если он новый"""
+        with self.lock:
+            if address in self.standby:
+                return False
+            self.standby.append(address)
+            return True
+
+    def promote_standby(self, current):
+        """После разрыва: запомненные серверы и текущий - в кандидаты; True, если началось окно сбора"""
+        with self.lock:
+            standby, self.standby = self.standby, []
+        if not standby:
+            return False
+        started = False
+        for address in [current] + standby if current else standby:
+            started = self.add_candidate(address) or started
+        return started
+
+    def seconds_until_selection(self, default):
+        with self.lock:
+            if self.selection_deadline is None:
+                return default
+            return max(0.0, min(default, self.selection_deadline - time.monotonic()))
+
+    @staticmethod
+    def probe(address, timeout=SERVER_PROBE_TIMEOUT):
+        """Время установления TCP-соединения с сервером или None"""
+        started = time.perf_counter()
+        try:
+            with socket.create_connection(address, timeout=timeout):
+                return time.perf_counter() - started
+        except OSError:
+            return None
+
+    def select_best(self):
+        """Выбирает кандидата с наименьшим RTT (блокирует на время замеров)"""
+        with self.lock:
+            candidates, self.candidates = self.candidates, []
+            self.selection_deadline = None
+        if len(candidates) <= 1:
+            return candidates[0] if candidates else None
+        measured = [(self.probe(address), address) for address in candidates]
+        reachable = sorted((rtt, address) for rtt, address in measured if rtt is not None)
+        for rtt, address in reachable:
+            logging.info(f"Сервер {address[0]}:{address[1]}: RTT {rtt * 1000:.1f} мс")
+        return reachable[0][1] if reachable else candidates[0]
+
+class StandbyMonitor:
+    """Резервные серверы администратора для мгновенного переключения.
+
+    Известные серверы (из discovery и списка приоритетов), кроме текущего,
+    периодически проверяются TCP-подключением. При разрыве соединения
+    клиент сразу идет на лучший доступный резервный сервер (меньший номер
+    приоритета, затем RTT), минуя задержку переподключения и повторный поиск.
+    На сервер с более высоким приоритетом клиент возвращается, только если тот
+    доступен не меньше failback_delay секунд подряд. Соединение всегда одно:
+    старое закрывается до рукопожатия с новым сервером.
+    """
+
+    def __init__(self, priorities=(), failback_delay=STANDBY_FAILBACK_DELAY,
+                 probe=ServerDirectory.probe, clock=time.monotonic):
+        self.priorities = list(priorities)
+        self.failback_delay = failback_delay
+        self.probe = probe
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.servers = {}  # адрес -> {'rtt': ..., 'healthy_since': ...}
+        self.active = None
+        self.switch_to = None  # Сервер, на который переключиться при следующем разрыве
+        self.counters = {'probes': 0, 'probe_failures': 0, 'failovers': 0, 'failbacks': 0}
+        for address in self.priorities:
+            self.add(address)
+
+    def add(self, address):
+        with self.lock:
+            self.servers.setdefault(address, {'rtt': None, 'healthy_since': None})
+
+    def set_active(self, address):
+        """Клиент подключился к address"""
+        self.add(address)
+        with self.lock:
+            if self.active and self.active != address:
+                # Прежний сервер не проверялся, пока был текущим: доступность неизвестна
+                self.servers[self.active]['healthy_since'] = None
+            self.active = address
+
+    def priority(self, address):
+        """Номер в списке приоритетов (меньше - важнее); серверы вне списка равноправны"""
+        try:
+            return self.priorities.index(address)
+        except ValueError:
+            return len(self.priorities)
+
+    def probe_all(self):
+        """Проверяет доступность всех известных серверов, кроме текущего"""
+        with self.lock:
+            targets = [address for address in self.servers if address != self.active]
+        for address in targets:
+            rtt = self.probe(address)
+            now = self.clock()
+            with self.lock:
+                state = self.servers[address]
+                self.counters['probes'] += 1
+                if rtt is None:
+                    self.counters['probe_failures'] += 1
+                    state['healthy_since'] = None
+                else:
+                    state['rtt'] = rtt
+                    if state['healthy_since'] is None:
+                        state['healthy_since'] = now
+
+    def _healthy(self):
+        return [(self.priority(address), state['rtt'], address) for address, state in self.servers.items()
+                if address != self.active and state['healthy_since'] is not None]
+
+    def failover_target(self):
+        """Сервер для немедленного подключения после разрыва или None"""
+        with self.lock:
+            if self.switch_to:
+                target, self.switch_to = self.switch_to, None
+                self.counters['failbacks'] += 1
+                return target
+            healthy = self._healthy()
+            if not healthy:
+                return None
+            self.counters['failovers'] += 1
+            return min(healthy)[2]
+
+    def failback_target(self):
+        """Приоритетный сервер, стабильно доступный failback_delay секунд, или None"""
+        with self.lock:
+            if self.active is None:
+                return None
+            now = self.clock()
+            current = self.priority(self.active)
+            better = [entry for entry in self._healthy() if entry[0] < current
+                      and now - self.servers[entry[2]]['healthy_since'] >= self.failback_delay]
+            return min(better)[2] if better else None
+
+    def prefer(self, address):
+        """При следующем разрыве переключиться на address (возврат на приоритетный сервер)"""
+        with self.lock:
+            self.switch_to = address
+
+    def stats(self):
+        with self.lock:
+            result = dict(self.counters)
+            result['healthy'] = len(self._healthy())
+            result['known'] = len(self.servers)
+            return result
+
+def parse_server_list(value):
+    """Разбирает "ip:port,ip:port" в список адресов (некорректные элементы пропускаются)"""
+    servers = []
+    for item in value.split(','):
+        host, _, port = item.strip().rpartition(':')
+        if host and port.isdigit():
+            servers.append((host, int(port)))
+        elif item.strip():
+            logging.warning(f"Некорректный адрес сервера в списке приоритетов: {item}")
+    return servers
+
+class Heartbeat:
+    """Адаптивный keepalive соединения с сервером.
+
+    ping отправляется, только если за текущий интервал не ушло ни одного
+    другого кадра. Интервал растет на стабильном канале (до половины таймаута
+    живости) и сбрасывается до минимума после сбоев; нижняя граница зависит от
+    измеренного RTT. Если сервер отвечает на ping кадром pong, два
+    неотвеченных ping подряд означают разрыв, не дожидаясь полного таймаута.
+    """
+    STABLE_SAMPLES = 3  # Стабильных интервалов до увеличения интервала
+    GROWTH = 1.5
+
+    def __init__(self, interval=PING_INTERVAL, min_interval=PING_MIN_INTERVAL,
+                 max_interval=PING_MAX_INTERVAL, timeout=SERVER_RESPONSE_TIMEOUT):
+        self.initial_interval = interval
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.default_timeout = timeout
+        self.lock = threading.Lock()
+        self.pings_sent = 0
+        self.early_failures = 0
+        self.reset()
+
+    def reset(self, timeout=None, rtt=None):
+        """Начинает новое соединение (timeout - согласованный с сервером)"""
+        now = time.monotonic()
+        with self.lock:
+            self.timeout = timeout or self.default_timeout
+            self.interval = min(self.initial_interval, self.interval_cap())
+            self.last_sent = now
+            self.last_received = now
+            self.ping_sent_at = None
+            self.srtt = rtt
+            self.rttvar = rtt / 2 if rtt else None
+            self.answers_pings = False
+            self.stable = 0
+            self.misses = 0
+
+    def interval_cap(self):
+        return max(self.min_interval, min(self.max_interval, self.timeout / 2))
+
+    def interval_floor(self):
+        # Пинговать чаще нескольких RTT бессмысленно
+        return min(self.interval_cap(), max(self.min_interval, 8 * (self.srtt or 0)))
+
+    def on_sent(self, now=None):
+        """Любой кадр ушел серверу"""
+        with self.lock:
+            self.last_sent = now or time.monotonic()
+
+    def on_received(self, now=None):
+        """От сервера пришли данные"""
+        with self.lock:
+            self.last_received = now or time.monotonic()
+
+    def on_pong(self, now=None):
+        """Сервер ответил на ping"""
+        now = now or time.monotonic()
+        with self.lock:
+            self.answers_pings = True
+            if self.ping_sent_at is not None:
+                self._sample_rtt(now - self.ping_sent_at)
+                self.ping_sent_at = None
+                self.misses = 0
+
+    def on_ping(self, now=None):
+        """ping поставлен в очередь отправки"""
+        with self.lock:
+            if not self.answers_pings:
+                # Без pong о стабильности судим по тому, что канал пережил интервал
+                self._stable_interval()
+            self.ping_sent_at = self.last_sent = now or time.monotonic()
+            self.pings_sent += 1
+
+    def _sample_rtt(self, rtt):
+        if self.srtt is None:
+            self.srtt, self.rttvar = rtt, rtt / 2
+        else:
+            spike = rtt > self.srtt + 4 * self.rttvar
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+            if spike:
+                self._unstable()
+                return
+        self._stable_interval()
+
+    def _stable_interval(self):
+        self.stable += 1
+        if self.stable >= self.STABLE_SAMPLES:
+            self.stable = 0
+            self.interval = min(self.interval_cap(), max(self.interval_floor(), self.interval * self.GROWTH))
+
+    def _unstable(self):
+        self.stable = 0
+        self.interval = self.interval_floor()
+
+    def ping_timeout(self):
+        return max(2.0, 4 * ((self.srtt or 0) + 4 * (self.rttvar or 0)))
+
+    def next_action(self, now=None):
+        """Возвращает ('dead' | 'ping' | None, сколько ждать до следующей проверки)"""
+        now = now or time.monotonic()
+        with self.lock:
+            if now - self.last_received > self.timeout:
+                return 'dead', 0
+            # Сервер отвечает на ping - неотвеченный ping виден сразу
+            if (self.ping_sent_at is not None and self.answers_pings
+                    and now - self.ping_sent_at > self.ping_timeout()):
+                self.ping_sent_at = None
+                self.misses += 1
+                self._unstable()
+                if self.misses >= 2:
+                    self.early_failures += 1
+                    return 'dead', 0
+                return 'ping', 0
+            due = self.last_sent + self.interval
+            if now >= due:
+                return 'ping', 0
+            wait = min(due, self.last_received + self.timeout) - now
+            if self.ping_sent_at is not None and self.answers_pings:
+                wait = min(wait, self.ping_sent_at + self.ping_timeout() - now)
+            return None, max(0.0, wait)
+
+    def is_dead(self, now=None):
+        with self.lock:
+            return (now or time.monotonic()) - self.last_received > self.timeout
+
+    def stats(self):
+        with self.lock:
+            return {
+                'interval_s': self.interval,
+                'timeout_s': self.timeout,
+                'srtt_ms': self.srtt * 1000 if self.srtt is not None else None,
+                'pings_sent': self.pings_sent,
+                'early_failures': self.early_failures,
+            }
+
+def parse_handshake_reply(reply):
+    """Разбирает 'CONNECTION_ACCEPTED [ключ=значение ...]'; None, если сервер отказал"""
+    parts = reply.split()
+    if not parts or parts[0] != "CONNECTION_ACCEPTED":
+        return None
+    options = {}
+    for part in parts[1:]:
+        key, _, value = part.partition('=')
+        options[key] = value
+    return options
+
+def negotiated_timeout(options):
+    """Таймаут живости из опции keepalive= рукопожатия (в разумных пределах)"""
+    try:
+        timeout = float(options.get('keepalive', ''))
+    except ValueError:
+        return None
+    return timeout if 10 <= timeout <= 3600 else None
+
+def negotiated_protocol(options):
+    """Версия протокола из опции proto= рукопожатия (не выше поддерживаемой)"""
+    try:
+        version = int(options.get('proto', 1))
+    except ValueError:
+        return 1
+    return max(1, min(version, PROTOCOL_VERSION))
+
+def parse_discovery_message(data):
+    """Разбирает пакет ADMIN_SERVER_DISCOVERY:ip:port, возвращает (ip, port) или None"""
+    try:
+        message = data.decode('utf-8')
+    except UnicodeDecodeError:
+        return None
+    if not message.startswith("ADMIN_SERVER_DISCOVERY:"):
+        return None
+    server_info = message.split(':')
+    if len(server_info) < 3:
+        return None
+    try:
+        return server_info[1], int(server_info[2])
+    except ValueError:
+        return None
+
+def parse_update_announcement(data):
+    """Разбирает пакет UPDATE_AVAILABLE:версия:sha256:порт, возвращает кортеж или None"""
+    try:
+        message = data.decode('utf-8')
+    except UnicodeDecodeError:
+        return None
+    if not message.startswith(UPDATE_ANNOUNCE_PREFIX):
+        return None
+    parts = message[len(UPDATE_ANNOUNCE_PREFIX):].split(':')
+    if len(parts) != 3 or not re.fullmatch(r'[0-9a-f]{64}', parts[1]):
+        return None
+    try:
+        return parts[0], parts[1], int(parts[2])
+    except ValueError:
+        return None
+
+class ClientMetrics(Registry):
+    """Метрики клиента. Счетчики других объектов (планировщик, очередь, heartbeat)
+    читаются при опросе и на горячий путь не влияют"""
+    COMMANDS = ('check_dnd_status', 'check_status', 'display_message', 'pong', 'stats')
+
+    def __init__(self, client):
+        super().__init__()
+        self.dnd_read = self.histogram('microsip_dnd_status_read_seconds', 'Время получения статуса DND')
+        self.send_latency = self.histogram('microsip_send_latency_seconds',
+                                           'Задержка от постановки сообщения до отправки в сокет')
+        self.send_failures = self.counter('microsip_send_failures_total', 'Неудачные отправки сообщений', ('reason',))
+        self.command_seconds = self.histogram('microsip_command_seconds',
+                                              'Время обработки команды сервера', ('command',))
+        self.discovery_to_connect = self.histogram('microsip_discovery_to_connect_seconds',
+                                                   'Время от начала поиска сервера до подключения',
+                                                   buckets=SLOW_BUCKETS)
+        self.update_check = self.histogram('microsip_update_check_seconds', 'Длительность проверки обновлений',
+                                           buckets=SLOW_BUCKETS)
+
+        reconnect = lambda key: lambda: client.reconnect_scheduler.stats()[key]
+        self.gauge_func('microsip_connected', 'Подключен ли клиент к серверу', lambda: int(client.connected))
+        self.gauge_func('microsip_protocol_version', 'Версия протокола текущего соединения',
+                        lambda: client.protocol_version)
+        self.counter_func('microsip_reconnect_attempts_total', 'Попытки подключения', reconnect('attempts'))
+        self.counter_func('microsip_reconnect_failures_total', 'Неудачные попытки подключения', reconnect('failures'))
+        self.counter_func('microsip_reconnect_give_ups_total', 'Возвраты к поиску сервера', reconnect('give_ups'))
+        self.counter_func('microsip_connection_losses_total', 'Разрывы соединения', reconnect('connection_losses'))
+        self.gauge_func('microsip_outbound_depth', 'Сообщений в очереди отправки',
+                        lambda: (client.get_outbound_stats() or {}).get('depth'))
+        self.gauge_func('microsip_ping_interval_seconds', 'Текущий интервал ping',
+                        lambda: client.heartbeat.stats()['interval_s'])
+        self.counter_func('microsip_pings_sent_total', 'Отправлено ping', lambda: client.heartbeat.stats()['pings_sent'])
+        self.counter_func('microsip_notifications_shown_total', 'Показано уведомлений',
+                          lambda: client.notification_manager.stats()['shown'])
+        self.counter_func('microsip_notifications_dropped_total', 'Отброшено уведомлений',
+                          lambda: sum(client.notification_manager.stats()[k]
+                                      for k in ('duplicate', 'rate_limited', 'queue_full')))
+        standby = lambda key: lambda: client.standby.stats()[key] if client.standby else 0
+        self.counter_func('microsip_failovers_total', 'Переключения на резервный сервер', standby('failovers'))
+        self.counter_func('microsip_failbacks_total', 'Возвраты на приоритетный сервер', standby('failbacks'))
+        self.counter_func('microsip_status_cache_hits_total', 'Запросы статуса, обслуженные из снимка',
+                          lambda: client.status.stats()['hits'])
+        self.counter_func('microsip_status_refreshes_total', 'Чтения статуса с диска',
+                          lambda: client.status.stats()['refreshes'])
+        outbox = lambda key: lambda: client.outbox.stats()[key]
+        self.gauge_func('microsip_outbox_pending', 'Сообщений состояния, ждущих подключения', outbox('pending'))
+        self.counter_func('microsip_outbox_compacted_total', 'Устаревшие значения, замененные в outbox',
+                          outbox('compacted'))
+        self.counter_func('microsip_outbox_flushed_total', 'Сообщения из outbox, отправленные после подключения',
+                          outbox('flushed'))
+        self.gauge_func('microsip_awake', 'Клиент бодрствует (MicroSIP запущен или режим сна выключен)',
+                        lambda: int(client.active))
+        self.counter_func('microsip_wakeups_total', 'Пробуждения при запуске MicroSIP', lambda: client.wakeups)
+        timers = lambda key: lambda: client.timers.stats()[key]
+        self.gauge_func('microsip_timer_jobs', 'Задач в планировщике таймеров', timers('jobs'))
+        self.counter_func('microsip_timer_wakeups_total', 'Пробуждения планировщика таймеров', timers('wakeups'))
+        self.counter_func('microsip_timer_runs_total', 'Запуски задач планировщика таймеров', timers('runs'))
+        self.gauge_func('microsip_sessions', 'Профилей пользователей, обслуживаемых службой',
+                        lambda: len(client.sessions) if client.sessions is not None else 0)
+        self.counter_func('microsip_update_checks_total', 'Запросы к API обновлений',
+                          lambda: client.update_manager.stats()['checks'])
+        self.counter_func('microsip_update_not_modified_total', 'Ответы 304 от API обновлений',
+                          lambda: client.update_manager.stats()['not_modified'])
+
+    def command_name(self, command):
+        """Метка команды (неизвестные команды - other, чтобы не плодить серии)"""
+        name = parse_addressed(command)[1].split(':', 1)[0]
+        return name if name in self.COMMANDS else 'other'
+
 class MicrosipClient:
-    def __init__(self):
+    def __init__(self, discovery_port=DISCOVERY_PORT, query_address=None, server_cache_path=SERVER_CACHE_FILE,
+                 process_detector=None):
         self.hostname = self.get_hostname()
+        self.discovery_port = discovery_port  # 0 - выбрать свободный порт (для тестовых стендов)
+        self.query_address = query_address or ('<broadcast>', DISCOVERY_QUERY_PORT)
+        self.server_directory = ServerDirectory(server_cache_path)
+        self.standby = StandbyMonitor(parse_server_list(SERVER_PRIORITY), STANDBY_FAILBACK_DELAY) \
+            if STANDBY_ENABLED else None  # Резервные серверы (горячий резерв)
         self.server_address = None
+        self.cached_address = None  # Сервер из кэша, к которому еще не пробовали подключиться
         self.main_socket = None
         self.connected = False
         self.running = True
         self.last_dnd_status = None
-        self.reconnect_attempts = 0
+        self.reconnect_scheduler = ReconnectScheduler(
+            self.connect_to_server, self.on_reconnect_give_up,
+            RECONNECT_BASE_DELAY, RECONNECT_MAX_DELAY, MAX_RECONNECT_ATTEMPTS
+        )
         self.last_server_response = time.time()
+        self.timers = TimerScheduler()  # Вся периодическая работа: ping, запросы discovery, опросы
+        self.heartbeat = Heartbeat()
+        self.connection_closed = threading.Event()  # Устанавливается при разрыве текущего соединения
         self.discovery_active = True  # Флаг активности поиска
-        self.notification_manager = NotificationManager()
-        self.update_manager = UpdateManager(self.notification_manager)
+        self.discovery_socket = None
+        self.dnd_watcher = None  # Наблюдатель за microsip.ini
+        self.outbound = None  # Очередь исходящих сообщений текущего соединения
+        self.protocol_version = 1  # Версия протокола текущего соединения (2 - с идентификаторами запросов)
+        self.server_options = {}  # Опции из CONNECTION_ACCEPTED текущего соединения
+        self.outbox = OfflineOutbox()  # Состояние, накопленное без связи
+        self.settings_reader = None  # Кэширующий читатель microsip.ini
+        self.status = StatusService(self.read_status_snapshot)  # Общий снимок статуса для всех читателей
+        self.backend = get_backend()  # Уведомления, keepalive и путь к настройкам для текущей ОС
+        self.process_detector = process_detector or ProcessDetector(self.backend)
+        self.active_stop = threading.Event()  # Устанавливается, когда клиент засыпает или останавливается
+        self.active_stop.set()
+        self.wakeups = 0  # Сколько раз клиент просыпался при запуске MicroSIP
+        self.sleep_probe_interval = SLEEP_PROBE_INTERVAL
+        self.command_pool = None
+        self.notification_manager = NotificationDispatcher(self.backend.create_notifier(),
+                                                           on_event=self.on_notification_event)
+        self.sessions = SessionRegistry(SERVICE_PROFILES or self.backend.profiles_pattern(), self.hostname) \
+            if SERVICE_MODE else None  # Профили пользователей (режим службы)
+        self.update_manager = UpdateManager(self.notification_manager, hostname=self.hostname, timers=self.timers,
+                                            on_install=self.stop)
+        self.metrics = ClientMetrics(self)
+        self.discovery_started = time.perf_counter()  # Начало поиска сервера (для метрики времени подключения)
+        self.metrics_server = None
+        if METRICS_PORT:
+            try:
+                self.metrics_server = start_http_server(self.metrics, METRICS_PORT)
+                logging.info(f"Метрики доступны на http://127.0.0.1:{METRICS_PORT}/metrics")
+            except OSError as e:
+                logging.error(f"Не удалось открыть порт метрик {METRICS_PORT}: {e}")
+        
+        self.start_background_threads()
+        
+        logging.info(f"Клиент инициализирован (hostname: {self.hostname})")
+
+    @property
+    def active(self):
+        """Клиент бодрствует: есть потоки, сокеты и наблюдатели (не спит и не остановлен)"""
+        return not self.active_stop.is_set()
+
+    def start_background_threads(self):
+        """Запускает фоновую работу; в режиме сна - только когда запущен MicroSIP (см. run)"""
+        if not SLEEP_MODE:
+            self.activate()
+
+    # Задачи таймеров, которые работают, только пока клиент бодрствует
+    ACTIVE_TIMERS = ('discovery_query', 'select_server', 'heartbeat', 'updates', 'standby', 'sessions')
+
+    def activate(self):
+        """Запускает поиск сервера, переподключения и периодические задачи"""
+        self.active_stop = threading.Event()
+        self.reconnect_scheduler.start()
+        from concurrent.futures import ThreadPoolExecutor  # Спящему клиенту пул не нужен
+        self.command_pool = ThreadPoolExecutor(max_workers=COMMAND_WORKERS, thread_name_prefix='microsip-cmd')
+        self.try_cached_server()
         
         # Запускаем поиск сервера
         self.discovery_thread = threading.Thread(target=self.discover_server, daemon=True)
         self.discovery_thread.start()
         
-        # Запускаем поток проверки обновлений
-        self.update_thread = threading.Thread(target=self.check_updates_periodically, daemon=True)
-        self.update_thread.start()
-        
-        logging.info(f"Клиент инициализирован (hostname: {self.hostname})")
+        # Обновления и проверка резервных серверов блокируют - выполняются в пуле
+        self.timers.every('updates', UPDATE_CHECK_INTERVAL, self.check_updates, delay=0,
+                          jitter=UPDATE_CHECK_JITTER, executor=self.command_pool)
+        if self.standby:
+            self.timers.every('standby', STANDBY_PROBE_INTERVAL, self.check_standby, delay=0,
+                              executor=self.command_pool)
+        if self.sessions is not None:
+            self.timers.every('sessions', SERVICE_POLL_INTERVAL, self.check_sessions, delay=0)
 
     def get_hostname(self):
         """Получает имя компьютера"""
@@ -171,58 +2693,134 @@ class MicrosipClient:
             return f"Unknown-{int(time.time())}"
 
     def discover_server(self):
-        """Поиск сервера администратора через широковещательные сообщения"""
+        """Поиск сервера администратора через широковещательные сообщения.
+
+        Поток только принимает пакеты (без таймаута); активные запросы и выбор
+        сервера после окна сбора - задачи таймеров."""
         discovery_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         discovery_socket.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
-        discovery_socket.bind(('', DISCOVERY_PORT))
-        discovery_socket.settimeout(1.0)  # Таймаут для возможности проверки флага
+        discovery_socket.bind(('', self.discovery_port))
+        self.discovery_port = discovery_socket.getsockname()[1]
+        self.discovery_socket = discovery_socket
         
         logging.info("Начат поиск сервера администратора...")
+        stop = self.active_stop
+        # Активный запрос: сервер ответит сразу, не дожидаясь своей рассылки
+        self.timers.call_later('discovery_query', 0, self.discovery_query)
         
-        while self.running:
+        while self.running and not stop.is_set():
             try:
-                # Если поиск не активен и есть подключение, пропускаем
-                if not self.discovery_active and self.connected:
-                    time.sleep(1)
-                    continue
-
-                try:
-                    data, addr = discovery_socket.recvfrom(BUFFER_SIZE)
-                    message = data.decode('utf-8')
-                    
-                    if message.startswith("ADMIN_SERVER_DISCOVERY:"):
-                        server_info = message.split(':')
-                        if len(server_info) >= 3:
-                            server_ip = server_info[1]
-                            server_port = int(server_info[2])
-                            
-                            # Проверяем, не подключены ли мы уже к этому серверу
-                            if self.server_address != (server_ip, server_port):
-                                old_server = self.server_address
-                                self.server_address = (server_ip, server_port)
-                                logging.info(f"Обнаружен сервер администратора: {server_ip}:{server_port}")
-                                
-                                # Если это новый сервер и мы не подключены, подключаемся
-                                if not self.connected:
-                                    self.connect_to_server()
-                                # Если мы уже подключены к другому серверу, проверяем необходимость переключения
-                                elif old_server and old_server != (server_ip, server_port):
-                                    logging.info(f"Обнаружен новый сервер администратора, пока подключены к {old_server}")
-                except socket.timeout:
-                    continue
+                data, addr = discovery_socket.recvfrom(BUFFER_SIZE)
+                if stop.is_set():
+                    break
+                server = parse_discovery_message(data)
+                if server:
+                    if self.on_server_announced(server):
+                        self.schedule_server_selection()
+                elif self.update_manager.on_peer_announcement(addr[0], data):
+                    self.timers.trigger('updates')
                     
             except Exception as e:
                 logging.error(f"Ошибка при поиске сервера: {str(e)}")
-                time.sleep(1)
+                stop.wait(1)
 
+        if self.discovery_socket is discovery_socket:
+            self.discovery_socket = None
         try:
             discovery_socket.close()
         except Exception as e:
             logging.error(f"Ошибка при закрытии discovery сокета: {str(e)}")
 
+    def wake_discovery(self):
+        """Будит поток discovery, ждущий пакет без таймаута (пустой пакет самому себе)"""
+        sock = self.discovery_socket
+        if sock:
+            try:
+                sock.sendto(b'', ('127.0.0.1', self.discovery_port))
+            except OSError as e:
+                logging.debug(f"Не удалось разбудить поток discovery: {str(e)}")
+
+    def discovery_query(self):
+        """Задача таймеров: активные запросы, пока нет подключения"""
+        sock = self.discovery_socket
+        if self.connected or sock is None or not self.active:
+            return None
+        self.send_discovery_query(sock)
+        return DISCOVERY_QUERY_INTERVAL
+
+    def send_discovery_query(self, sock):
+        """Отправляет активный запрос ADMIN_SERVER_QUERY"""
+        try:
+            sock.sendto(DISCOVERY_QUERY_MESSAGE, self.query_address)
+        except OSError as e:
+            logging.debug(f"Не удалось отправить запрос поиска сервера: {str(e)}")
+
+    def on_server_announced(self, server):
+        """Обрабатывает объявление сервера; True, если началось окно сбора кандидатов"""
+        if self.standby:
+            self.standby.add(server)
+            if self.connected:
+                return False
+        if self.connected:
+            # Адрес текущего сервера не меняем: другой сервер - кандидат на случай разрыва
+            if self.server_address != server and self.server_directory.add_standby(server):
+                logging.info(f"Обнаружен сервер администратора {server[0]}:{server[1]}, "
+                             f"пока подключены к {self.server_address}; он будет кандидатом при разрыве")
+            return False
+        return self.server_directory.add_candidate(server)
+
+    def schedule_server_selection(self):
+        """Выбор сервера после окна сбора кандидатов"""
+        self.timers.call_later('select_server', self.server_directory.seconds_until_selection(0),
+                               self.select_server, executor=self.command_pool)
+
+    def select_server(self):
+        """Выбирает лучший из объявившихся серверов и планирует подключение"""
+        server = self.server_directory.select_best()
+        if not server or self.connected:
+            # Уже переподключились - текущее соединение не рвем
+            return
+        if self.server_address != server:
+            logging.info(f"Обнаружен сервер администратора: {server[0]}:{server[1]}")
+            self.server_address = server
+        self.reconnect_scheduler.request_connect()
+
+    def try_cached_server(self):
+        """Сразу пробует последний сервер, к которому удалось подключиться"""
+        cached = self.server_directory.load_cache()
+        if not cached or self.server_address:
+            return
+        self.server_address, rtt = cached
+        self.cached_address = self.server_address
+        logging.info(f"Подключаемся к серверу из кэша {self.server_address[0]}:{self.server_address[1]} "
+                     f"(RTT {rtt * 1000:.1f} мс)")
+        self.reconnect_scheduler.request_connect()
+
+    def connect_timeout(self, address):
+        """Таймаут TCP-подключения: короткий для первой попытки к серверу из кэша"""
+        cached, self.cached_address = self.cached_address, None
+        return CACHED_SERVER_CONNECT_TIMEOUT if address == cached else SERVER_CONNECT_TIMEOUT
+
+    def on_connect_failed(self, address, timeout):
+        """Сервер из кэша недоступен: не повторяем его, а ждем адрес от discovery"""
+        if timeout != CACHED_SERVER_CONNECT_TIMEOUT or self.server_address != address:
+            return
+        logging.info(f"Сервер из кэша {address[0]}:{address[1]} недоступен, ищем сервер через discovery")
+        self.server_address = None
+        self.reconnect_scheduler.wait_for_discovery()
+
     def connect_to_server(self):
-        """Подключение к серверу администратора"""
-        if not self.server_address:
+        """Подключение к серверу администратора.
+
+        Адрес читается один раз: select_server может сменить server_address во
+        время рукопожатия, а кэш и резерв должны получить сервер, к которому
+        действительно подключились. Если клиент уснул во время рукопожатия,
+        соединение сразу закрывается."""
+        stop = self.active_stop
+        if stop.is_set():
+            return False
+        address = self.server_address
+        if not address:
             logging.error("Нет адреса сервера для подключения")
             return False
 
@@ -231,35 +2829,58 @@ class MicrosipClient:
             self.disconnect_from_server()
         
         try:
-            logging.info(f"Попытка подключения к серверу {self.server_address}")
+            logging.info(f"Попытка подключения к серверу {address}")
             
             # Создаем новый сокет
             self.main_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.main_socket.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
-            self.main_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
-            
-            if platform.system() == 'Windows':
-                self.main_socket.ioctl(socket.SIO_KEEPALIVE_VALS, (1, 10000, 3000))
+            self.configure_socket(self.main_socket)
             
-            # Устанавливаем таймаут на подключение
-            self.main_socket.settimeout(10)
+            # Устанавливаем таймаут на подключение (к серверу из кэша - короткий)
+            timeout = self.connect_timeout(address)
+            self.main_socket.settimeout(timeout)
             
             # Пытаемся подключиться
-            self.main_socket.connect(self.server_address)
+            handshake_started = time.perf_counter()
+            try:
+                self.main_socket.connect(address)
+            except OSError:
+                self.on_connect_failed(address, timeout)
+                raise
             
             # Отправляем имя хоста для идентификации
             self.main_socket.sendall(f"{self.hostname}\n".encode('utf-8'))
             
-            # Ждем подтверждения от сервера
+            # Ждем подтверждения от сервера. Читаем ровно один кадр: команды, пришедшие
+            # с ним в одном пакете, выполнит handle_commands
+            decoder = FrameDecoder()
             try:
-                self.main_socket.settimeout(10)  # Таймаут 10 секунд на получение подтверждения
-                confirmation = self.main_socket.recv(1024).decode('utf-8').strip()
-                if confirmation == "CONNECTION_ACCEPTED":
+                self.main_socket.settimeout(SERVER_CONNECT_TIMEOUT)  # Таймаут на получение подтверждения
+                frames = []
+                while not frames:
+                    frames = decoder.recv_from(self.main_socket)
+                    if frames is None:
+                        raise ConnectionError("сервер закрыл соединение")
+                confirmation = frames.pop(0).strip()
+                options = parse_handshake_reply(confirmation)
+                if options is not None and stop.is_set():
+                    logging.info("Клиент уснул во время рукопожатия, соединение закрывается")
+                    self.main_socket.close()
+                    return False
+                if options is not None:
                     logging.info("Подключение подтверждено сервером")
+                    handshake_rtt = time.perf_counter() - handshake_started
+                    self.heartbeat.reset(timeout=negotiated_timeout(options), rtt=handshake_rtt)
+                    self.protocol_version = negotiated_protocol(options)
+                    self.server_options = options
+                    self.connection_closed = threading.Event()
                     self.connected = True
-                    self.reconnect_attempts = 0  # Сбрасываем счетчик попыток
                     self.last_server_response = time.time()
                     self.discovery_active = False  # Отключаем активный поиск
+                    self.record_connected()
+                    self.server_address = address  # Подключены к нему, что бы ни выбрал select_server
+                    self.server_directory.save_cache(address, handshake_rtt)
+                    if self.standby:
+                        self.standby.set_active(address)
                 else:
                     logging.error(f"Неожиданный ответ от сервера: {confirmation}")
                     self.main_socket.close()
@@ -273,318 +2894,1131 @@ class MicrosipClient:
                 self.main_socket.close()
                 return False
             finally:
-                self.main_socket.settimeout(None)
+                if self.main_socket.fileno() != -1:  # Ветки ошибок уже закрыли сокет
+                    self.main_socket.settimeout(None)
             
-            # Запускаем обработчики
-            threading.Thread(target=self.handle_commands, daemon=True).start()
-            threading.Thread(target=self.maintain_connection, daemon=True).start()
+            # Один таймаут на сокет: его читает handle_commands, пишет только очередь отправки
+            self.main_socket.settimeout(COMMAND_READ_TIMEOUT)
+            closed = self.connection_closed
+            self.outbound = OutboundQueue(self.main_socket, lambda: self.disconnect_from_server(closed),
+                                          on_sent=self.heartbeat.on_sent, metrics=self.metrics)
+            self.outbound.start()
+            if self.protocol_version >= 2:
+                # Подтверждаем версию до любых ответов, иначе сервер ждет протокол 1
+                self.send_message(f"proto:{self.protocol_version}")
+                logging.info(f"Согласован протокол версии {self.protocol_version}")
             
-            # Даем небольшую паузу для стабилизации соединения
-            time.sleep(0.5)
+            # Запускаем обработчик команд; ping - задача таймеров
+            threading.Thread(target=self.handle_commands, args=(decoder, frames, closed, self.main_socket),
+                             daemon=True).start()
+            self.timers.call_later('heartbeat', 0, lambda: self.maintain_connection(closed))
             
-            # Отправляем начальный статус DND
-            initial_status = self.get_dnd_status()
-            self.send_message(f"dnd_status:{initial_status}")
-            logging.info(f"Отправлен начальный статус DND: {initial_status}")
+            # Отправляем начальный статус DND вместе с накопленным без связи состоянием
+            frames, initial_status = self.reconnect_frames()
+            if all([self.send_message(frame) for frame in frames]):
+                self.last_dnd_status = initial_status
+            self.log_initial_status(initial_status)
             
             # Запускаем мониторинг DND статуса
-            self.dnd_monitor_thread = threading.Thread(target=self.monitor_dnd_status, daemon=True)
-            self.dnd_monitor_thread.start()
+            self.monitor_dnd_status()
             
-            logging.info(f"Успешно подключились к серверу {self.server_address}")
+            if stop.is_set():
+                # Уснули, пока запускали соединение: deactivate мог его уже не застать
+                logging.info("Клиент уснул во время подключения, соединение закрывается")
+                self.disconnect_from_server(closed)
+                if not self.active:
+                    self.stop_local_services()
+                return False
+            
+            logging.info(f"Успешно подключились к серверу {address}")
             return True
             
         except Exception as e:
             logging.error(f"Ошибка при подключении к серверу: {str(e)}")
-            self.disconnect_from_server()
+            if self.connected:
+                self.disconnect_from_server()
+            else:
+                self.close_main_socket()
             return False
 
-    def maintain_connection(self):
-        """Поддержание активного соединения с сервером"""
-        while self.connected and self.running:
-            try:
-                if not self.main_socket:
-                    logging.error("Сокет закрыт при попытке поддержания соединения")
-                    break
-                
-                # Отправляем ping каждые 15 секунд
-                logging.debug("Отправляем ping серверу")
-                if not self.send_message("ping"):
+    def configure_socket(self, sock):
+        """Включает TCP keepalive и отключает алгоритм Нейгла"""
+        self.backend.configure_keepalive(sock)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def maintain_connection(self, closed):
+        """Поддержание активного соединения с сервером (адаптивный ping).
+
+        Задача таймеров: возвращает задержку до следующей проверки; при разрыве
+        задача отменяется."""
+        if closed is not self.connection_closed or closed.is_set() or not self.running:
+            return None
+        try:
+            if not self.main_socket:
+                logging.error("Сокет закрыт при попытке поддержания соединения")
+            else:
+                action, wait = self.heartbeat.next_action()
+                if action is None:
+                    return wait
+                if action == 'ping':
+                    # ping нужен, только если за интервал не было другого трафика
+                    logging.debug("Отправляем ping серверу")
+                    self.heartbeat.on_ping()
+                    if self.send_message("ping"):
+                        return 0
                     logging.error("Не удалось отправить ping")
-                    break
-                
-                # Проверяем время последнего ответа
-                if time.time() - self.last_server_response > 60:  # 1 минута без ответа
-                    logging.warning("Нет ответа от сервера более 60 секунд")
-                    break
-                
-                # Ждем 15 секунд
-                for _ in range(15):
-                    if not self.connected or not self.running:
-                        break
-                    time.sleep(1)
-                    
-            except Exception as e:
-                logging.error(f"Ошибка при поддержании соединения: {str(e)}")
-                break
+                else:
+                    logging.warning(f"Нет ответа от сервера более {self.heartbeat.timeout:.0f} секунд "
+                                    f"или не отвечены ping подряд")
+        except Exception as e:
+            logging.error(f"Ошибка при поддержании соединения: {str(e)}")
         
         logging.info("Завершение поддержания соединения")
-        self.disconnect_from_server()
+        self.disconnect_from_server(closed)
+        return None
+
+    def disconnect_from_server(self, closed=None):
+        """Корректное отключение от сервера.
 
-    def disconnect_from_server(self):
-        """Корректное отключение от сервера"""
+        closed - событие соединения, которое закрывает вызывающий поток: если
+        клиент уже переподключился, новое соединение не трогаем."""
+        if closed is not None and closed is not self.connection_closed:
+            return
         if self.connected:
             logging.info("Отключение от сервера...")
             self.connected = False
+            self.connection_closed.set()
+            self.timers.cancel('heartbeat')
             
-            if hasattr(self, 'main_socket') and self.main_socket:
-                try:
-                    self.main_socket.shutdown(socket.SHUT_RDWR)
-                except Exception as e:
-                    logging.debug(f"Ошибка при shutdown сокета: {str(e)}")
-                try:
-                    self.main_socket.close()
-                except Exception as e:
-                    logging.debug(f"Ошибка при закрытии сокета: {str(e)}")
-                self.main_socket = None
+            outbound, self.outbound = self.outbound, None
+            if outbound:
+                outbound.close()
+            
+            self.close_main_socket()
+            
+            if outbound:
+                outbound.join()
+                if logging.getLogger().isEnabledFor(logging.DEBUG):
+                    logging.debug(f"Статистика очереди отправки: {outbound.stats()}")
             
             # Активируем поиск нового сервера
             self.discovery_active = True
+            self.discovery_started = self.discovery_started or time.perf_counter()
             logging.info("Активирован поиск нового сервера администратора")
             
-            # Если клиент все еще работает, пытаемся переподключиться к текущему серверу
-            if self.running and self.reconnect_attempts < MAX_RECONNECT_ATTEMPTS:
-                self.reconnect_attempts += 1
-                logging.info(f"Попытка переподключения {self.reconnect_attempts}/{MAX_RECONNECT_ATTEMPTS}")
-                time.sleep(RECONNECT_DELAY)
-                if self.connect_to_server():
-                    logging.info("Успешное переподключение к серверу")
-                else:
-                    logging.error("Не удалось переподключиться к серверу")
-            elif self.reconnect_attempts >= MAX_RECONNECT_ATTEMPTS:
-                logging.warning("Достигнуто максимальное количество попыток переподключения")
-                # Сбрасываем счетчик попыток и адрес сервера для поиска нового
-                self.reconnect_attempts = 0
-                self.server_address = None
-
-    def handle_commands(self):
-        """Обработка команд от сервера"""
-        buffer = ""
+            # Переподключение выполняет планировщик в своем потоке
+            if self.running and self.active:
+                self.timers.call_later('discovery_query', 0, self.discovery_query)
+                self.schedule_reconnect()
+
+    def schedule_reconnect(self):
+        """После разрыва: сразу на доступный резервный сервер, иначе - с обычной задержкой"""
+        target = self.standby.failover_target() if self.standby else None
+        if not target:
+            # Серверы, объявившиеся во время подключения, соревнуются с текущим
+            if self.server_directory.promote_standby(self.server_address):
+                self.schedule_server_selection()
+            self.reconnect_scheduler.connection_lost()
+            return
+        logging.info(f"Переключаемся на резервный сервер {target[0]}:{target[1]}")
+        self.server_address = target
+        self.reconnect_scheduler.connection_lost(delay=random.uniform(0, STANDBY_FAILOVER_JITTER))
+
+    def check_standby(self):
+        """Задача таймеров: проверяет резервные серверы и возвращает клиента на приоритетный"""
+        try:
+            self.standby.probe_all()
+            if self.connected and self.check_failback():
+                self.disconnect_from_server()
+        except Exception as e:
+            logging.error(f"Ошибка при проверке резервных серверов: {str(e)}")
+
+    def check_failback(self):
+        """True, если пора вернуться на приоритетный сервер (переключение - при разрыве)"""
+        target = self.standby.failback_target()
+        if not target:
+            return False
+        logging.info(f"Приоритетный сервер {target[0]}:{target[1]} снова доступен, возвращаемся на него")
+        self.standby.prefer(target)
+        return True
+
+    def close_main_socket(self):
+        """Закрывает TCP-сокет соединения с сервером"""
+        if hasattr(self, 'main_socket') and self.main_socket:
+            try:
+                self.main_socket.shutdown(socket.SHUT_RDWR)
+            except Exception as e:
+                logging.debug(f"Ошибка при shutdown сокета: {str(e)}")
+            try:
+                self.main_socket.close()
+            except Exception as e:
+                logging.debug(f"Ошибка при закрытии сокета: {str(e)}")
+            self.main_socket = None
+
+    def on_reconnect_give_up(self):
+        """Размыкатель сработал: забываем адрес сервера и ждем discovery"""
+        self.server_address = None
+        self.discovery_active = True
+        logging.info("Активирован поиск нового сервера администратора")
+
+    def record_connected(self):
+        """Замеряет время от начала поиска сервера до подключения"""
+        if self.discovery_started is not None:
+            self.metrics.discovery_to_connect.observe(time.perf_counter() - self.discovery_started)
+            self.discovery_started = None
+
+    def get_heartbeat_stats(self):
+        """Текущий интервал ping, таймаут живости и RTT"""
+        return self.heartbeat.stats()
+
+    def get_reconnect_stats(self):
+        """Состояние и счетчики планировщика переподключений"""
+        return self.reconnect_scheduler.stats()
+
+    def handle_commands(self, decoder=None, pending=(), closed=None, sock=None):
+        """Обработка команд от сервера.
+
+        Читатель привязан к сокету и событию closed своего соединения: после
+        быстрого переключения он не читает новое соединение."""
+        decoder = decoder or FrameDecoder()
+        sock = sock or self.main_socket
+        closed = closed or self.connection_closed
+        if not sock:
+            logging.error("Сокет закрыт или не инициализирован")
+            self.disconnect_from_server(closed)
+            return
+        self.execute_frames(pending)
         
-        while self.connected and self.running:
+        while self.running and not closed.is_set():
             try:
-                if not self.main_socket:
-                    logging.error("Сокет закрыт или не инициализирован")
-                    break
-                    
                 try:
-                    # Устанавливаем таймаут на чтение
-                    self.main_socket.settimeout(30.0)
-                    data = self.main_socket.recv(BUFFER_SIZE)
+                    # Таймаут на чтение установлен при подключении (COMMAND_READ_TIMEOUT)
+                    commands = decoder.recv_from(sock)
+                    if closed.is_set():
+                        break
                     
-                    if not data:
+                    if commands is None:
                         logging.warning("Получены пустые данные от сервера - возможно, сервер закрыл соединение")
                         break
                         
                     self.last_server_response = time.time()
-                    
-                    try:
-                        buffer += data.decode('utf-8')
-                    except UnicodeDecodeError as e:
-                        logging.error(f"Ошибка декодирования данных: {str(e)}")
-                        continue
-                    
-                    while '\n' in buffer:
-                        command, buffer = buffer.split('\n', 1)
-                        command = command.strip()
-                        
-                        if command == "check_dnd_status":
-                            try:
-                                status = self.get_dnd_status()
-                                # Всегда отправляем с префиксом dnd_status:
-                                if not self.send_message(f"dnd_status:{status}"):
-                                    logging.error("Не удалось отправить статус DND")
-                            except Exception as e:
-                                logging.error(f"Ошибка при проверке статуса DND: {str(e)}")
-                        elif command.startswith("display_message:"):
-                            try:
-                                message = command.split(':', 1)[1]
-                                self.display_message(message)
-                                if not self.send_message("message_displayed"):
-                                    logging.error("Не удалось отправить подтверждение показа сообщения")
-                            except Exception as e:
-                                logging.error(f"Ошибка при отображении сообщения: {str(e)}")
+                    self.heartbeat.on_received()
+                    self.execute_frames(commands)
                                 
                 except socket.timeout:
                     # Проверяем время последнего ответа
-                    if time.time() - self.last_server_response > 60:  # 1 минута без ответа
+                    if self.heartbeat.is_dead():
                         logging.warning("Превышено время ожидания ответа от сервера")
                         break
                     continue
                     
-            except ConnectionError as e:
-                logging.error(f"Ошибка соединения: {str(e)}")
-                break
             except Exception as e:
-                logging.error(f"Неожиданная ошибка при обработке команд: {str(e)}")
+                if closed.is_set():
+                    break  # Сокет закрыт отключением - это не ошибка
+                if isinstance(e, ConnectionError):
+                    logging.error(f"Ошибка соединения: {str(e)}")
+                else:
+                    logging.error(f"Неожиданная ошибка при обработке команд: {str(e)}")
                 break
         
         logging.info("Завершение обработки команд")
-        self.disconnect_from_server()
+        self.disconnect_from_server(closed)
 
-    def send_message(self, message):
-        """Отправка сообщения серверу"""
-        if not self.connected or not self.main_socket:
-            logging.error("Попытка отправки сообщения при отключенном соединении")
-            return False
-            
+    def execute_frames(self, frames):
+        """Выполняет команды из кадров: без идентификатора - по порядку, с идентификатором - в пуле"""
+        for frame in frames:
+            for request_id, command in self.split_commands(frame):
+                if request_id is not None:
+                    self.command_pool.submit(self.run_request, request_id, command)
+                    continue
+                response = self.process_command(command)
+                if response and not self.send_message(response):
+                    logging.error(f"Не удалось отправить ответ {response.split(':', 1)[0]}")
+
+    def split_commands(self, frame):
+        """Разбирает кадр сервера в список пар (идентификатор запроса или None, команда)"""
+        frame = frame.strip()
+        if self.protocol_version < 2:
+            return [(None, frame)]
+        return [parse_tagged(message.strip()) for message in split_batch(frame)]
+
+    def answer_request(self, request_id, command):
+        """Выполняет команду с идентификатором и возвращает ответ с тем же тегом"""
         try:
-            if not message.endswith('\n'):
-                message += '\n'
-            
-            # Отправляем данные с таймаутом
-            self.main_socket.settimeout(5.0)
+            response = self.process_command(command)
+        except Exception as e:
+            logging.error(f"Ошибка при выполнении запроса #{request_id}: {str(e)}")
+            response = None
+        # Ответ нужен на каждый запрос, иначе сервер будет ждать его до таймаута
+        return tag_frame(request_id, response or "error")
+
+    def run_request(self, request_id, command):
+        """Выполняет запрос в пуле и отправляет ответ, как только он готов"""
+        if not self.send_message(self.answer_request(request_id, command)):
+            logging.error(f"Не удалось отправить ответ на запрос #{request_id}")
+
+    def process_command(self, command):
+        """Выполняет команду сервера и возвращает строку ответа (или None)"""
+        started = time.perf_counter()
+        try:
+            return self.execute_command(command)
+        finally:
+            self.metrics.command_seconds.labels(self.metrics.command_name(command)).observe(
+                time.perf_counter() - started)
+
+    def execute_command(self, command):
+        if command.startswith("@"):
+            identity, command = parse_addressed(command)
+            return address_frame(identity, self.execute_session_command(identity, command) or "error")
+        if command == "check_dnd_status":
             try:
-                message_bytes = message.encode('utf-8')
-                total_sent = 0
-                while total_sent < len(message_bytes):
-                    sent = self.main_socket.send(message_bytes[total_sent:])
-                    if sent == 0:
-                        logging.error("Соединение разорвано при отправке")
-                        return False
-                    total_sent += sent
-                return True
-            except socket.timeout:
-                logging.error("Таймаут при отправке сообщения")
-                return False
+                # Всегда отвечаем с префиксом dnd_status:
+                return f"dnd_status:{self.current_dnd_status()}"
             except Exception as e:
-                logging.error(f"Ошибка при отправке сообщения: {str(e)}")
-                return False
-            finally:
-                self.main_socket.settimeout(None)
-                
+                logging.error(f"Ошибка при проверке статуса DND: {str(e)}")
+        elif command == "check_status":
+            return "status:" + json.dumps(self.status.get().as_dict(), separators=(',', ':'))
+        elif command.startswith("display_message:"):
+            return self.display_message(command.split(':', 1)[1])
+        elif command == "pong":
+            self.heartbeat.on_pong()
+        elif command == "stats":
+            return "stats:" + json.dumps(self.metrics.snapshot(), separators=(',', ':'))
+        return None
+
+    def reconnect_frames(self):
+        """Первые кадры после рукопожатия: история разрыва, сжатое состояние и текущий статус DND.
+
+        Возвращает (кадры, статус DND хоста); в режиме службы вместо статуса
+        хоста уходят статусы пользователей, и статус хоста - None."""
+        current_status = None
+        messages, history = self.outbox.drain()
+        # Статусы DND (свой и пользователей) уходят ниже текущими значениями
+        frames = [message for message in messages if not OfflineOutbox.key(message).endswith("dnd_status")]
+        if not self.notification_events_enabled():
+            # События уведомлений - только серверу, который их согласовал
+            frames = [message for message in frames if not OfflineOutbox.key(message).startswith("message:")]
+            history = [entry for entry in history if not entry[1].startswith("message_")]
+        if frames or history:
+            logging.info(f"Отправляем состояние, накопленное без связи: {len(frames)} сообщений, "
+                         f"{len(history)} переходов")
+        if self.multiplexing():
+            frames.extend(self.session_frames())
+        else:
+            current_status = self.current_dnd_status()
+            frames.append(f"dnd_status:{current_status}")
+        if history and self.server_options.get('history') == 'zlib':
+            frames.insert(0, encode_history(history))
+        return self.pack_frames(frames), current_status
+
+    def log_initial_status(self, initial_status):
+        if initial_status is None:
+            logging.info(f"Отправлены статусы пользователей: {len(self.sessions)}")
+        else:
+            logging.info(f"Отправлен начальный статус DND: {initial_status}")
+
+    def pack_frames(self, frames):
+        """Несколько кадров подряд - одним кадром batch:, если протокол это позволяет"""
+        if self.protocol_version >= 2 and len(frames) > 1:
+            return [encode_batch(frames)]
+        return frames
+
+    def multiplexing(self):
+        """Служба передает статусы пользователей, и сервер объявил sessions=1"""
+        return self.sessions is not None and self.server_options.get('sessions') == '1'
+
+    def session_frames(self):
+        """Полное состояние сессий для нового соединения: session_open и статус каждого профиля"""
+        frames = []
+        with self.sessions.lock:
+            for session in self.sessions.all():
+                status = session.dnd_status()
+                if status is None:
+                    continue
+                session.last_dnd_status = status
+                frames.append(f"session_open:{session.identity}")
+                frames.append(address_frame(session.identity, f"dnd_status:{status}"))
+        return frames
+
+    def session_updates(self):
+        """Кадры по изменениям профилей с прошлой проверки (режим службы)"""
+        with self.sessions.lock:
+            opened, closed, changed = self.sessions.poll()
+            if not self.multiplexing():
+                return []
+            frames = []
+            if self.connected:
+                # Без связи открытие и закрытие не копятся: новое соединение получит полный список
+                frames.extend(f"session_open:{session.identity}" for session in opened)
+                frames.extend(f"session_close:{identity}" for identity in closed)
+            for session, status in changed:
+                session.last_dnd_status = status
+                frames.append(address_frame(session.identity, f"dnd_status:{status}"))
+        return self.pack_frames(frames) if self.connected else frames
+
+    def check_sessions(self):
+        """Задача таймеров: проверяет профили пользователей и сообщает серверу об изменениях"""
+        try:
+            for frame in self.session_updates():
+                self.send_message(frame)
         except Exception as e:
-            logging.error(f"Критическая ошибка при отправке сообщения: {str(e)}")
-            self.disconnect_from_server()
+            logging.error(f"Ошибка при проверке профилей пользователей: {e}")
+
+    def execute_session_command(self, identity, command):
+        """Команда сервера, адресованная сессии пользователя"""
+        session = self.sessions.get(identity) if self.sessions is not None else None
+        if session is None:
+            return "session_unknown"
+        if command == "check_dnd_status":
+            return f"dnd_status:{session.dnd_status() or '1'}"
+        if command == "check_status":
+            return "status:" + json.dumps(session.snapshot().as_dict(), separators=(',', ':'))
+        if command.startswith("display_message:"):
+            return self.display_message(f"{session.user}: {command.split(':', 1)[1]}")
+        return None
+
+    def send_message(self, message):
+        """Ставит сообщение серверу в очередь отправки (без связи - в outbox, если это состояние)"""
+        outbound = self.outbound
+        if not self.connected or not outbound:
+            if self.outbox.record(message):
+                logging.debug(f"Нет связи с сервером, сохранено до подключения: {message}")
+                return True
+            logging.error("Попытка отправки сообщения при отключенном соединении")
+            self.metrics.send_failures.labels('disconnected').inc()
             return False
+        if not outbound.put(message):
+            logging.error("Очередь отправки закрыта или переполнена")
+            self.metrics.send_failures.labels('queue_full').inc()
+            return False
+        return True
+
+    def get_outbound_stats(self):
+        """Метрики очереди отправки текущего соединения"""
+        outbound = self.outbound
+        return outbound.stats() if outbound else None
+
+    def get_settings_path(self):
+        """Путь к файлу настроек MicroSIP"""
+        return self.backend.settings_path()
+
+    def get_settings_reader(self):
+        """Кэширующий читатель microsip.ini (создается при первом обращении)"""
+        path = self.get_settings_path()
+        if self.settings_reader is None or self.settings_reader.path != path:
+            self.settings_reader = IniReader(path)
+        return self.settings_reader
+
+    def current_dnd_status(self):
+        """Статус DND из общего снимка (без обращения к диску, пока снимок свежий)"""
+        return self.status.get().dnd
+
+    def read_status_snapshot(self):
+        """Снимает статус с диска и из списка процессов (вызывается StatusService)"""
+        return StatusSnapshot(self.get_dnd_status(), self.is_microsip_running(), self.get_account_state())
+
+    def is_microsip_running(self):
+        """Запущен ли MicroSIP; None, если платформа не позволяет узнать"""
+        try:
+            return self.process_detector.running()
+        except Exception as e:
+            logging.debug(f"Не удалось проверить процесс MicroSIP: {e}")
+            return None
+
+    def get_account_state(self):
+        """Состояние учетной записи по accountId в microsip.ini"""
+        try:
+            account_id = self.get_settings_reader().get('accountId')
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logging.debug(f"Ошибка при чтении учетной записи: {e}")
+            return None
+        return 'configured' if account_id and account_id.strip() not in ('', '0') else 'none'
 
     def get_dnd_status(self):
         """Получение статуса DND из MicroSIP"""
+        started = time.perf_counter()
         try:
-            # Путь к файлу настроек MicroSIP
-            microsip_settings = os.path.join(os.getenv('APPDATA'), 'MicroSIP', 'microsip.ini')
-            
-            if not os.path.exists(microsip_settings):
+            reader = self.get_settings_reader()
+            try:
+                dnd_value = reader.get('DND')
+            except FileNotFoundError:
                 logging.warning("MicroSIP не установлен")
                 return "1"  # По умолчанию DND выключен
 
-            # Список кодировок для проверки
-            encodings = ['utf-16', 'utf-16le', 'utf-16be', 'utf-8', 'cp1251']
-            
-            # Сначала определяем BOM
-            with open(microsip_settings, 'rb') as f:
-                raw = f.read()
-                if raw.startswith(b'\xff\xfe'):
-                    encodings.insert(0, 'utf-16le')
-                elif raw.startswith(b'\xfe\xff'):
-                    encodings.insert(0, 'utf-16be')
-
-            # Пробуем разные кодировки
-            for encoding in encodings:
-                try:
-                    with open(microsip_settings, 'r', encoding=encoding) as f:
-                        content = f.read()
-                        for line in content.splitlines():
-                            if line.strip().startswith('DND='):
-                                dnd_value = line.strip().split('=')[1]
-                                # Проверяем, что значение - это число
-                                if dnd_value.isdigit():
-                                    return dnd_value  # Возвращаем "0" или "1"
-                        logging.warning("Статус DND не найден")
-                        return "1"  # По умолчанию DND выключен
-                except UnicodeError:
-                    continue
-                except Exception as e:
-                    logging.debug(f"Ошибка при чтении с кодировкой {encoding}: {e}")
-                    continue
-
-            # Если не удалось прочитать файл ни с одной кодировкой
-            # Пробуем прочитать побайтово
-            try:
-                with open(microsip_settings, 'rb') as f:
-                    content = f.read()
-                    dnd_pattern = b'DND='
-                    if dnd_pattern in content:
-                        pos = content.index(dnd_pattern) + len(dnd_pattern)
-                        # Ищем значение после DND=
-                        value = chr(content[pos])
-                        if value in ['0', '1']:
-                            return value
-            except Exception as e:
-                logging.error(f"Ошибка при побайтовом чтении: {e}")
+            # Проверяем, что значение - это число
+            if dnd_value is not None and dnd_value.isdigit():
+                return dnd_value  # Возвращаем "0" или "1"
 
-            logging.warning("Не удалось определить статус DND")
+            logging.warning("Статус DND не найден")
             return "1"  # По умолчанию DND выключен
             
         except Exception as e:
             logging.error(f"Ошибка при получении статуса DND: {e}")
             return "1"  # По умолчанию DND выключен
+        finally:
+            self.metrics.dnd_read.observe(time.perf_counter() - started)
 
     def monitor_dnd_status(self):
-        """Мониторинг изменений статуса DND"""
-        while self.connected and self.running:
-            try:
-                current_status = self.get_dnd_status()
-                if current_status != self.last_dnd_status:
-                    self.last_dnd_status = current_status
-                    # Всегда отправляем с префиксом dnd_status:
-                    if not self.send_message(f"dnd_status:{current_status}"):
-                        logging.error("Не удалось отправить обновление статуса DND")
-                        # При ошибке отправки сбрасываем last_dnd_status
-                        self.last_dnd_status = None
-                time.sleep(2)  # Уменьшаем интервал проверки до 2 секунд
-            except Exception as e:
-                logging.error(f"Ошибка при мониторинге DND: {e}")
-                self.last_dnd_status = None  # Сбрасываем статус при ошибке
-                time.sleep(2)
+        """Мониторинг изменений статуса DND через наблюдатель за файлом настроек"""
+        if self.dnd_watcher or self.multiplexing():
+            return
+        try:
+            self.dnd_watcher = create_file_watcher(self.get_settings_path(), self.on_settings_changed,
+                                                   timers=self.timers)
+            self.dnd_watcher.start()
+        except Exception as e:
+            logging.error(f"Ошибка при запуске мониторинга DND: {e}")
+            self.dnd_watcher = None
+        self.status.set_ttl(self.status_ttl())
+
+    def status_ttl(self):
+        """Снимок без срока, если об изменениях сообщают события, а не опрос.
+
+        Файл отслеживает нативный наблюдатель, а запуск и закрытие MicroSIP -
+        режим сна (переход сбрасывает снимок). Иначе - STATUS_TTL."""
+        watcher = self.dnd_watcher
+        if SLEEP_MODE and watcher is not None and not isinstance(watcher, PollingWatcher):
+            return None
+        return STATUS_TTL
+
+    def on_settings_changed(self, path):
+        """Вызывается наблюдателем, когда microsip.ini действительно изменился"""
+        if not self.running:
+            return
+        self.status.invalidate()
+        try:
+            current_status = self.current_dnd_status()
+            if current_status != self.last_dnd_status:
+                self.last_dnd_status = current_status
+                # Всегда отправляем с префиксом dnd_status:
+                if not self.send_message(f"dnd_status:{current_status}"):
+                    logging.error("Не удалось отправить обновление статуса DND")
+                    # При ошибке отправки сбрасываем last_dnd_status
+                    self.last_dnd_status = None
+        except Exception as e:
+            logging.error(f"Ошибка при мониторинге DND: {e}")
+            self.last_dnd_status = None  # Сбрасываем статус при ошибке
 
     def display_message(self, message):
-        """Отображает сообщение в виде уведомления"""
+        """Ставит сообщение в очередь показа; подтверждение уходит сразу, не дожидаясь пользователя.
+
+        Серверу, объявившему notify=1, отвечает message_displayed:id или
+        message_dropped:id:причина; остальным - прежним message_displayed."""
         try:
-            self.notification_manager.show_notification(
-                "Сообщение от СВО",
-                message
-            )
-            return "message_displayed"
+            notification_id, reason = self.notification_manager.submit("Сообщение от СВО", message)
         except Exception as e:
             logging.error(f"Ошибка при отображении сообщения: {e}")
             return "error_displaying_message"
+        if not self.notification_events_enabled():
+            return "message_displayed"
+        if reason is not None:
+            return self.notification_event_frame('dropped', notification_id, reason)
+        return f"message_displayed:{notification_id}"
 
-    def check_updates_periodically(self):
-        """Периодически проверяет наличие обновлений"""
-        while self.running:
-            try:
-                self.update_manager.check_for_updates()
-            except Exception as e:
-                logging.error(f"Ошибка при проверке обновлений: {e}")
-            time.sleep(UPDATE_CHECK_INTERVAL)
+    def notification_events_enabled(self):
+        """Сервер объявил notify=1: понимает id уведомлений и события message_shown/dismissed/dropped"""
+        return self.server_options.get('notify') == '1'
+
+    def on_notification_event(self, event, notification_id, reason=None):
+        """Сообщает серверу о показе или закрытии уведомления (message_shown:id и т.д.)"""
+        if self.connected and not self.notification_events_enabled():
+            return
+        self.send_message(self.notification_event_frame(event, notification_id, reason))
+
+    @staticmethod
+    def notification_event_frame(event, notification_id, reason=None):
+        frame = f"message_{event}:{notification_id}"
+        return f"{frame}:{reason}" if reason else frame
+
+    def stop_metrics_server(self):
+        server, self.metrics_server = self.metrics_server, None
+        if server:
+            server.shutdown()
+            server.server_close()
+
+    def get_notification_stats(self):
+        """Счетчики показанных и отброшенных уведомлений"""
+        return self.notification_manager.stats()
+
+    def check_updates(self):
+        """Задача таймеров: проверяет наличие обновлений; возвращает задержку до следующей проверки"""
+        manager = self.update_manager
+        manager.start_peer_cache()  # Раздача соседям (если уже идет - ничего не делает)
+        started = time.perf_counter()
+        try:
+            manager.check_for_updates()
+        except Exception as e:
+            logging.error(f"Ошибка при проверке обновлений: {e}")
+        self.metrics.update_check.observe(time.perf_counter() - started)
+        return manager.next_check_delay()
+
+    def deactivate(self):
+        """Засыпание: закрывает соединение и сокеты, останавливает потоки и наблюдателей"""
+        self.active_stop.set()
+        self.timers.cancel(*self.ACTIVE_TIMERS)
+        self.wake_discovery()
+        self.reconnect_scheduler.stop()
+        self.disconnect_from_server()
+        self.reconnect_scheduler.reset()
+        self.server_address = None  # После пробуждения - сервер из кэша или discovery
+        if self.command_pool:
+            self.command_pool.shutdown(wait=False)
+        self.stop_local_services()
+        self.discovery_thread.join(2)
+        self.status.invalidate()
+        self.sleep_probe_interval = SLEEP_PROBE_INTERVAL  # MicroSIP могут сразу запустить снова
+
+    def stop_local_services(self):
+        """Останавливает наблюдатель за microsip.ini и раздачу обновления соседям"""
+        if self.dnd_watcher:
+            self.dnd_watcher.stop()
+            self.dnd_watcher = None
+        self.status.set_ttl(STATUS_TTL)
+        self.update_manager.stop_peer_cache()
+
+    def update_activity(self):
+        """Режим сна: будит клиента при запуске MicroSIP и усыпляет, когда он закрыт (задача таймеров)"""
+        running = self.process_detector.running()
+        if running is False and self.active:
+            logging.info("MicroSIP закрыт, клиент засыпает")
+            self.deactivate()
+        elif running is not False and not self.active:
+            logging.info("MicroSIP запущен, клиент просыпается")
+            self.wakeups += 1
+            self.activate()
+        return SLEEP_AWAKE_PROBE_INTERVAL if self.active else self.next_sleep_probe()
+
+    def next_sleep_probe(self):
+        """Интервал до следующей проверки во сне: пока MicroSIP нет, проверки все реже"""
+        interval = self.sleep_probe_interval
+        self.sleep_probe_interval = min(SLEEP_PROBE_MAX_INTERVAL, interval * SLEEP_PROBE_BACKOFF)
+        return interval
+
+    def stop(self):
+        """Запрашивает остановку клиента"""
+        self.running = False
+        self.timers.stop()
 
     def run(self):
         """Запуск клиента"""
         try:
             logging.info(f"Клиент запущен (hostname: {self.hostname})")
             
-            # Держим главный поток активным
-            while self.running:
-                time.sleep(1)
+            # Главный поток выполняет задачи таймеров; во сне среди них только проверка запуска MicroSIP
+            if SLEEP_MODE:
+                self.timers.call_later('activity', 0, self.update_activity)
+            self.timers.run()
                 
         except KeyboardInterrupt:
             logging.info("Получен сигнал завершения работы")
         finally:
             self.running = False
+            self.active_stop.set()
+            self.timers.stop()
+            self.wake_discovery()
+            self.reconnect_scheduler.stop()
+            if self.command_pool:
+                self.command_pool.shutdown(wait=False)
+            self.stop_local_services()
+            self.notification_manager.close()
+            self.stop_metrics_server()
             self.disconnect_from_server()
             logging.info("Клиент остановлен")
 
+def import_asyncio():
+    """Импортирует asyncio в глобальное имя модуля.
+
+    asyncio - самый дорогой импорт (~50 мс), а нужен только AsyncMicrosipClient,
+    поэтому его импортирует конструктор этого клиента, а не загрузка client.py."""
+    global asyncio
+    import asyncio
+    return asyncio
+
+class DiscoveryProtocol:
+    """UDP-протокол для приема широковещательных пакетов сервера.
+
+    Реализует интерфейс asyncio.DatagramProtocol без наследования, чтобы
+    объявление класса не требовало импорта asyncio."""
+    def __init__(self, on_datagram):
+        self.on_datagram = on_datagram
+
+    def connection_made(self, transport):
+        pass
+
+    def connection_lost(self, exc):
+        pass
+
+    def pause_writing(self):
+        pass
+
+    def resume_writing(self):
+        pass
+
+    def datagram_received(self, data, addr):
+        self.on_datagram(data, addr)
+
+    def error_received(self, exc):
+        logging.error(f"Ошибка при поиске сервера: {str(exc)}")
+
+class AsyncMicrosipClient(MicrosipClient):
+    """Клиент на asyncio: поиск сервера, чтение команд, ping, мониторинг DND и
+    проверка обновлений работают задачами одного цикла событий.
+
+    Протокол тот же, что у MicrosipClient. Блокирующие вызовы (чтение ini,
+    уведомления, обновления) выполняются в пуле фиксированного размера, поэтому
+    число потоков не растет при переподключениях.
+    """
+    EXECUTOR_WORKERS = 4
+
+    def __init__(self, *args, **kwargs):
+        import_asyncio()
+        super().__init__(*args, **kwargs)
+
+    def start_background_threads(self):
+        """Фоновые задачи запускаются в run(), отдельных потоков не создаем"""
+        self.loop = None
+        self.main_task = None
+        self.reader = None
+        self.writer = None
+        self.reconnect_wakeup = None
+        self.dnd_changed = None
+        self.update_wakeup = None
+        self.executor = self.create_executor()
+
+    def create_executor(self):
+        """Пул для блокирующих вызовов (пересоздается при каждом пробуждении)"""
+        from concurrent.futures import ThreadPoolExecutor
+        return ThreadPoolExecutor(max_workers=self.EXECUTOR_WORKERS, thread_name_prefix='microsip-io')
+
+    async def run_blocking(self, func, *args):
+        """Выполняет блокирующую функцию в пуле потоков"""
+        return await self.loop.run_in_executor(self.executor, func, *args)
+
+    async def main(self):
+        self.loop = asyncio.get_running_loop()
+        self.main_task = asyncio.current_task()
+        self.reconnect_wakeup = asyncio.Event()
+        self.dnd_changed = asyncio.Event()
+        self.update_wakeup = asyncio.Event()
+        # Задачи таймеров общих компонентов (polling-наблюдатель, объявления о раздаче) - в этом же цикле
+        timers = asyncio.create_task(self.timers.run_async())
+        try:
+            while self.running:
+                # Во сне в цикле событий нет ничего, кроме этой проверки
+                if SLEEP_MODE and self.process_detector.running() is False:
+                    await asyncio.sleep(self.next_sleep_probe())
+                    continue
+                await self.active_phase()
+        finally:
+            timers.cancel()
+
+    async def active_phase(self):
+        """Работа клиента, пока запущен MicroSIP (без режима сна - до остановки)"""
+        if SLEEP_MODE:
+            logging.info("MicroSIP запущен, клиент просыпается")
+            self.wakeups += 1
+        self.active_stop = threading.Event()
+        if self.executor is None:
+            self.executor = self.create_executor()
+        self.try_cached_server()
+        tasks = [
+            asyncio.create_task(self.discovery_task()),
+            asyncio.create_task(self.connection_task()),
+            asyncio.create_task(self.dnd_task()),
+            asyncio.create_task(self.update_task()),
+        ]
+        if self.standby:
+            tasks.append(asyncio.create_task(self.standby_task()))
+        if self.sessions is not None:
+            tasks.append(asyncio.create_task(self.sessions_task()))
+        work = asyncio.gather(*tasks)
+        watch = asyncio.create_task(self.activity_task()) if SLEEP_MODE else None
+        try:
+            if watch:
+                await asyncio.wait([work, watch], return_when=asyncio.FIRST_COMPLETED)
+                if work.done():
+                    work.result()
+            else:
+                await work
+        finally:
+            self.active_stop.set()
+            if watch:
+                watch.cancel()
+            work.cancel()
+            await asyncio.gather(work, *tasks, return_exceptions=True)
+            await self.close_connection()
+            if self.running:
+                self.deactivate()
+
+    def deactivate(self):
+        """Засыпание: задачи уже отменены, соединение закрыто - освобождаем потоки и наблюдателей"""
+        self.reconnect_scheduler.reset()
+        self.server_address = None
+        self.stop_local_services()
+        executor, self.executor = self.executor, None
+        executor.shutdown(wait=False)
+        self.status.invalidate()
+        self.sleep_probe_interval = SLEEP_PROBE_INTERVAL  # MicroSIP могут сразу запустить снова
+
+    async def activity_task(self):
+        """Завершается, когда MicroSIP закрыт"""
+        while self.process_detector.running() is not False:
+            await asyncio.sleep(SLEEP_AWAKE_PROBE_INTERVAL)
+        logging.info("MicroSIP закрыт, клиент засыпает")
+
+    def on_discovery_datagram(self, data, addr):
+        """Обрабатывает пакет ADMIN_SERVER_DISCOVERY или объявление обновления"""
+        server = parse_discovery_message(data)
+        if server is None:
+            if self.update_manager.on_peer_announcement(addr[0], data):
+                self.update_wakeup.set()
+        elif self.on_server_announced(server):
+            self.schedule_server_selection()
+
+    def schedule_server_selection(self):
+        """Выбор сервера после окна сбора кандидатов"""
+        self.loop.call_later(self.server_directory.seconds_until_selection(0),
+                             lambda: asyncio.ensure_future(self.select_server_async()))
+
+    async def select_server_async(self):
+        """Выбор сервера с замером RTT в пуле потоков"""
+        await self.run_blocking(self.select_server)
+        self.reconnect_wakeup.set()
+
+    async def discovery_task(self):
+        """Слушает широковещательные пакеты сервера администратора"""
+        logging.info("Начат поиск сервера администратора...")
+        while self.running:
+            transport = None
+            try:
+                discovery_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                discovery_socket.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+                discovery_socket.bind(('', self.discovery_port))
+                self.discovery_port = discovery_socket.getsockname()[1]
+                transport, _ = await self.loop.create_datagram_endpoint(
+                    lambda: DiscoveryProtocol(self.on_discovery_datagram),
+                    sock=discovery_socket
+                )
+                # Транспорт живет до отмены задачи; пока нет подключения, шлем активные запросы
+                while True:
+                    if not self.connected:
+                        try:
+                            transport.sendto(DISCOVERY_QUERY_MESSAGE, self.query_address)
+                        except OSError as e:
+                            logging.debug(f"Не удалось отправить запрос поиска сервера: {str(e)}")
+                    await asyncio.sleep(DISCOVERY_QUERY_INTERVAL)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"Ошибка при поиске сервера: {str(e)}")
+                await asyncio.sleep(RECONNECT_BASE_DELAY)
+            finally:
+                if transport:
+                    transport.close()
+
+    async def connection_task(self):
+        """Подключается к найденному серверу и переподключается по планировщику"""
+        scheduler = self.reconnect_scheduler
+        while self.running:
+            delay = scheduler.seconds_until_attempt()
+            if delay is None or delay > 0:
+                try:
+                    await asyncio.wait_for(self.reconnect_wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                self.reconnect_wakeup.clear()
+                continue
+
+            scheduler.begin_attempt()
+            address = self.server_address
+            success = bool(address) and await self.connect_async(address)
+            if scheduler.finish_attempt(success):
+                logging.warning(f"Не удалось подключиться {MAX_RECONNECT_ATTEMPTS} раз подряд, возвращаемся к поиску сервера")
+                self.on_reconnect_give_up()
+            if success:
+                await self.session()
+                await self.close_connection()
+                self.schedule_reconnect()
+
+    async def connect_async(self, address):
+        """Устанавливает соединение и выполняет рукопожатие hostname/CONNECTION_ACCEPTED"""
+        logging.info(f"Попытка подключения к серверу {address}")
+        handshake_started = time.perf_counter()
+        writer = None
+        timeout = self.connect_timeout(address)
+        try:
+            try:
+                reader, writer = await asyncio.wait_for(
+                    asyncio.open_connection(address[0], address[1]), timeout
+                )
+            except (OSError, asyncio.TimeoutError):
+                self.on_connect_failed(address, timeout)
+                raise
+            self.configure_socket(writer.get_extra_info('socket'))
+            writer.write(f"{self.hostname}\n".encode('utf-8'))
+            await writer.drain()
+            confirmation = await asyncio.wait_for(reader.readline(), SERVER_CONNECT_TIMEOUT)
+            confirmation = confirmation.decode('utf-8', errors='replace').strip()
+            options = parse_handshake_reply(confirmation)
+            if options is None:
+                logging.error(f"Неожиданный ответ от сервера: {confirmation}")
+                writer.close()
+                return False
+            self.protocol_version = negotiated_protocol(options)
+            self.server_options = options
+        except asyncio.TimeoutError:
+            logging.error("Таймаут при подключении к серверу")
+            if writer:
+                writer.close()
+            return False
+        except Exception as e:
+            logging.error(f"Ошибка при подключении к серверу: {str(e)}")
+            if writer:
+                writer.close()
+            return False
+
+        logging.info("Подключение подтверждено сервером")
+        handshake_rtt = time.perf_counter() - handshake_started
+        self.heartbeat.reset(timeout=negotiated_timeout(options), rtt=handshake_rtt)
+        self.server_address = address  # Подключены к нему, что бы ни выбрал select_server
+        self.server_directory.save_cache(address, handshake_rtt)
+        if self.standby:
+            self.standby.set_active(address)
+        self.reader, self.writer = reader, writer
+        self.connected = True
+        self.last_server_response = time.time()
+        self.discovery_active = False
+        self.record_connected()
+        return True
+
+    async def session(self):
+        """Обслуживает установленное соединение до его разрыва"""
+        if self.protocol_version >= 2:
+            await self.send_message_async(f"proto:{self.protocol_version}")
+            logging.info(f"Согласован протокол версии {self.protocol_version}")
+        frames, initial_status = await self.run_blocking(self.reconnect_frames)
+        if all([await self.send_message_async(frame) for frame in frames]):
+            self.last_dnd_status = initial_status
+        self.log_initial_status(initial_status)
+        self.monitor_dnd_status()
+        logging.info(f"Успешно подключились к серверу {self.server_address}")
+
+        tasks = [
+            asyncio.create_task(self.read_commands()),
+            asyncio.create_task(self.heartbeat_task()),
+        ]
+        try:
+            await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def close_connection(self):
+        """Закрывает текущее соединение"""
+        if not self.connected and not self.writer:
+            return
+        logging.info("Отключение от сервера...")
+        self.connected = False
+        writer, self.writer, self.reader = self.writer, None, None
+        if writer:
+            writer.close()
+            try:
+                await asyncio.wait_for(writer.wait_closed(), 1)
+            except Exception as e:
+                logging.debug(f"Ошибка при закрытии сокета: {str(e)}")
+        self.discovery_active = True
+        self.discovery_started = self.discovery_started or time.perf_counter()
+        logging.info("Активирован поиск нового сервера администратора")
+
+    async def read_commands(self):
+        """Читает и выполняет команды сервера"""
+        decoder = FrameDecoder()
+        requests = set()  # Выполняющиеся запросы с идентификатором
+        try:
+            while True:
+                try:
+                    data = await asyncio.wait_for(self.reader.read(RECV_BUFFER_SIZE), 30.0)
+                except asyncio.TimeoutError:
+                    if self.heartbeat.is_dead():
+                        logging.warning("Превышено время ожидания ответа от сервера")
+                        return
+                    continue
+                except ConnectionError as e:
+                    logging.error(f"Ошибка соединения: {str(e)}")
+                    return
+
+                if not data:
+                    logging.warning("Получены пустые данные от сервера - возможно, сервер закрыл соединение")
+                    return
+                self.last_server_response = time.time()
+                self.heartbeat.on_received()
+
+                for frame in decoder.feed(data):
+                    for request_id, command in self.split_commands(frame):
+                        if request_id is not None:
+                            task = asyncio.create_task(self.request_task(request_id, command))
+                            requests.add(task)
+                            task.add_done_callback(requests.discard)
+                            continue
+                        response = await self.run_blocking(self.process_command, command)
+                        if response and not await self.send_message_async(response):
+                            logging.error(f"Не удалось отправить ответ {response.split(':', 1)[0]}")
+        finally:
+            for task in list(requests):
+                task.cancel()
+
+    async def request_task(self, request_id, command):
+        """Выполняет запрос в пуле и отправляет ответ, как только он готов"""
+        response = await self.run_blocking(self.answer_request, request_id, command)
+        if not await self.send_message_async(response):
+            logging.error(f"Не удалось отправить ответ на запрос #{request_id}")
+
+    async def heartbeat_task(self):
+        """Отправляет ping, когда нет другого трафика, и проверяет, что сервер отвечает"""
+        while True:
+            action, wait = self.heartbeat.next_action()
+            if action == 'dead':
+                logging.warning(f"Нет ответа от сервера более {self.heartbeat.timeout:.0f} секунд "
+                                f"или не отвечены ping подряд")
+                return
+            if action == 'ping':
+                logging.debug("Отправляем ping серверу")
+                self.heartbeat.on_ping()
+                if not await self.send_message_async("ping"):
+                    logging.error("Не удалось отправить ping")
+                    return
+                continue
+            await asyncio.sleep(wait)
+
+    async def send_message_async(self, message):
+        """Отправка сообщения серверу из цикла событий"""
+        if not self.connected or not self.writer:
+            if self.outbox.record(message):
+                logging.debug(f"Нет связи с сервером, сохранено до подключения: {message}")
+                return True
+            logging.error("Попытка отправки сообщения при отключенном соединении")
+            self.metrics.send_failures.labels('disconnected').inc()
+            return False
+        started = time.perf_counter()
+        try:
+            self.writer.write(encode_frame(message))
+            await asyncio.wait_for(self.writer.drain(), 5.0)
+            self.heartbeat.on_sent()
+            self.metrics.send_latency.observe(time.perf_counter() - started)
+            return True
+        except asyncio.TimeoutError:
+            logging.error("Таймаут при отправке сообщения")
+            self.metrics.send_failures.labels('timeout').inc()
+        except Exception as e:
+            logging.error(f"Ошибка при отправке сообщения: {str(e)}")
+            self.metrics.send_failures.labels('socket_error').inc()
+        return False
+
+    def on_notification_event(self, event, notification_id, reason=None):
+        """Вызывается из UI-потока уведомлений - отправляем событие из цикла"""
+        frame = self.notification_event_frame(event, notification_id, reason)
+        if self.connected and not self.notification_events_enabled():
+            return
+        if not self.connected or not self.loop:
+            self.outbox.record(frame)
+            return
+        try:
+            self.loop.call_soon_threadsafe(lambda: asyncio.ensure_future(self.send_message_async(frame)))
+        except RuntimeError:
+            pass
+
+    def on_settings_changed(self, path):
+        """Вызывается из потока наблюдателя - передаем событие в цикл"""
+        self.status.invalidate()
+        try:
+            self.loop.call_soon_threadsafe(self.dnd_changed.set)
+        except (AttributeError, RuntimeError):
+            pass
+
+    async def dnd_task(self):
+        """Отправляет серверу изменения статуса DND"""
+        while True:
+            await self.dnd_changed.wait()
+            self.dnd_changed.clear()
+            current_status = await self.run_blocking(self.current_dnd_status)
+            if current_status != self.last_dnd_status:
+                self.last_dnd_status = current_status
+                if not await self.send_message_async(f"dnd_status:{current_status}"):
+                    logging.error("Не удалось отправить обновление статуса DND")
+                    self.last_dnd_status = None
+
+    async def sessions_task(self):
+        """Проверяет профили пользователей и сообщает серверу об изменениях"""
+        while True:
+            try:
+                for frame in await self.run_blocking(self.session_updates):
+                    await self.send_message_async(frame)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"Ошибка при проверке профилей пользователей: {e}")
+            await asyncio.sleep(SERVICE_POLL_INTERVAL)
+
+    async def standby_task(self):
+        """Проверяет резервные серверы и возвращает клиента на приоритетный"""
+        while True:
+            try:
+                await self.run_blocking(self.standby.probe_all)
+                if self.connected and self.check_failback():
+                    await self.close_connection()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"Ошибка при проверке резервных серверов: {str(e)}")
+            await asyncio.sleep(STANDBY_PROBE_INTERVAL)
+
+    async def update_task(self):
+        """Периодически проверяет наличие обновлений"""
+        manager = self.update_manager
+        await self.run_blocking(manager.start_peer_cache)
+        while True:
+            started = time.perf_counter()
+            try:
+                await self.run_blocking(manager.check_for_updates)
+            except Exception as e:
+                logging.error(f"Ошибка при проверке обновлений: {e}")
+            self.metrics.update_check.observe(time.perf_counter() - started)
+            try:
+                await asyncio.wait_for(self.update_wakeup.wait(), manager.next_check_delay())
+            except asyncio.TimeoutError:
+                pass
+            self.update_wakeup.clear()
+
+    def stop(self):
+        """Запрашивает остановку клиента (можно вызывать из любого потока)"""
+        self.running = False
+        if self.loop and self.main_task:
+            self.loop.call_soon_threadsafe(self.main_task.cancel)
+
+    def run(self):
+        """Запуск клиента"""
+        logging.info(f"Клиент запущен (hostname: {self.hostname}, engine: asyncio)")
+        try:
+            asyncio.run(self.main())
+        except (KeyboardInterrupt, asyncio.CancelledError):
+            logging.info("Получен сигнал завершения работы")
+        finally:
+            self.running = False
+            self.active_stop.set()
+            self.stop_local_services()
+            self.notification_manager.close()
+            self.stop_metrics_server()
+            if self.executor:
+                self.executor.shutdown(wait=False)
+            logging.info("Клиент остановлен")
+
 if __name__ == "__main__":
-    client = MicrosipClient()
-    client.run() 
\ No newline at end of file
+    setup_logging(LOG_FILE, getattr(logging, LOG_LEVEL, logging.INFO))
+    if "--asyncio" in sys.argv or os.getenv("MICROSIP_CLIENT_ENGINE") == "asyncio":
+        client = AsyncMicrosipClient()
+    else:
+        client = MicrosipClient()
+    client.run()
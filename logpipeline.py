@@ -0,0 +1,158 @@
+# logpipeline.py
+"""Неблокирующее логирование клиента.
+
+Потоки клиента только кладут запись в очередь (QueueHandler), а
+форматирует и пишет на диск и в консоль отдельный поток QueueListener.
+Одинаковые сообщения (то же место вызова, шаблон и аргументы)
+ограничиваются по частоте прямо в вызывающем потоке: лишние не попадают
+даже в очередь, а их число дописывается к следующему пропущенному
+сообщению. Файл ротируется по размеру и по времени.
+
+Модуль не зависит от client.py и Windows API.
+"""
+import atexit
+import copy
+import logging
+import logging.handlers
+import queue
+import sys
+import threading
+import time
+
+LOG_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+LOG_MAX_BYTES = 5 * 1024 * 1024  # Ротация по размеру
+LOG_ROTATE_INTERVAL = 24 * 3600  # Ротация по времени (секунды)
+LOG_BACKUP_COUNT = 5  # Сколько старых файлов хранить
+LOG_QUEUE_SIZE = 10000  # Максимум записей, ожидающих записи на диск
+LOG_RATE_BURST = 5  # Сколько одинаковых сообщений пропускать подряд
+LOG_RATE_PERIOD = 60.0  # Окно ограничения частоты (секунды)
+LOG_RATE_KEYS = 1000  # Сколько окон хранить до очистки истекших
+
+
+class RateLimitFilter(logging.Filter):
+    """Ограничивает частоту одинаковых записей.
+
+    В каждом окне period пропускается не больше burst записей с одним
+    ключом (файл, строка, уровень, шаблон сообщения и его аргументы), так
+    что разные сообщения из одного места вызова друг друга не подавляют.
+    Остальные отбрасываются и считаются, а первая пропущенная после этого
+    запись сообщает, сколько было подавлено. Сообщение при этом не
+    форматируется.
+    """
+
+    def __init__(self, burst=LOG_RATE_BURST, period=LOG_RATE_PERIOD):
+        super().__init__()
+        self.burst = burst
+        self.period = period
+        self.windows = {}  # ключ -> [начало окна, пропущено, подавлено]
+        self.suppressed_total = 0
+        self.expire_at = LOG_RATE_KEYS
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        with self.lock:
+            return self._admit(record)
+
+    @staticmethod
+    def _key(record):
+        key = (record.pathname, record.lineno, record.levelno, str(record.msg), record.args)
+        try:
+            hash(key)
+        except TypeError:
+            # Аргументы-словари и списки не хешируются
+            key = key[:4] + (repr(record.args),)
+        return key
+
+    def _admit(self, record):
+        key = self._key(record)
+        now = record.created
+        window = self.windows.get(key)
+        if window is None or now - window[0] >= self.period:
+            suppressed = window[2] if window else 0
+            self.windows[key] = [now, 1, 0]
+            if suppressed:
+                # Шаблон и аргументы сохраняются: сообщение соберет поток записи
+                record.msg = f"{record.msg} (подавлено таких же сообщений: {suppressed})"
+            if len(self.windows) > self.expire_at:
+                self._expire(now)
+                self.expire_at = max(LOG_RATE_KEYS, 2 * len(self.windows))
+            return True
+        if window[1] < self.burst:
+            window[1] += 1
+            return True
+        window[2] += 1
+        self.suppressed_total += 1
+        return False
+
+    def _expire(self, now):
+        for key in [k for k, w in self.windows.items() if now - w[0] >= self.period and not w[2]]:
+            del self.windows[key]
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler, который при переполнении очереди отбрасывает запись, а не блокирует"""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        """Не форматирует в вызывающем потоке (в отличие от QueueHandler): это делает поток записи"""
+        return copy.copy(record)
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class SizeAndTimeRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    """Ротация по размеру файла или по истечении interval секунд"""
+
+    def __init__(self, filename, max_bytes=LOG_MAX_BYTES, interval=LOG_ROTATE_INTERVAL,
+                 backup_count=LOG_BACKUP_COUNT):
+        super().__init__(filename, maxBytes=max_bytes, backupCount=backup_count,
+                         encoding='utf-8', delay=True)
+        self.interval = interval
+        self.rollover_at = time.time() + interval
+
+    def shouldRollover(self, record):
+        if time.time() >= self.rollover_at:
+            return True
+        return super().shouldRollover(record)
+
+    def doRollover(self):
+        super().doRollover()
+        self.rollover_at = time.time() + self.interval
+
+
+def setup_logging(path='client.log', level=logging.INFO, console=True,
+                  burst=LOG_RATE_BURST, period=LOG_RATE_PERIOD):
+    """Настраивает корневой логгер на очередь и запускает поток записи; возвращает listener"""
+    handlers = [SizeAndTimeRotatingFileHandler(path)]
+    if console and sys.stdout is not None:
+        # В оконной сборке PyInstaller консоли нет
+        handlers.append(logging.StreamHandler(sys.stdout))
+    formatter = logging.Formatter(LOG_FORMAT)
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    queue_handler = DroppingQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+    queue_handler.addFilter(RateLimitFilter(burst, period))
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+
+    listener = logging.handlers.QueueListener(queue_handler.queue, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(stop_logging, listener)
+    return listener
+
+
+def stop_logging(listener):
+    """Дописывает накопленные записи и останавливает поток (повторный вызов безопасен)"""
+    if getattr(listener, '_thread', None) is not None:
+        listener.stop()
@@ -0,0 +1,258 @@
+# metrics.py
+"""Реестр метрик клиента: счетчики и гистограммы задержек.
+
+Отдается в текстовом формате Prometheus (render) и компактным словарем для
+команды stats (snapshot). На горячем пути - только bisect и сложение под
+коротким локом; значения, которые и так считают другие объекты (очередь
+отправки, планировщик переподключений), читаются функциями в момент
+опроса и не стоят ничего, пока их не спрашивают.
+
+Модуль не зависит от client.py и Windows API.
+"""
+import bisect
+import logging
+import threading
+
+# Границы корзин гистограмм (секунды)
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SLOW_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, help, label_names=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(label_names)
+        self.lock = threading.Lock()
+        self.children = {}
+
+    def labels(self, *values):
+        """Метрика с конкретными значениями меток (кэшируется)"""
+        child = self.children.get(values)
+        if child is None:
+            with self.lock:
+                child = self.children.setdefault(values, self._new_child())
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def _default(self):
+        return self.labels()
+
+
+class CounterValue:
+    __slots__ = ('lock', 'value')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.value = 0
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+
+class Counter(Metric):
+    """Счетчик; имя по соглашению Prometheus оканчивается на _total"""
+    kind = 'counter'
+
+    def _new_child(self):
+        return CounterValue()
+
+    def inc(self, amount=1):
+        self._default().inc(amount)
+
+    def samples(self):
+        for values, child in list(self.children.items()):
+            yield self.name, values, (), child.value
+
+    def snapshot(self):
+        return {self._key(values): child.value for values, child in list(self.children.items())}
+
+    def _key(self, values):
+        return self.name + (':' + ','.join(values) if values else '')
+
+
+class HistogramValue:
+    __slots__ = ('lock', 'bounds', 'counts', 'sum', 'count')
+
+    def __init__(self, bounds):
+        self.lock = threading.Lock()
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.bounds, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def quantile(self, fraction):
+        """Оценка квантиля по верхней границе корзины"""
+        with self.lock:
+            counts, total = list(self.counts), self.count
+        if not total:
+            return 0.0
+        rank = fraction * total
+        seen = 0
+        for bound, count in zip(self.bounds + (float('inf'),), counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, label_names=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, label_names)
+        self.buckets = tuple(buckets)
+
+    def _new_child(self):
+        return HistogramValue(self.buckets)
+
+    def observe(self, value):
+        self._default().observe(value)
+
+    def samples(self):
+        for values, child in list(self.children.items()):
+            with child.lock:
+                counts, total, count = list(child.counts), child.sum, child.count
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                yield self.name + '_bucket', values, (('le', _format_value(bound)),), cumulative
+            yield self.name + '_sum', values, (), total
+            yield self.name + '_count', values, (), count
+
+    def snapshot(self):
+        result = {}
+        for values, child in list(self.children.items()):
+            key = self.name + (':' + ','.join(values) if values else '')
+            p50, p99 = child.quantile(0.5), child.quantile(0.99)
+            result[key] = {
+                'count': child.count,
+                'sum': round(child.sum, 6),
+                # В корзине +Inf оценки нет
+                'p50': p50 if p50 != float('inf') else None,
+                'p99': p99 if p99 != float('inf') else None,
+            }
+        return result
+
+
+class FunctionMetric:
+    """Значение, вычисляемое функцией при опросе (counter или gauge)"""
+
+    def __init__(self, name, help, kind, func):
+        self.name = name
+        self.help = help
+        self.kind = kind
+        self.func = func
+        self.label_names = ()
+
+    def value(self):
+        try:
+            return self.func() or 0
+        except Exception as e:
+            logging.debug(f"Ошибка при вычислении метрики {self.name}: {e}")
+            return 0
+
+    def samples(self):
+        yield self.name, (), (), self.value()
+
+    def snapshot(self):
+        return {self.name: self.value()}
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def _add(self, metric):
+        if not metric.label_names and isinstance(metric, Metric):
+            metric.labels()  # Метрика без меток видна с нулем до первого события
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, label_names=()):
+        return self._add(Counter(name, help, label_names))
+
+    def histogram(self, name, help, label_names=(), buckets=LATENCY_BUCKETS):
+        return self._add(Histogram(name, help, label_names, buckets))
+
+    def counter_func(self, name, help, func):
+        return self._add(FunctionMetric(name, help, 'counter', func))
+
+    def gauge_func(self, name, help, func):
+        return self._add(FunctionMetric(name, help, 'gauge', func))
+
+    def render(self):
+        """Текстовый формат Prometheus 0.0.4"""
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, values, extra, value in metric.samples():
+                lines.append(f"{name}{_format_labels(metric.label_names, values, extra)} {_format_value(value)}")
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self):
+        """Компактный словарь всех метрик (для команды stats)"""
+        result = {}
+        for metric in self.metrics:
+            result.update(metric.snapshot())
+        return result
+
+
+def metrics_handler():
+    """Класс обработчика /metrics; http.server импортируется, только когда эндпоинт включен"""
+    from http.server import BaseHTTPRequestHandler
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = self.server.registry.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    return MetricsHandler
+
+
+def start_http_server(registry, port, host='127.0.0.1'):
+    """Поднимает HTTP-эндпоинт /metrics в фоновом потоке; возвращает сервер"""
+    from http.server import ThreadingHTTPServer
+    server = ThreadingHTTPServer((host, port), metrics_handler())
+    server.daemon_threads = True
+    server.registry = registry
+    threading.Thread(target=server.serve_forever, daemon=True, name='metrics-http').start()
+    return server
@@ -0,0 +1,179 @@
+# protocol.py
+"""Кодек строкового протокола клиент-сервер: кадры в UTF-8, разделенные '\n'.
+
+Версия 2 (согласуется в рукопожатии: сервер добавляет proto=2 к
+CONNECTION_ACCEPTED, клиент подтверждает кадром proto:2) добавляет
+идентификаторы запросов: команда '#17 check_dnd_status' получает ответ
+'#17 dnd_status:1', причем ответы могут приходить в любом порядке. Кадры без
+тега - как в версии 1 (ping/pong, dnd_status: по инициативе клиента). Несколько
+команд можно отправить одним кадром 'batch:["#1 ...", "#2 ..."]' (JSON-массив);
+так же клиент отправляет накопленное без связи состояние сразу после
+рукопожатия. Если сервер объявил history=zlib, клиент передает и историю
+переходов за время разрыва кадром 'history:<base64(zlib(JSON))>'.
+
+Служба, отслеживающая профили нескольких пользователей одного хоста
+(сервер объявил sessions=1), открывает их кадрами 'session_open:<identity>'
+и 'session_close:<identity>', а статусы и команды пользователя адресует
+префиксом: '@ivanov@TS01 dnd_status:1', '#5 @ivanov@TS01 check_dnd_status'.
+Кадры без адреса относятся к самому хосту.
+
+Серверу, объявившему notify=1, клиент подтверждает display_message: кадром
+'message_displayed:<id>' (или сразу 'message_dropped:<id>:<причина>', если
+уведомление отброшено) и потом сообщает 'message_shown:<id>' и
+'message_dismissed:<id>'. Остальные серверы получают прежний
+'message_displayed' без id и событий.
+
+Модуль не зависит от client.py и Windows API, поэтому его может использовать
+и серверная часть.
+"""
+import base64
+import codecs
+import json
+import logging
+import zlib
+
+MAX_FRAME_SIZE = 64 * 1024  # Максимальная длина кадра (в символах)
+RECV_BUFFER_SIZE = 16 * 1024  # Размер предвыделенного буфера приема
+PROTOCOL_VERSION = 2  # Старшая поддерживаемая версия протокола
+BATCH_PREFIX = "batch:"
+HISTORY_PREFIX = "history:"
+
+
+def encode_frame(message):
+    """Кодирует сообщение в кадр протокола"""
+    if not message.endswith('\n'):
+        message += '\n'
+    return message.encode('utf-8')
+
+
+def tag_frame(request_id, message):
+    """Добавляет к сообщению идентификатор запроса: '#id сообщение'"""
+    return f"#{request_id} {message}"
+
+
+def parse_tagged(frame):
+    """Разбирает '#id сообщение' в (id, сообщение); для кадра без тега - (None, кадр)"""
+    if frame.startswith('#'):
+        request_id, separator, message = frame[1:].partition(' ')
+        if separator and request_id:
+            return request_id, message
+    return None, frame
+
+
+def address_frame(identity, message):
+    """Адресует сообщение сессии пользователя: '@identity сообщение'"""
+    return f"@{identity} {message}"
+
+
+def parse_addressed(frame):
+    """Разбирает '@identity сообщение' в (identity, сообщение); без адреса - (None, кадр)"""
+    if frame.startswith('@'):
+        identity, separator, message = frame[1:].partition(' ')
+        if separator and identity:
+            return identity, message
+    return None, frame
+
+
+def encode_batch(messages):
+    """Объединяет несколько сообщений в один кадр batch:"""
+    return BATCH_PREFIX + json.dumps(list(messages), ensure_ascii=False, separators=(',', ':'))
+
+
+def split_batch(frame):
+    """Раскрывает кадр batch: в список сообщений; обычный кадр - список из одного"""
+    if not frame.startswith(BATCH_PREFIX):
+        return [frame]
+    try:
+        messages = json.loads(frame[len(BATCH_PREFIX):])
+    except ValueError:
+        messages = None
+    if not isinstance(messages, list) or not all(isinstance(m, str) for m in messages):
+        logging.warning("Отброшен некорректный кадр batch:")
+        return []
+    return messages
+
+
+def encode_history(entries):
+    """Сжимает историю [(время, сообщение), ...] в кадр history:"""
+    payload = json.dumps([[round(at, 3), message] for at, message in entries],
+                         ensure_ascii=False, separators=(',', ':'))
+    return HISTORY_PREFIX + base64.b64encode(zlib.compress(payload.encode('utf-8'), 9)).decode('ascii')
+
+
+def decode_history(frame):
+    """Разбирает кадр history: в список [время, сообщение]"""
+    data = base64.b64decode(frame[len(HISTORY_PREFIX):])
+    return json.loads(zlib.decompress(data).decode('utf-8'))
+
+
+class FrameDecoder:
+    """Инкрементальный декодер кадров.
+
+    Данные принимаются через recv_into в предвыделенный bytearray и передаются
+    инкрементальному UTF-8 декодеру через memoryview без копирования, поэтому
+    символ, разрезанный границей recv, не теряется. Поиск '\n' идет только по
+    новым данным, так что разбор линеен по объему входа. Кадры длиннее
+    max_frame_size отбрасываются целиком.
+    """
+
+    def __init__(self, max_frame_size=MAX_FRAME_SIZE, buffer_size=RECV_BUFFER_SIZE):
+        self.max_frame_size = max_frame_size
+        self.buffer = bytearray(buffer_size)
+        self.view = memoryview(self.buffer)
+        self.decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        self.pending = []  # Части незавершенного кадра
+        self.pending_size = 0
+        self.discarding = False  # Пропускаем остаток слишком длинного кадра
+        self.dropped_frames = 0
+
+    def recv_from(self, sock):
+        """Читает из сокета в буфер; возвращает список кадров или None при закрытии"""
+        received = sock.recv_into(self.buffer)
+        if not received:
+            return None
+        return self.feed(self.view[:received])
+
+    def feed(self, data):
+        """Принимает очередную порцию байт, возвращает список завершенных кадров"""
+        text = self.decoder.decode(data)
+        frames = []
+        start = 0
+        while True:
+            end = text.find('\n', start)
+            if end < 0:
+                break
+            piece = text[start:end]
+            start = end + 1
+            if self.pending:
+                self.pending.append(piece)
+                piece = ''.join(self.pending)
+                self.pending = []
+                self.pending_size = 0
+            if self.discarding:
+                self.discarding = False
+            elif len(piece) > self.max_frame_size:
+                self._drop()
+            else:
+                frames.append(piece)
+
+        rest = text[start:]
+        if rest and not self.discarding:
+            self.pending.append(rest)
+            self.pending_size += len(rest)
+            if self.pending_size > self.max_frame_size:
+                self.pending = []
+                self.pending_size = 0
+                self.discarding = True
+                self._drop()
+        return frames
+
+    def _drop(self):
+        self.dropped_frames += 1
+        logging.warning(f"Отброшен кадр длиннее {self.max_frame_size} символов")
+
+    def reset(self):
+        """Сбрасывает состояние (например, при новом соединении)"""
+        self.decoder.reset()
+        self.pending = []
+        self.pending_size = 0
+        self.discarding = False